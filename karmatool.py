@@ -66,6 +66,11 @@ Arguments:
    --autoremcustom=3000    Auto remove custom SSIDs from beaconing list after sending 3000
                         beacons without receiving an association (about 5 minutes, 0 = beacon
                         forever)
+   --profile=file.json  Load configuration profile (JSON, see KarmaConfig in mame82_util.py),
+                        options given afterwards override the profile
+   --saveprofile=file.json  Save the resulting configuration as profile
+
+Only the settings which differ from the current firmware configuration are sent.
    
 Example:
    python karmatool.py -k 1 -b 0    Enables KARMA (probe and association responses)
@@ -77,13 +82,12 @@ Example:
    python karmatool.py --addssid="test 1" --addssid="test 2" -s 1
                                     Add SSID "test 1" and "test 2" and enable beaconing for
                                     custom SSIDs
+
+   python karmatool.py --profile=office.json
+                                    Switch to the configuration stored in office.json
 '''
         print(usagescr)
 
-def print_conf():
-	print "Retrieving current configuration ...\n===================================="
-	MaMe82_IO.dump_conf(print_res=True)
-	
 def check_bool_arg(arg):
 	try:
 		res = int(arg)
@@ -96,79 +100,93 @@ def check_bool_arg(arg):
 
 def main(argv):
 	try:
-		opts, args = getopt.getopt(argv, "hicdk:p:a:b:s:", ["help", "interactive", "currentconfig", "setdefault", "clearkarma", "clearssids", "addssid=", "remssid=", "autoremkarma=", "autoremcustom="])
+		opts, args = getopt.getopt(argv, "hicdk:p:a:b:s:", ["help", "interactive", "currentconfig", "setdefault", "clearkarma", "clearssids", "addssid=", "remssid=", "autoremkarma=", "autoremcustom=", "profile=", "saveprofile="])
 	except getopt.GetoptError:
 		print "ERROR: Wrong command line argument(s)"
 		print "-------------------------------------\n"
 		usage()
 		sys.exit(2)
-		
+
+	# the options are collected into the desired configuration, which is applied at once afterwards
+	desired = KarmaConfig()
+	save_profile = None
+	changes_requested = False
 	for opt, arg in opts:
 		if opt in ("-h", "--help"):
 			usage()
 			sys.exit()
 		elif opt in ("-d", "--setdefault"):
 			print "Setting default configuration ..."
-			MaMe82_IO.set_defaults()
-			print_conf()
-			sys.exit()
+			desired.merge(KarmaConfig.defaults())
+			changes_requested = True
 		elif opt in ("-i", "--interactive"):
 			print "Interactive mode"
 			print "... Sorry, feature not implemented, yet ... stay tuned"
 			sys.exit()
 		elif opt in ("-c", "--currentconfig"):
-			print_conf()
+			pass # the configuration is printed at the end
+		elif opt == "--profile":
+			try:
+				desired.merge(KarmaConfig.from_json(arg))
+				changes_requested = True
+			except (IOError, ValueError) as e:
+				print "Couldn't load profile {0}: {1} ... ignoring option".format(arg, e)
+		elif opt == "--saveprofile":
+			save_profile = arg
 		elif opt == "-p":
 			val = check_bool_arg(arg)
 			if (val == -1):
 				print "Argument error for -p (KARMA probe), must be 0 or 1 .... ignoring option"
 			else:
-				print "Setting KARMA probe responses to {0}".format("On" if (val==1) else "Off")
-				MaMe82_IO.set_enable_karma_probe(True if (val==1) else False)
+				desired.karma_probes = (val == 1)
+				changes_requested = True
 		elif opt == "-a":
 			val = check_bool_arg(arg)
 			if (val == -1):
 				print "Argument error for -a (KARMA associations), must be 0 or 1 .... ignoring option"
 			else:
-				print "Setting KARMA association responses to {0}".format("On" if (val==1) else "Off")
-				MaMe82_IO.set_enable_karma_assoc(True if (val==1) else False)
+				desired.karma_assocs = (val == 1)
+				changes_requested = True
 		elif opt == "-k":
 			val = check_bool_arg(arg)
 			if (val == -1):
 				print "Argument error for -k (KARMA probes and associations), must be 0 or 1 .... ignoring option"
 			else:
-				print "Setting KARMA probe and association responses to {0}".format("On" if (val==1) else "Off")
-				MaMe82_IO.set_enable_karma(True if (val==1) else False)
+				desired.karma_probes = (val == 1)
+				desired.karma_assocs = (val == 1)
+				changes_requested = True
 		elif opt == "-b":
 			val = check_bool_arg(arg)
 			if (val == -1):
 				print "Argument error for -b (KARMA beaconing), must be 0 or 1 .... ignoring option"
 			else:
-				print "Setting KARMA beaconing to {0}".format("On" if (val==1) else "Off")
-				MaMe82_IO.set_enable_karma_beaconing(True if (val==1) else False)
+				desired.karma_beacons = (val == 1)
+				changes_requested = True
 		elif opt == "-s":
 			val = check_bool_arg(arg)
 			if (val == -1):
 				print "Argument error for -s (custom beaconing), must be 0 or 1 .... ignoring option"
 			else:
-				print "Setting custom beaconing to {0}".format("On" if (val==1) else "Off")
-				MaMe82_IO.set_enable_custom_beaconing(True if (val==1) else False)
+				desired.custom_beacons = (val == 1)
+				changes_requested = True
 		elif opt == "--addssid":
 			if len(arg) == 0 or len(arg) > 32:
 				print "Argument error for --addssid, mustn't be empty max length is 32 ... ignoring option"
 			else:
-				MaMe82_IO.add_custom_ssid(arg)
+				desired.add_custom_ssid(arg)
+				changes_requested = True
 		elif opt == "--remssid":
 			if len(arg) == 0 or len(arg) > 32:
 				print "Argument error for --remssid, mustn't be empty max length is 32 ... ignoring option"
 			else:
-				MaMe82_IO.rem_custom_ssid(arg)
+				desired.remove_custom_ssid(arg)
+				changes_requested = True
 		elif opt == "--clearssids":
-			print "Removing all custom SSIDs"
-			MaMe82_IO.clear_custom_ssids()
+			desired.clear_custom_ssids()
+			changes_requested = True
 		elif opt == "--clearkarma":
-			print "Removing all KARMA SSIDs (no influence on probe / assoc responses)"
-			MaMe82_IO.clear_karma_ssids()
+			desired.clear_karma_ssids = True
+			changes_requested = True
 		elif opt == "--autoremkarma":
 			error="An integer value >=0 is needed for autoremkarma ... ignoring option"
 			try:
@@ -176,8 +194,8 @@ def main(argv):
 				if (val < 0):
 					print error
 				else:
-					print "Removing KARMA SSIDs after sending {0} beacons without occuring association".format(val)
-					MaMe82_IO.set_autoremove_karma_ssids(val)
+					desired.karma_beacon_autoremove = val
+					changes_requested = True
 			except ValueError:
 				print error
 		elif opt == "--autoremcustom":
@@ -187,15 +205,36 @@ def main(argv):
 				if (val < 0):
 					print error
 				else:
-					print "Removing custom SSIDs after sending {0} beacons without occuring association".format(val)
-					MaMe82_IO.set_autoremove_custom_ssids(val)
+					desired.custom_beacon_autoremove = val
+					changes_requested = True
 			except ValueError:
 				print error
-			
-			
-		
-	print ""
-	print_conf()
+
+	# the firmware config is read once (by the shadow config), applied changes are recorded by the shadow config,
+	# thus the config printed at the end doesn't need to be read again
+	print "Retrieving current configuration ..."
+	current = MaMe82_IO.get_conf()
+	if current == None:
+		sys.exit(1)
+
+	if changes_requested:
+		changes = desired.diff(current)
+		for desc, buf in changes:
+			print desc
+		sent = KarmaConfig.apply(changes)
+		print "{0} setting(s) changed".format(sent)
+		current = MaMe82_IO.get_conf()
+		if current == None:
+			sys.exit(1)
+
+	if save_profile != None:
+		profile = KarmaConfig()
+		profile.merge(current)
+		profile.save_json(save_profile)
+		print "Configuration saved to {0}".format(save_profile)
+
+	print "\nCurrent configuration\n===================================="
+	current.print_conf()
 
 		
 
@@ -24,8 +24,15 @@
 import fcntl
 import socket
 import os
+import time
+import threading
+from select import select
 from ctypes import *
 import struct
+import json
+import mmap
+import zlib
+from collections import OrderedDict, deque
 
 class struct_mame82_probe_resp_arg(Structure):
 	_fields_ = [("da", c_ubyte*6),
@@ -191,10 +198,28 @@ class nexconf:
 			print "No Netlink IOCTL connection possible"
 			return None
 
-		# bind to kernel
-		s.bind((os.getpid(), 0))
+		# bind to a port ID chosen by the kernel (the PID is handed out to the first netlink socket of the process only,
+		# f.e. NexmonSession), the assigned port ID is returned by nexconf.nl_portid()
+		s.bind((0, 0))
 		
 		return s
+
+	@staticmethod
+	def nl_portid(s):
+		# port ID the netlink socket s (or a file object of a netlink socket) is bound to, used as nlmsg_pid. Objects
+		# without a netlink socket (f.e. a stand-in for tests) get the PID.
+		try:
+			if hasattr(s, "getsockname"):
+				return s.getsockname()[0]
+			if hasattr(s, "fileno"):
+				sock = socket.fromfd(s.fileno(), socket.AF_NETLINK, socket.SOCK_RAW) # dup, only to query the port ID
+				try:
+					return sock.getsockname()[0]
+				finally:
+					sock.close()
+		except (socket.error, TypeError, IndexError):
+			pass
+		return os.getpid()
 		
 	def closeNL_sock(s):
 		s.close()
@@ -216,7 +241,6 @@ class nexconf:
 		nlh = cast(pointer(nlhbuf), POINTER(struct_nlmsghdr))
 
 		nlh.contents.nlmsg_len = nexconf.NLMSG_SPACE(frame_len)
-		nlh.contents.nlmsg_pid = os.getpid();
 		nlh.contents.nlmsg_flags = 0;
 
 
@@ -236,9 +260,8 @@ class nexconf:
 		# frame to string
 		fstr = nexconf.ptr2str(frame, nexconf.NLMSG_SPACE(frame_len) - nexconf.NLMSG_LENGTH(0))
 
-		#full buf to string (including nlhdr)
+		#full buf to string (including nlhdr), serialized once nlmsg_pid is known
 		p_nlhbuf = pointer(nlhbuf)
-		bstr = nexconf.ptr2str(p_nlhbuf, nexconf.NLMSG_SPACE(frame_len))
 
 
 		'''
@@ -262,10 +285,14 @@ class nexconf:
 				return None
 
 			# bind to kernel
-			s.bind((os.getpid(), 0))
+			s.bind((0, 0))
+			nlh.contents.nlmsg_pid = nexconf.nl_portid(s)
 			sfd = os.fdopen(s.fileno(), 'w+b')
 		else:
 			sfd = nl_socket_fd
+			nlh.contents.nlmsg_pid = nexconf.nl_portid(sfd)
+
+		bstr = nexconf.ptr2str(p_nlhbuf, nexconf.NLMSG_SPACE(frame_len))
 
 		sfd.write(bstr)
 		sfd.flush()
@@ -337,8 +364,302 @@ class nexconf:
 		# send ioctl to kernel via UDP socket
 		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		fcntl.ioctl(s.fileno(), SIOCDEVPRIVATE, ifr)
-		s.close()		
-		
+		s.close()
+
+class ProbeRespTX:
+	# TX engine for MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP
+	#
+	# Instead of building ctypes structs and a new buffer for every probe response (create_cmd_ioctl + sendNL_IOCTL),
+	# complete netlink messages (nlmsghdr + nexudp_ioctl_hdr + probe response argument) are prebuilt once.
+	# Per response only DA, BSSID, SSID IE data and vendor IE data are patched in place and the message is
+	# written to a persistent netlink socket with a single send().
+	#
+	# Message layout (byte identical to what sendNL_IOCTL produces):
+	#
+	# 0..15		nlmsghdr (nlmsg_len, type 0, flags 0, seq 0, pid)
+	# 16..23	nexudp_hdr ("NEX", NEXUDP_IOCTL, securitycookie 0)
+	# 24..31	cmd (MaMe82_IO.CMD), set (1)
+	# 32..39	arg type (SEND_PROBE_RESP), arg len
+	# 40..45	da
+	# 46..51	bssid
+	# 52..85	SSID IE (type 0, len 32, 32 bytes data)
+	# 86..		additional IEs given on construction (f.e. supported rates, DS parameter set)
+	# ...		0..MAX_VEN_IES vendor IEs (type 221, len 238, 238 bytes data each)
+
+	NLMSG_HDR = struct.Struct("<IHHII") # nlmsg_len, nlmsg_type, nlmsg_flags, nlmsg_seq, nlmsg_pid
+	NEXUDP_IOCTL_HDR = struct.Struct("<3scIII") # nex, type, securitycookie, cmd, set
+	PROBE_RESP_HDR = struct.Struct("<II") # arg type, arg len
+
+	DA_OFFSET = 40
+	BSSID_OFFSET = 46
+	SSID_DATA_OFFSET = 54
+	SSID_DATA_LEN = 32
+	VEN_IE_DATA_LEN = 238
+	VEN_IE_STRIDE = 2 + VEN_IE_DATA_LEN # distance between the data of consecutive vendor IEs
+	MAX_VEN_IES = 4
+
+	SSID_DATA = struct.Struct("32s") # pads with zeroes
+	VEN_IE_DATA = struct.Struct("238s") # pads with zeroes
+
+	def __init__(self, extra_ies="", nl_socket=None):
+		self.extra_ies = extra_ies
+		self.nl_socket = nl_socket
+		self.portid = nexconf.nl_portid(nl_socket) # nlmsg_pid of the prebuilt messages
+		self.tx_count = 0 # number of probe responses handed to the driver
+
+		# offset of the first vendor IE's data (behind SSID IE, additional IEs and vendor IE type/len), further
+		# vendor IEs follow in distance of VEN_IE_STRIDE
+		self.ven_ie_data_offset = ProbeRespTX.SSID_DATA_OFFSET + ProbeRespTX.SSID_DATA_LEN + len(extra_ies) + 2
+
+		# templates indexed by number of vendor IEs
+		self.__templates = [self.__build_template(count) for count in range(ProbeRespTX.MAX_VEN_IES + 1)]
+
+	def __build_template(self, ven_ie_count):
+		arg = struct.pack("<BB32s", 0, ProbeRespTX.SSID_DATA_LEN, "") + self.extra_ies
+		arg += struct.pack("<BB238s", 221, ProbeRespTX.VEN_IE_DATA_LEN, "") * ven_ie_count
+		arg_len = 12 + len(arg) # da + bssid + IEs
+		ioc_len = ProbeRespTX.PROBE_RESP_HDR.size + arg_len
+		if ven_ie_count == 0:
+			arg_len += 2 # the legacy code announced 48 bytes for da, bssid and SSID IE, kept to produce identical frames
+
+		# same length calculation as sendNL_IOCTL
+		frame_len = ioc_len + sizeof(struct_nexudp_ioctl_hdr) - sizeof(c_char)
+		msg_len = nexconf.NLMSG_SPACE(frame_len)
+
+		buf = bytearray(msg_len)
+		ProbeRespTX.NLMSG_HDR.pack_into(buf, 0, msg_len, 0, 0, 0, self.portid)
+		ProbeRespTX.NEXUDP_IOCTL_HDR.pack_into(buf, nexconf.NLMSG_HDRLEN(), "NEX", chr(nexconf.NEXUDP_IOCTL), 0, MaMe82_IO.CMD, 1)
+		ProbeRespTX.PROBE_RESP_HDR.pack_into(buf, 32, MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP, arg_len)
+		buf[ProbeRespTX.SSID_DATA_OFFSET - 2:ProbeRespTX.SSID_DATA_OFFSET - 2 + len(arg)] = arg
+		return buf
+
+	def open(self):
+		if self.nl_socket == None:
+			self.nl_socket = nexconf.openNL_sock()
+			if self.nl_socket != None:
+				# the kernel assigned port ID is known now
+				self.portid = nexconf.nl_portid(self.nl_socket)
+				self.__templates = [self.__build_template(count) for count in range(ProbeRespTX.MAX_VEN_IES + 1)]
+		return self.nl_socket != None
+
+	def close(self):
+		if self.nl_socket != None:
+			self.nl_socket.close()
+			self.nl_socket = None
+
+	def get_frame(self, da, bssid, ven_ie_count=0):
+		# returns the prebuilt message with DA and BSSID (6 byte binary strings) patched in, the SSID IE data
+		# (at SSID_DATA_OFFSET) and vendor IE data (at ven_ie_data_offset + n * VEN_IE_STRIDE) have to be filled
+		# by the caller before handing the frame to send_frame()
+		buf = self.__templates[ven_ie_count]
+		buf[ProbeRespTX.DA_OFFSET:ProbeRespTX.DA_OFFSET + 6] = da
+		buf[ProbeRespTX.BSSID_OFFSET:ProbeRespTX.BSSID_OFFSET + 6] = bssid
+		return buf
+
+	def send_frame(self, buf):
+		self.nl_socket.send(buf)
+		self.tx_count += 1
+
+	def send(self, da, bssid, ie_ssid_data, ie_vendor_data=None):
+		# ie_vendor_data could be the data of a single vendor IE or a list with data for multiple vendor IEs
+		if ie_vendor_data == None:
+			ie_vendor_data = []
+		elif not isinstance(ie_vendor_data, list):
+			ie_vendor_data = [ie_vendor_data]
+		buf = self.get_frame(da, bssid, len(ie_vendor_data))
+		ProbeRespTX.SSID_DATA.pack_into(buf, ProbeRespTX.SSID_DATA_OFFSET, ie_ssid_data)
+		for i in range(len(ie_vendor_data)):
+			ProbeRespTX.VEN_IE_DATA.pack_into(buf, self.ven_ie_data_offset + i * ProbeRespTX.VEN_IE_STRIDE, ie_vendor_data[i])
+		self.send_frame(buf)
+
+
+class NexmonSession:
+	# Persistent netlink session for ioctls to the nexmon driver
+	#
+	# sendNL_IOCTL creates, binds and closes a new netlink socket per ioctl and reads GET replies without a timeout.
+	# A session keeps one socket open, stamps a sequence number (nlmsg_seq) on every request and matches replies by it.
+	# If a reply carries an unknown sequence number (f.e. 0, as the driver doesn't have to echo it), it is assigned to
+	# the oldest pending GET request, as replies are sent in order of the requests. Several GET requests could be in
+	# flight (submit() / wait()), waiting for a reply is bounded by a timeout.
+	# Replies which don't fit into a single netlink message are reassembled: parts are flagged NLM_F_MULTI (a datagram
+	# could carry several of them) and the data following their nlmsghdr is concatenated, till NLMSG_DONE arrives or the
+	# expected reply length is complete.
+	#
+	# Like all netlink sockets of this module (see nexconf.openNL_sock()), the socket is bound to a port ID chosen by the
+	# kernel, the assigned port ID is used as nlmsg_pid. The kernel hands out the PID to the first of these sockets only,
+	# thus binding any of them to the PID explicitly would fail once the session is open.
+
+	NLMSG_HDR = struct.Struct("<IHHII") # nlmsg_len, nlmsg_type, nlmsg_flags, nlmsg_seq, nlmsg_pid
+	NEXUDP_IOCTL_HDR = struct.Struct("<3scIII") # nex, type, securitycookie, cmd, set
+	PAYLOAD_OFFSET = NLMSG_HDR.size + NEXUDP_IOCTL_HDR.size # offset of the ioctl payload in requests and replies
+	MAX_REPLY_LEN = 0xFFFF
+	NLM_F_MULTI = 0x2
+	NLMSG_DONE = 0x3
+
+	def __init__(self, timeout=2.0):
+		self.timeout = timeout # default seconds to wait for a reply
+		self.nl_socket = None
+		self.portid = 0
+		self.requests = 0 # number of ioctls sent
+		self.replies = 0 # number of replies matched to a GET request
+		self.timeouts = 0 # number of GET requests which didn't receive a reply in time
+		self.stale = 0 # number of received messages, which couldn't be matched to a pending request (dropped)
+		self.__seq = 0
+		self.__pending = OrderedDict() # seq -> [expected reply length, reply or None, parts of a multi-part reply], in order of submission
+		self.multipart_replies = 0 # number of replies reassembled from multiple netlink messages
+		self.__completed_by_length = None # last multi-part reply completed by its length (before NLMSG_DONE arrived)
+		self.__lock = threading.RLock()
+
+	def open(self):
+		if self.nl_socket != None:
+			return True
+		try:
+			s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, nexconf.NETLINK_USER)
+		except socket.error:
+			print "No Netlink IOCTL connection possible"
+			return False
+		s.bind((0, 0))
+		self.portid = s.getsockname()[0]
+		self.nl_socket = s
+		return True
+
+	def close(self):
+		with self.__lock:
+			if self.nl_socket != None:
+				self.nl_socket.close()
+				self.nl_socket = None
+			self.__pending.clear()
+
+	def __enter__(self):
+		self.open()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def submit(self, cmd, buf, set_val=False):
+		# sends the ioctl and returns its sequence number, which has to be passed to wait() for GET requests (set_val
+		# False). Returns None if the session couldn't be opened.
+		if not self.open():
+			return None
+
+		# same length calculation as sendNL_IOCTL (the request buffer size defines the size of the reply)
+		frame_len = len(buf) + sizeof(struct_nexudp_ioctl_hdr) - sizeof(c_char)
+		msg_len = nexconf.NLMSG_SPACE(frame_len)
+
+		with self.__lock:
+			if not set_val and len(self.__pending) == 0:
+				self.__drain() # drop leftovers (f.e. replies of timed out requests), which would be matched in order otherwise
+			self.__seq = (self.__seq % 0xFFFFFFFF) + 1 # never 0
+			seq = self.__seq
+			msg = NexmonSession.NLMSG_HDR.pack(msg_len, 0, 0, seq, self.portid)
+			msg += NexmonSession.NEXUDP_IOCTL_HDR.pack("NEX", chr(nexconf.NEXUDP_IOCTL), 0, cmd, 1 if set_val else 0)
+			msg += buf
+			msg += "\x00" * (msg_len - len(msg))
+			if not set_val:
+				self.__pending[seq] = [msg_len, None, []]
+			self.nl_socket.send(msg)
+			self.requests += 1
+		return seq
+
+	def wait(self, seq, timeout=None):
+		# returns the payload of the reply for the GET request with the given sequence number, None if it didn't
+		# arrive within timeout seconds (default: self.timeout)
+		if timeout == None:
+			timeout = self.timeout
+		deadline = time.time() + timeout
+		with self.__lock:
+			entry = self.__pending.get(seq)
+			if entry == None:
+				return None
+			while entry[1] == None:
+				remaining = deadline - time.time()
+				if remaining <= 0 or len(select([self.nl_socket], [], [], remaining)[0]) == 0:
+					del self.__pending[seq]
+					self.timeouts += 1
+					return None
+				self.__receive()
+			del self.__pending[seq]
+			return entry[1][NexmonSession.PAYLOAD_OFFSET:entry[0]]
+
+	def request(self, cmd, buf, set_val=False, timeout=None):
+		# sends the ioctl, for GET requests the payload of the reply is returned (None on timeout), "" otherwise
+		seq = self.submit(cmd, buf, set_val)
+		if seq == None:
+			return None
+		if set_val:
+			return ""
+		return self.wait(seq, timeout)
+
+	def send_ioctl(self, ioc, timeout=None):
+		# counterpart of nexconf.sendNL_IOCTL for a struct_IOCTL (see nexconf.create_cmd_ioctl)
+		return self.request(ioc.cmd, nexconf.ptr2str(ioc.buf, ioc.len), ioc.set, timeout)
+
+	def __receive(self):
+		# reads one datagram (the socket is readable) and assigns it to its request
+		msg = self.nl_socket.recv(NexmonSession.MAX_REPLY_LEN)
+		if len(msg) < NexmonSession.NLMSG_HDR.size:
+			self.stale += 1
+			return
+		nlmsg_len, nlmsg_type, nlmsg_flags, seq = NexmonSession.NLMSG_HDR.unpack_from(msg)[:4]
+		if not (nlmsg_flags & NexmonSession.NLM_F_MULTI or nlmsg_type == NexmonSession.NLMSG_DONE):
+			# single message reply, the whole datagram is taken (as sendNL_IOCTL does)
+			entry = self.__match(seq)
+			if entry == None or entry[1] != None:
+				self.stale += 1
+				return
+			entry[1] = msg
+			self.replies += 1
+			return
+
+		# parts of multi-part replies
+		pos = 0
+		while pos + NexmonSession.NLMSG_HDR.size <= len(msg):
+			nlmsg_len, nlmsg_type, nlmsg_flags, seq = NexmonSession.NLMSG_HDR.unpack_from(msg, pos)[:4]
+			if nlmsg_len < NexmonSession.NLMSG_HDR.size or pos + nlmsg_len > len(msg):
+				break
+			if nlmsg_type == NexmonSession.NLMSG_DONE and self.__completed_by_length != None and not seq in self.__pending:
+				# terminates a reply, which has been completed by its length already (unknown sequence number)
+				entry = self.__completed_by_length
+			else:
+				entry = self.__match(seq)
+			self.__completed_by_length = None
+			if entry == None:
+				self.stale += 1
+			elif entry[1] != None:
+				pass # NLMSG_DONE or surplus part of a reply completed by its length
+			elif nlmsg_type == NexmonSession.NLMSG_DONE:
+				self.__complete(entry)
+			else:
+				entry[2].append(msg[pos:pos + nlmsg_len] if len(entry[2]) == 0 else msg[pos + NexmonSession.NLMSG_HDR.size:pos + nlmsg_len])
+				if sum(len(part) for part in entry[2]) >= entry[0]:
+					self.__complete(entry)
+					self.__completed_by_length = entry
+			pos += nexconf.NLMSG_ALIGN(nlmsg_len)
+
+	def __match(self, seq):
+		# returns the pending entry for the sequence number or, if unknown, the oldest GET request still waiting for its reply
+		entry = self.__pending.get(seq)
+		if entry != None:
+			return entry
+		for candidate in self.__pending.itervalues():
+			if candidate[1] == None:
+				return candidate
+		return None
+
+	def __complete(self, entry):
+		# the first part is kept with its headers, thus the payload is at PAYLOAD_OFFSET of the reassembled reply
+		entry[1] = "".join(entry[2])
+		entry[2] = []
+		self.replies += 1
+		self.multipart_replies += 1
+
+	def __drain(self):
+		while len(select([self.nl_socket], [], [], 0)[0]) > 0:
+			self.nl_socket.recv(NexmonSession.MAX_REPLY_LEN)
+			self.stale += 1
+
+
 class MaMe82_IO:
 	CMD=666
 	CMD_RETRIEVE_CAP = 400
@@ -365,45 +686,70 @@ class MaMe82_IO:
 	def s2hex(s):
 		return "".join(map("0x%2.2x ".__mod__, map(ord, s)))
 
+	__probe_resp_tx = None # ProbeRespTX engine with persistent netlink socket, created on first use
+	session = None # NexmonSession used for all ioctls, created on first use (could be replaced, f.e. to change the timeout)
+	shadow = None # ShadowConfig kept up to date by all set ioctls, created on first use (get_conf())
+
+	@staticmethod
+	def get_session():
+		if MaMe82_IO.session == None:
+			MaMe82_IO.session = NexmonSession()
+		return MaMe82_IO.session
+
+	@staticmethod
+	def send_ioctl(ioc):
+		# sends the struct_IOCTL with the persistent session, returns the reply payload for GET requests (None on timeout)
+		return MaMe82_IO.get_session().send_ioctl(ioc)
+
+	# argument buffers of the MaMe82_IO.CMD set ioctls (arg type, arg len, arg)
+
+	@staticmethod
+	def arg_bool(arg_type, on):
+		return struct.pack("IIB", arg_type, 1, 1 if on else 0)
+
+	@staticmethod
+	def arg_uint(arg_type, value):
+		return struct.pack("III", arg_type, 4, value)
+
+	@staticmethod
+	def arg_ssid(arg_type, ssid):
+		return struct.pack("II{0}s".format(len(ssid)), arg_type, len(ssid), ssid)
+
+	@staticmethod
+	def arg_empty(arg_type):
+		return struct.pack("II", arg_type, 0)
+
+	@staticmethod
+	def set_arg(buf):
+		# sends a set ioctl, if it has been sent the change is recorded in the shadow config
+		if MaMe82_IO.send_ioctl(nexconf.create_cmd_ioctl(MaMe82_IO.CMD, buf, True)) == None:
+			return False
+		if MaMe82_IO.shadow != None:
+			MaMe82_IO.shadow.record(buf)
+		return True
+
+	@staticmethod
+	def get_shadow():
+		if MaMe82_IO.shadow == None:
+			MaMe82_IO.shadow = ShadowConfig()
+		return MaMe82_IO.shadow
+
+	@staticmethod
+	def get_conf(max_age=None):
+		# type: (float) -> KarmaConfig
+		# returns the current config from the shadow config (read from the firmware on first use, if it is older than
+		# max_age seconds or than the interval of the shadow config), None if the firmware couldn't be read
+		return MaMe82_IO.get_shadow().get(max_age)
+
 	@staticmethod
 	def send_probe_resp(bssid, da="ff:ff:ff:ff:ff:ff", ie_ssid_data="TEST_SSID", ie_vendor_data=None):
-		arr_bssid = mac2bstr(bssid)
-		arr_da = mac2bstr(da)
-		
-		ie_ssid_type = 0
-		ie_ssid_len = 32
-		ie_vendor_type = 221
-		ie_vendor_len = 238
-		
-		buf = ""
-		
-		if ie_vendor_data == None:
-			buf = struct.pack("<II6s6sBB32s", 
-				MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP, 
-				48, # 6 + 6 + 1 + 1 +32 + 1 + 1 + 238
-				arr_da, 
-				arr_bssid,
-				ie_ssid_type,
-				ie_ssid_len,
-				ie_ssid_data)
-		else:
-			buf = struct.pack("<II6s6sBB32sBB238s", 
-				MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP, 
-				286, # 6 + 6 + 1 + 1 +32 + 1 + 1 + 238
-				arr_da, 
-				arr_bssid,
-				ie_ssid_type,
-				ie_ssid_len,
-				ie_ssid_data,
-				# insert additional IEs here
-				ie_vendor_type,
-				ie_vendor_len,
-				ie_vendor_data)
-		
-		#print repr(buf)
-		
-		ioctl_sendprbrsp = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, buf, True)
-		nexconf.sendNL_IOCTL(ioctl_sendprbrsp)
+		if MaMe82_IO.__probe_resp_tx == None:
+			tx = ProbeRespTX()
+			if not tx.open():
+				return
+			MaMe82_IO.__probe_resp_tx = tx
+
+		MaMe82_IO.__probe_resp_tx.send(mac2bstr(da), mac2bstr(bssid), ie_ssid_data, ie_vendor_data)
 		
 	@staticmethod
 	def send_deauth(bssid, da="ff:ff:ff:ff:ff:ff", reason=0x0007):
@@ -414,17 +760,20 @@ class MaMe82_IO:
 		print repr(buf)
 		
 		ioctl_senddeauth = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, buf, True)
-		nexconf.sendNL_IOCTL(ioctl_senddeauth)
+		MaMe82_IO.send_ioctl(ioctl_senddeauth)
 
 	@staticmethod
 	def set_ch(channel):
 		ioctl = nexconf.create_cmd_ioctl(30, struct.pack("<I", channel), True)
-		res = nexconf.sendNL_IOCTL(ioctl)
+		res = MaMe82_IO.send_ioctl(ioctl)
 
 	@staticmethod
 	def get_ch():
 		ioctl = nexconf.create_cmd_ioctl(29, "", False)
-		res = nexconf.sendNL_IOCTL(ioctl)
+		res = MaMe82_IO.send_ioctl(ioctl)
+		if res == None:
+			print "Couldn't retrieve channel"
+			return None
 		return struct.unpack("<I", res[:4])[0]
 	
 	@staticmethod
@@ -432,82 +781,56 @@ class MaMe82_IO:
 		if len(ssid) > 32:
 			print "SSID too long, 32 chars max"
 			return
-		ioctl_addssid = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("II{0}s".format(len(ssid)), MaMe82_IO.MAME82_IOCTL_ARG_TYPE_ADD_CUSTOM_SSID, len(ssid), ssid), True)
-		nexconf.sendNL_IOCTL(ioctl_addssid)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_ssid(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_ADD_CUSTOM_SSID, ssid))
 		
 	@staticmethod
 	def rem_custom_ssid(ssid):
 		if len(ssid) > 32:
 			print "SSID too long, 32 chars max"
 			return
-		ioctl_addssid = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("II{0}s".format(len(ssid)), MaMe82_IO.MAME82_IOCTL_ARG_TYPE_DEL_CUSTOM_SSID, len(ssid), ssid), True)
-		nexconf.sendNL_IOCTL(ioctl_addssid)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_ssid(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_DEL_CUSTOM_SSID, ssid))
 	
 	@staticmethod
 	def set_enable_karma_probe(on=True):
-		if on:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_PROBE, 1, 1), True)
-		else:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_PROBE, 1, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_bool(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_PROBE, on))
 	
 	@staticmethod	
 	def set_enable_karma_assoc(on=True):
-		if on:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_ASSOC, 1, 1), True)
-		else:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_ASSOC, 1, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_bool(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_ASSOC, on))
 		
 	@staticmethod	
 	def set_enable_karma_beaconing(on=True):
-		if on:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_BEACON, 1, 1), True)
-		else:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_BEACON, 1, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_bool(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_BEACON, on))
 
 	@staticmethod	
 	def set_enable_custom_beaconing(on=True):
-		if on:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_CUSTOM_BEACONS, 1, 1), True)
-		else:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_CUSTOM_BEACONS, 1, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_bool(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_CUSTOM_BEACONS, on))
 
 		
 	@staticmethod	
 	def set_enable_karma(on=True):
-		if on:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA, 1, 1), True)
-		else:
-			ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("IIB", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA, 1, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_bool(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA, on))
 		
 	@staticmethod	
 	def clear_custom_ssids():
-		ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("II", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_CUSTOM_SSIDS, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_empty(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_CUSTOM_SSIDS))
 		
 	@staticmethod	
 	def clear_karma_ssids():
-		ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("II", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_KARMA_SSIDS, 0), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_empty(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_KARMA_SSIDS))
 		
 	@staticmethod	
 	def set_autoremove_custom_ssids(beacon_count):
-		ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("III", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_CUSTOM_BEACON_AUTO_REMOVE_COUNT, 4, beacon_count), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_uint(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_CUSTOM_BEACON_AUTO_REMOVE_COUNT, beacon_count))
 		
 	@staticmethod	
 	def set_autoremove_karma_ssids(beacon_count):
-		ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("III", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_KARMA_BEACON_AUTO_REMOVE_COUNT, 4, beacon_count), True)
-		nexconf.sendNL_IOCTL(ioctl)
+		MaMe82_IO.set_arg(MaMe82_IO.arg_uint(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_KARMA_BEACON_AUTO_REMOVE_COUNT, beacon_count))
 		
 	@staticmethod
 	def check_for_karma_cap():
 		ioctl = nexconf.create_cmd_ioctl(400, "", False) # there's a length check for the CAPs ioctl, forcing size to 4 (only command, no arg buffer)
-		res = nexconf.sendNL_IOCTL(ioctl)
+		res = MaMe82_IO.send_ioctl(ioctl)
 		if res == None:
 			return False
 		else:
@@ -520,7 +843,7 @@ class MaMe82_IO:
 	@staticmethod
 	def dump_conf(print_res=True, dump_ssids=True):
 		ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("II40s", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_GET_CONFIG, 4, ""), False)
-		res = nexconf.sendNL_IOCTL(ioctl)
+		res = MaMe82_IO.send_ioctl(ioctl)
 		
 		if res == None:
 			print "Couldn't retrieve config"
@@ -530,35 +853,22 @@ class MaMe82_IO:
 		memmove(addressof(mame82_config), res, min(len(res), sizeof(struct_mame82_config)))
 		
 		if dump_ssids:
-			mame82_config.ssids_karma = MaMe82_IO.dump_ssid_list(cast(mame82_config.ssids_karma, c_void_p).value)
-			mame82_config.ssids_custom = MaMe82_IO.dump_ssid_list(cast(mame82_config.ssids_custom, c_void_p).value)
+			# both lists are resolved from the same memory windows (nodes are allocated from the same heap)
+			reader = FirmwareMemoryReader()
+			ssids_karma = MaMe82_IO.dump_ssid_list(cast(mame82_config.ssids_karma, c_void_p).value, reader)
+			ssids_custom = MaMe82_IO.dump_ssid_list(cast(mame82_config.ssids_custom, c_void_p).value, reader)
+			if ssids_karma == None or ssids_custom == None:
+				print "Couldn't retrieve SSID lists"
+				return None
+			mame82_config.ssids_karma = ssids_karma
+			mame82_config.ssids_custom = ssids_custom
 		else:
 			mame82_config.ssids_karma = None
 			mame82_config.ssids_custom = None
 		
 		
 		if print_res:
-			print "KARMA PROBES - Answer probe requests for foreign SSIDs [{0}]".format("On" if mame82_config.karma_probes else "Off")
-			print "KARMA ASSOCS - Answer association requests for foreign SSIDs [{0}]".format("On" if mame82_config.karma_assocs else "Off")
-			print "KARMA SSIDs - Broadcast beacons for foreigin SSIDs after probe request [{0}]".format("On" if mame82_config.karma_beacons else "Off")
-			print "CUSTOM SSIDs - Broadcast beacons for custom SSIDs (added by user) [{0}]".format("On" if mame82_config.custom_beacons else "Off")
-			print "(unused for now) Print debug messages to BCM43430a1 internal console [{0}]".format("On" if mame82_config.debug_out else "Off")
-			
-			print "\nStop sending more beacons for KARMA SSIDs if no association request is received\nafter [{0}] beacons (0 send forever)".format(mame82_config.karma_beacon_autoremove)
-			print "\nStop sending more beacons for CUSTOM SSIDs if no association request is received\nafter [{0}] beacons (0 send forever)".format(mame82_config.custom_beacon_autoremove)
-
-			print "\nMaximum allowed KARMA SSIDs for beaconing (no influence on assocs / probes): [{0}]".format(mame82_config.max_karma_beacon_ssids)
-			print "Maximum allowed CUSTOM SSIDs: [{0}]".format(mame82_config.max_custom_beacon_ssids)
-
-			print ""
-	
-			if cast(mame82_config.ssids_karma, c_void_p).value != None:
-				print "Beaconed SSIDs from probes (KARMA SSIDs), right now:\n{0}".format(MaMe82_IO.ssid_list2str(mame82_config.ssids_karma))
-			
-			print ""
-				
-			if cast(mame82_config.ssids_karma, c_void_p).value != None:
-				print "Beaconed SSIDs defined by user, right now:\n{0}".format(MaMe82_IO.ssid_list2str(mame82_config.ssids_custom))
+			KarmaConfig.from_mame82_config(mame82_config).print_conf()
 			
 		# fetch structs for SSID list
 		return mame82_config
@@ -578,29 +888,45 @@ class MaMe82_IO:
 		# valid 0x80 - 0x07ffff
 		# valid 0x800000 - 0x89ffff
 		if dump_len < 16:
-			printf("Minimum length for dumping is 16 bytes")
+			print "Minimum length for dumping is 16 bytes"
 			return ""
 		ioctl = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, struct.pack("III{0}s".format(dump_len - 16), MaMe82_IO.MAME82_IOCTL_ARG_TYPE_GET_MEM, 4, dump_addr, ""), False)
-		res = nexconf.sendNL_IOCTL(ioctl)
+		res = MaMe82_IO.send_ioctl(ioctl)
+		if res == None:
+			if print_res:
+				print "Couldn't dump memory at {0}".format(hex(dump_addr))
+			return None
 		if print_res:
 			print MaMe82_IO.s2hex(res)
 		return res
 	
 	@classmethod
-	def dump_ssid_list_entry(cls, address):
-		headdata = cls.dump_mem(address, sizeof(struct_ssid_list), print_res=False)
+	def dump_ssid_list_entry(cls, address, reader=None):
+		# reads the node from the windows of the given FirmwareMemoryReader, with a separate ioctl otherwise (None if
+		# the memory couldn't be read)
+		if reader == None:
+			headdata = cls.dump_mem(address, sizeof(struct_ssid_list), print_res=False)
+		else:
+			headdata = reader.read(address, sizeof(struct_ssid_list))
+		if headdata == None:
+			return None
 		head = struct_ssid_list()
-		memmove(addressof(head), headdata, len(headdata))
+		memmove(addressof(head), headdata, min(len(headdata), sizeof(struct_ssid_list)))
 		return head
 	
 	@classmethod
-	def dump_ssid_list(cls, address):
-		cur = cls.dump_ssid_list_entry(address)
+	def dump_ssid_list(cls, address, reader=None):
+		# returns None if a node couldn't be read
+		cur = cls.dump_ssid_list_entry(address, reader)
+		if cur == None:
+			return None
 		head = cur
 		p_next = cast(cur.next, c_void_p)
 		while p_next.value != None:
 			#print "p_next {0}".format(hex(p_next.value))
-			next_entry = cls.dump_ssid_list_entry(p_next.value)
+			next_entry = cls.dump_ssid_list_entry(p_next.value, reader)
+			if next_entry == None:
+				return None
 			cur.next = pointer(next_entry) # replace pointer to next element with a one valid in py
 			cur = cur.next.contents # advance cur to next element (dreferenced)
 			p_next = cast(cur.next, c_void_p) # update pointer to next and cast to void*
@@ -610,31 +936,563 @@ class MaMe82_IO:
 
 	@classmethod
 	def set_defaults(cls):
-		cls.add_custom_ssid("linksys")
-		cls.add_custom_ssid("NETGEAR")
-		cls.add_custom_ssid("dlink")
-		cls.add_custom_ssid("AndroidAP")
-		cls.add_custom_ssid("default")
-		cls.add_custom_ssid("cablewifi")
-		cls.add_custom_ssid("asus")
-		cls.add_custom_ssid("Guest")
-		cls.add_custom_ssid("Telekom")
-		cls.add_custom_ssid("xerox")
-		cls.add_custom_ssid("tmobile")
-		cls.add_custom_ssid("Telekom_FON")
-		cls.add_custom_ssid("freifunk")
-
-		cls.set_enable_karma(True) # send probe responses and association responses for foreign SSIDs
-
-		cls.set_enable_karma_beaconing(False) # send beacons for SSIDs seen in probe requests (we better don't enable this by default)
-		cls.set_autoremove_karma_ssids(600) # remove SSIDs from karma beaconing, which didn't received an assoc request after 600 beacons (1 minute)
-
-		cls.set_enable_custom_beaconing(True) # send beacons for the custom SSIDs set with 'add_custom_ssid'
-		cls.set_autoremove_custom_ssids(0) # never remove custom  SSIDs from beaconing list, if they didn't receive an assoc request 
-
-		#cls.dump_conf(print_res=True)
+		# applies KarmaConfig.defaults(), only the settings which differ from the current config are sent
+		current = cls.get_conf()
+		if current == None:
+			current = KarmaConfig() # unknown, send everything
+		KarmaConfig.apply(KarmaConfig.defaults().diff(current))
+		return cls.get_conf()
+
+
+class FirmwareMemoryReader:
+	# Reads firmware memory in windows of window_size bytes (one MAME82_IOCTL_ARG_TYPE_GET_MEM ioctl each), which are
+	# cached by their start address (windows are aligned to window_size and clamped to the valid memory ranges).
+	# Reads covered by cached windows are served locally, thus following a linked list (f.e. struct_ssid_list) costs
+	# one ioctl per window instead of one per node. Reads outside the valid ranges or of windows which couldn't be
+	# fetched completely fall back to a dump_mem() of exactly the requested range.
+	# The cache isn't invalidated automatically, a reader should be used for a single snapshot (or invalidate() called).
+
+	VALID_RANGES = [(0x80, 0x80000), (0x800000, 0x8a0000)] # [start, end) of readable firmware memory
+	WINDOW_SIZE = 1024
+
+	def __init__(self, window_size=WINDOW_SIZE):
+		self.window_size = window_size # multiple of 4, 0 disables windows
+		self.__windows = {} # window start address -> data
+		self.window_reads = 0 # number of window ioctls
+		self.node_reads = 0 # number of fallback ioctls for single reads
+		self.hits = 0 # number of reads served from cached windows
+
+	def invalidate(self):
+		self.__windows.clear()
+
+	def read(self, address, length):
+		data = self.__read_cached(address, length)
+		if data != None:
+			self.hits += 1
+			return data
+		if self.__fetch_windows(address, length):
+			return self.__read_cached(address, length)
+		self.node_reads += 1
+		data = MaMe82_IO.dump_mem(address, max(length, 16), print_res=False)
+		if data == None:
+			return None # no reply
+		return data[:length]
+
+	@staticmethod
+	def __valid_range(address, length):
+		# returns the valid memory range containing [address, address + length), None if there's none
+		for start, end in FirmwareMemoryReader.VALID_RANGES:
+			if start <= address and address + length <= end:
+				return (start, end)
+		return None
+
+	def __read_cached(self, address, length):
+		if self.window_size == 0:
+			return None
+		chunks = []
+		pos = address
+		end = address + length
+		while pos < end:
+			start = pos - pos % self.window_size
+			window = self.__windows.get(start)
+			if window == None:
+				# windows at the start of a memory range begin at the range start (not aligned)
+				for range_start, range_end in FirmwareMemoryReader.VALID_RANGES:
+					if start < range_start <= pos:
+						window = self.__windows.get(range_start)
+						start = range_start
+						break
+			if window == None or pos - start >= len(window):
+				return None
+			chunk = window[pos - start:min(end - start, len(window))]
+			chunks.append(chunk)
+			pos += len(chunk)
+		return "".join(chunks)
+
+	def __fetch_windows(self, address, length):
+		if self.window_size == 0:
+			return False
+		valid = FirmwareMemoryReader.__valid_range(address, length)
+		if valid == None:
+			return False
+		pos = address - address % self.window_size
+		while pos < address + length:
+			start = max(pos, valid[0])
+			end = min(pos + self.window_size, valid[1])
+			if self.__windows.get(start) == None:
+				self.window_reads += 1
+				data = MaMe82_IO.dump_mem(start, end - start, print_res=False)
+				if data == None or len(data) < end - start:
+					return False
+				self.__windows[start] = data[:end - start]
+			pos += self.window_size
+		return True
+
+
+class FirmwareDumper:
+	# Dumps the readable firmware RAM (FirmwareMemoryReader.VALID_RANGES) in chunks of chunk_size bytes into a memory
+	# mapped image file, the file offset of each byte equals its firmware address (the gaps are sparse).
+	#
+	# Up to 'in_flight' GET_MEM requests are pending on the NexmonSession at a time, replies which don't fit into a
+	# single netlink message are reassembled by the session. Progress is recorded in a state file (<image>.state, JSON),
+	# a dump with resume set skips the chunks recorded there. If checksums are enabled, the crc32 of every chunk is
+	# recorded as well and chunks whose content in the image doesn't match their crc are dumped again on resume.
+
+	CHUNK_SIZE = 0x2000
+	STATE_SAVE_INTERVAL = 32 # chunks dumped between saves of the state file
+
+	def __init__(self, chunk_size=CHUNK_SIZE, checksums=False, in_flight=4, session=None):
+		self.chunk_size = chunk_size # multiple of 4
+		self.checksums = checksums
+		self.in_flight = in_flight
+		self.session = session # NexmonSession, MaMe82_IO.get_session() if None
+		self.chunks_dumped = 0
+		self.chunks_skipped = 0 # chunks already dumped (resume)
+		self.bytes_dumped = 0
+
+	def chunks(self):
+		# returns [(address, length)] covering the valid memory ranges
+		chunks = []
+		for start, end in FirmwareMemoryReader.VALID_RANGES:
+			for address in range(start, end, self.chunk_size):
+				chunks.append((address, min(self.chunk_size, end - address)))
+		return chunks
+
+	def dump(self, filename, resume=False):
+		# returns True if all chunks have been dumped
+		session = self.session
+		if session == None:
+			session = MaMe82_IO.get_session()
+		state_filename = filename + ".state"
+		state = self.__load_state(state_filename) if resume else None
+		if state == None:
+			state = {"chunk_size": self.chunk_size, "chunks": {}}
+
+		size = FirmwareMemoryReader.VALID_RANGES[-1][1]
+		mode = "r+b" if resume and os.path.exists(filename) else "w+b"
+		with open(filename, mode) as f:
+			f.truncate(size)
+			image = mmap.mmap(f.fileno(), size)
+			try:
+				todo = [chunk for chunk in self.chunks() if not self.__is_done(state, image, chunk)]
+				self.chunks_skipped = len(self.chunks()) - len(todo)
+				complete = self.__dump_chunks(session, todo, image, state, state_filename)
+				image.flush()
+			finally:
+				image.close()
+		self.__save_state(state_filename, state)
+		return complete
+
+	def __dump_chunks(self, session, todo, image, state, state_filename):
+		pending = deque() # (seq, address, length) in order of submission
+		todo = deque(todo)
+		since_save = 0
+		while len(todo) > 0 or len(pending) > 0:
+			while len(todo) > 0 and len(pending) < self.in_flight:
+				address, length = todo.popleft()
+				buf = struct.pack("III{0}s".format(length - 16), MaMe82_IO.MAME82_IOCTL_ARG_TYPE_GET_MEM, 4, address, "")
+				seq = session.submit(MaMe82_IO.CMD, buf, False)
+				if seq == None:
+					return False
+				pending.append((seq, address, length))
+
+			seq, address, length = pending.popleft()
+			data = session.wait(seq)
+			if data == None or len(data) < length:
+				print "Dumping {0} bytes at {1} failed".format(length, hex(address))
+				for seq, address, length in pending:
+					session.wait(seq, 0) # drop the requests still in flight
+				return False
+			image[address:address + length] = data[:length]
+			state["chunks"][str(address)] = zlib.crc32(data[:length]) & 0xFFFFFFFF if self.checksums else None
+			self.chunks_dumped += 1
+			self.bytes_dumped += length
+			since_save += 1
+			if since_save >= FirmwareDumper.STATE_SAVE_INTERVAL:
+				self.__save_state(state_filename, state)
+				since_save = 0
+		return True
+
+	def __is_done(self, state, image, chunk):
+		address, length = chunk
+		if not str(address) in state["chunks"]:
+			return False
+		crc = state["chunks"][str(address)]
+		if crc != None and zlib.crc32(image[address:address + length]) & 0xFFFFFFFF != crc:
+			print "Checksum mismatch of chunk at {0}, dumping it again".format(hex(address))
+			return False
+		return True
+
+	def __load_state(self, state_filename):
+		try:
+			with open(state_filename) as f:
+				state = json.load(f)
+		except (IOError, ValueError):
+			return None
+		if state.get("chunk_size") != self.chunk_size:
+			print "Chunk size of {0} differs, dumping everything again".format(state_filename)
+			return None
+		return state
+
+	@staticmethod
+	def __save_state(state_filename, state):
+		# replaced atomically, thus an interrupted dump leaves a valid state file
+		with open(state_filename + ".tmp", "w") as f:
+			json.dump(state, f)
+		os.rename(state_filename + ".tmp", state_filename)
+
+
+class KarmaConfig:
+	# Declarative KARMA configuration of the firmware
+	#
+	# A desired state only holds the settings to change (None = leave as is). The custom SSID list is either given
+	# completely (custom_ssids) or by operations (clear / add / remove, in order) on the current list. diff() compares a
+	# desired state with a snapshot of the current config (from_firmware()) and returns the minimal list of set ioctl
+	# argument buffers, apply() sends them back-to-back on a single NexmonSession (set ioctls don't wait for a reply).
+	#
+	# JSON profiles use the field names below, f.e.
+	#	{"karma_probes": true, "karma_assocs": true, "karma_beacons": false, "custom_ssids": ["linksys", "NETGEAR"]}
+	# a profile could use "add_custom_ssids" / "remove_custom_ssids" (lists) instead of "custom_ssids".
+
+	BOOL_FIELDS = [
+		("karma_probes", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_PROBE, "KARMA probe responses"),
+		("karma_assocs", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_ASSOC, "KARMA association responses"),
+		("karma_beacons", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA_BEACON, "KARMA beaconing"),
+		("custom_beacons", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_CUSTOM_BEACONS, "custom SSID beaconing"),
+	]
+	UINT_FIELDS = [
+		("karma_beacon_autoremove", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_KARMA_BEACON_AUTO_REMOVE_COUNT, "KARMA SSID autoremove"),
+		("custom_beacon_autoremove", MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_CUSTOM_BEACON_AUTO_REMOVE_COUNT, "custom SSID autoremove"),
+	]
+	SSID_OP_CLEAR = 0
+	SSID_OP_ADD = 1
+	SSID_OP_REMOVE = 2
+
+	def __init__(self):
+		self.karma_probes = None
+		self.karma_assocs = None
+		self.karma_beacons = None
+		self.custom_beacons = None
+		self.karma_beacon_autoremove = None
+		self.custom_beacon_autoremove = None
+		self.custom_ssids = None # complete list of custom SSIDs, None = current list modified by custom_ssid_ops
+		self.custom_ssid_ops = [] # (SSID_OP_*, ssid) applied in order
+		self.clear_karma_ssids = False
+
+		# read only state of a snapshot
+		self.karma_ssids = None
+		self.debug_out = None
+		self.max_karma_beacon_ssids = None
+		self.max_custom_beacon_ssids = None
+
+	@classmethod
+	def from_dict(cls, values):
+		conf = cls()
+		for name, arg_type, desc in cls.BOOL_FIELDS:
+			if values.get(name) != None:
+				setattr(conf, name, bool(values[name]))
+		for name, arg_type, desc in cls.UINT_FIELDS:
+			if values.get(name) != None:
+				setattr(conf, name, int(values[name]))
+		if values.get("custom_ssids") != None:
+			conf.custom_ssids = [str(ssid) for ssid in values["custom_ssids"]]
+		for ssid in values.get("remove_custom_ssids", []):
+			conf.remove_custom_ssid(str(ssid))
+		for ssid in values.get("add_custom_ssids", []):
+			conf.add_custom_ssid(str(ssid))
+		conf.clear_karma_ssids = bool(values.get("clear_karma_ssids", False))
+		return conf
+
+	@classmethod
+	def from_json(cls, filename):
+		with open(filename) as f:
+			return cls.from_dict(json.load(f))
+
+	def to_dict(self):
+		# settings which aren't None (custom SSID operations are resolved, if the complete list is known)
+		values = {}
+		for name, arg_type, desc in KarmaConfig.BOOL_FIELDS + KarmaConfig.UINT_FIELDS:
+			if getattr(self, name) != None:
+				values[name] = getattr(self, name)
+		if self.custom_ssids != None or (KarmaConfig.SSID_OP_CLEAR, None) in self.custom_ssid_ops:
+			values["custom_ssids"] = self.resolve_custom_ssids([]) # complete list, independent of the current one
+		elif len(self.custom_ssid_ops) > 0:
+			values["add_custom_ssids"] = [ssid for op, ssid in self.custom_ssid_ops if op == KarmaConfig.SSID_OP_ADD]
+			values["remove_custom_ssids"] = [ssid for op, ssid in self.custom_ssid_ops if op == KarmaConfig.SSID_OP_REMOVE]
+		if self.clear_karma_ssids:
+			values["clear_karma_ssids"] = True
+		return values
+
+	def save_json(self, filename):
+		with open(filename, "w") as f:
+			json.dump(self.to_dict(), f, indent=4, sort_keys=True)
+
+	@classmethod
+	def from_firmware(cls):
+		# snapshot of the current firmware config (reads the config and walks both SSID lists), None on error
+		mame82_config = MaMe82_IO.dump_conf(print_res=False, dump_ssids=True)
+		if mame82_config == None:
+			return None
+		return cls.from_mame82_config(mame82_config)
+
+	@classmethod
+	def from_mame82_config(cls, mame82_config):
+		conf = cls()
+		conf.karma_probes = bool(mame82_config.karma_probes)
+		conf.karma_assocs = bool(mame82_config.karma_assocs)
+		conf.karma_beacons = bool(mame82_config.karma_beacons)
+		conf.custom_beacons = bool(mame82_config.custom_beacons)
+		conf.debug_out = bool(mame82_config.debug_out)
+		conf.karma_beacon_autoremove = mame82_config.karma_beacon_autoremove
+		conf.custom_beacon_autoremove = mame82_config.custom_beacon_autoremove
+		conf.max_karma_beacon_ssids = mame82_config.max_karma_beacon_ssids
+		conf.max_custom_beacon_ssids = mame82_config.max_custom_beacon_ssids
+		if cast(mame82_config.ssids_karma, c_void_p).value != None:
+			conf.karma_ssids = MaMe82_IO.ssid_list2str(mame82_config.ssids_karma)
+		if cast(mame82_config.ssids_custom, c_void_p).value != None:
+			conf.custom_ssids = MaMe82_IO.ssid_list2str(mame82_config.ssids_custom)
+		return conf
+
+	def add_custom_ssid(self, ssid):
+		self.custom_ssid_ops.append((KarmaConfig.SSID_OP_ADD, ssid))
+
+	def remove_custom_ssid(self, ssid):
+		self.custom_ssid_ops.append((KarmaConfig.SSID_OP_REMOVE, ssid))
+
+	def clear_custom_ssids(self):
+		self.custom_ssid_ops.append((KarmaConfig.SSID_OP_CLEAR, None))
+
+	def merge(self, other):
+		# settings of other (if not None) override ours, custom SSID operations of other follow ours
+		for name, arg_type, desc in KarmaConfig.BOOL_FIELDS + KarmaConfig.UINT_FIELDS:
+			if getattr(other, name) != None:
+				setattr(self, name, getattr(other, name))
+		if other.custom_ssids != None:
+			self.custom_ssids = list(other.custom_ssids)
+			self.custom_ssid_ops = []
+		self.custom_ssid_ops += other.custom_ssid_ops
+		self.clear_karma_ssids = self.clear_karma_ssids or other.clear_karma_ssids
+
+	def resolve_custom_ssids(self, current):
+		# returns the custom SSID list resulting from our state, given the current list
+		ssids = list(current if self.custom_ssids == None else self.custom_ssids)
+		for op, ssid in self.custom_ssid_ops:
+			if op == KarmaConfig.SSID_OP_CLEAR:
+				ssids = []
+			elif op == KarmaConfig.SSID_OP_ADD:
+				if not ssid in ssids:
+					ssids.append(ssid)
+			elif ssid in ssids:
+				ssids.remove(ssid)
+		return ssids
+
+	def diff(self, current):
+		# type: (KarmaConfig) -> list
+		# returns [(description, ioctl argument buffer)] needed to transfer the snapshot 'current' into our state
+		changes = []
+
+		# custom SSID list first, thus beaconing (enabled below) starts with the final list
+		current_ssids = current.custom_ssids or []
+		ssids = self.resolve_custom_ssids(current_ssids)
+		removed = [ssid for ssid in current_ssids if not ssid in ssids]
+		added = [ssid for ssid in ssids if not ssid in current_ssids]
+		if len(removed) + len(added) > 1 + len(ssids):
+			# rebuilding the list is cheaper
+			removed = []
+			added = ssids
+			changes.append(("Removing all custom SSIDs", MaMe82_IO.arg_empty(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_CUSTOM_SSIDS)))
+		for ssid in removed:
+			changes.append(("Removing custom SSID '{0}'".format(ssid), MaMe82_IO.arg_ssid(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_DEL_CUSTOM_SSID, ssid)))
+		for ssid in added:
+			changes.append(("Adding custom SSID '{0}'".format(ssid), MaMe82_IO.arg_ssid(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_ADD_CUSTOM_SSID, ssid)))
+		if self.clear_karma_ssids:
+			changes.append(("Removing all KARMA SSIDs", MaMe82_IO.arg_empty(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_KARMA_SSIDS)))
+
+		for name, arg_type, desc in KarmaConfig.UINT_FIELDS:
+			value = getattr(self, name)
+			if value != None and value != getattr(current, name):
+				changes.append(("Setting {0} to {1} beacons".format(desc, value), MaMe82_IO.arg_uint(arg_type, value)))
+
+		bools = [(name, arg_type, desc) for name, arg_type, desc in KarmaConfig.BOOL_FIELDS
+			if getattr(self, name) != None and getattr(self, name) != getattr(current, name)]
+		if len(bools) >= 2 and bools[0][0] == "karma_probes" and bools[1][0] == "karma_assocs" and self.karma_probes == self.karma_assocs:
+			# probe and association responses are switched by a single ioctl
+			bools = bools[2:]
+			changes.append(("Setting KARMA probe and association responses to {0}".format("On" if self.karma_probes else "Off"),
+				MaMe82_IO.arg_bool(MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA, self.karma_probes)))
+		for name, arg_type, desc in bools:
+			changes.append(("Setting {0} to {1}".format(desc, "On" if getattr(self, name) else "Off"), MaMe82_IO.arg_bool(arg_type, getattr(self, name))))
+
+		return changes
+
+	@staticmethod
+	def apply(changes, session=None):
+		# sends the argument buffers returned by diff() back-to-back, returns the number of ioctls sent
+		if session == None:
+			session = MaMe82_IO.get_session()
+		count = 0
+		for desc, buf in changes:
+			if session.submit(MaMe82_IO.CMD, buf, True) == None:
+				break
+			if MaMe82_IO.shadow != None:
+				MaMe82_IO.shadow.record(buf)
+			count += 1
+		return count
+
+	def copy(self):
+		conf = KarmaConfig()
+		conf.__dict__.update(self.__dict__)
+		conf.custom_ssid_ops = list(self.custom_ssid_ops)
+		if self.custom_ssids != None:
+			conf.custom_ssids = list(self.custom_ssids)
+		if self.karma_ssids != None:
+			conf.karma_ssids = list(self.karma_ssids)
+		return conf
+
+	def print_conf(self):
+		print "KARMA PROBES - Answer probe requests for foreign SSIDs [{0}]".format("On" if self.karma_probes else "Off")
+		print "KARMA ASSOCS - Answer association requests for foreign SSIDs [{0}]".format("On" if self.karma_assocs else "Off")
+		print "KARMA SSIDs - Broadcast beacons for foreigin SSIDs after probe request [{0}]".format("On" if self.karma_beacons else "Off")
+		print "CUSTOM SSIDs - Broadcast beacons for custom SSIDs (added by user) [{0}]".format("On" if self.custom_beacons else "Off")
+		print "(unused for now) Print debug messages to BCM43430a1 internal console [{0}]".format("On" if self.debug_out else "Off")
+
+		print "\nStop sending more beacons for KARMA SSIDs if no association request is received\nafter [{0}] beacons (0 send forever)".format(self.karma_beacon_autoremove)
+		print "\nStop sending more beacons for CUSTOM SSIDs if no association request is received\nafter [{0}] beacons (0 send forever)".format(self.custom_beacon_autoremove)
+
+		print "\nMaximum allowed KARMA SSIDs for beaconing (no influence on assocs / probes): [{0}]".format(self.max_karma_beacon_ssids)
+		print "Maximum allowed CUSTOM SSIDs: [{0}]".format(self.max_custom_beacon_ssids)
+
+		print ""
+
+		if self.karma_ssids != None:
+			print "Beaconed SSIDs from probes (KARMA SSIDs), right now:\n{0}".format(self.karma_ssids)
+
+		print ""
+
+		if self.custom_ssids != None:
+			print "Beaconed SSIDs defined by user, right now:\n{0}".format(self.custom_ssids)
+
+	@classmethod
+	def defaults(cls):
+		# default configuration (see MaMe82_IO.set_defaults)
+		conf = cls()
+		for ssid in ["linksys", "NETGEAR", "dlink", "AndroidAP", "default", "cablewifi", "asus", "Guest", "Telekom", "xerox", "tmobile", "Telekom_FON", "freifunk"]:
+			conf.add_custom_ssid(ssid)
+		conf.karma_probes = True # send probe responses and association responses for foreign SSIDs
+		conf.karma_assocs = True
+		conf.karma_beacons = False # send beacons for SSIDs seen in probe requests (we better don't enable this by default)
+		conf.karma_beacon_autoremove = 600 # remove SSIDs from karma beaconing, which didn't received an assoc request after 600 beacons (1 minute)
+		conf.custom_beacons = True # send beacons for the custom SSIDs set with 'add_custom_ssid'
+		conf.custom_beacon_autoremove = 0 # never remove custom  SSIDs from beaconing list, if they didn't receive an assoc request
+		return conf
+
+
+class ShadowConfig:
+	# Local copy of the firmware config (KarmaConfig snapshot), which is updated with every set ioctl sent through
+	# MaMe82_IO.set_arg() or KarmaConfig.apply() instead of reading the config and walking the SSID lists again.
+	# get() serves reads from the copy, the firmware is only read again by revalidate() or if the copy is older than
+	# max_age seconds (None = never). The firmware changes the KARMA SSID list (and removes SSIDs without associations)
+	# on its own, thus users of karma_ssids should use an interval.
+
+	def __init__(self, max_age=None):
+		self.max_age = max_age
+		self.__conf = None
+		self.__time = 0
+		self.__lock = threading.RLock()
+		self.reads = 0 # number of get() calls served from the copy
+		self.revalidations = 0 # number of times the config has been read from the firmware
+		self.recorded = 0 # number of set ioctls applied to the copy
+
+		# ioctl arg type -> KarmaConfig field
+		self.__fields = {}
+		for name, arg_type, desc in KarmaConfig.BOOL_FIELDS + KarmaConfig.UINT_FIELDS:
+			self.__fields[arg_type] = name
+
+	def get(self, max_age=None):
+		# returns a copy of the config, None if it couldn't be read from the firmware
+		if max_age == None:
+			max_age = self.max_age
+		with self.__lock:
+			if self.__conf == None or (max_age != None and time.time() - self.__time > max_age):
+				if self.revalidate() == None:
+					return None
+			else:
+				self.reads += 1
+			return self.__conf.copy()
+
+	def revalidate(self):
+		# reads the config from the firmware, returns it (None on error, the copy is kept in this case)
+		conf = KarmaConfig.from_firmware()
+		with self.__lock:
+			self.revalidations += 1
+			if conf == None:
+				return None
+			self.__conf = conf
+			self.__time = time.time()
+			return conf.copy()
+
+	def invalidate(self):
+		with self.__lock:
+			self.__conf = None
+
+	def record(self, buf):
+		# applies the argument buffer of a sent MaMe82_IO.CMD set ioctl to the copy
+		arg_type, arg_len = struct.unpack_from("II", buf)
+		arg = buf[8:8 + arg_len]
+		with self.__lock:
+			conf = self.__conf
+			if conf == None:
+				return # nothing cached, the next get() reads the firmware
+			self.recorded += 1
+			if arg_type == MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SET_ENABLE_KARMA:
+				conf.karma_probes = ord(arg[0]) != 0
+				conf.karma_assocs = conf.karma_probes
+			elif arg_type in self.__fields:
+				name = self.__fields[arg_type]
+				if arg_len == 1:
+					setattr(conf, name, ord(arg[0]) != 0)
+				else:
+					setattr(conf, name, struct.unpack("I", arg)[0])
+			elif arg_type == MaMe82_IO.MAME82_IOCTL_ARG_TYPE_ADD_CUSTOM_SSID:
+				conf.custom_ssids = conf.custom_ssids or []
+				if not arg in conf.custom_ssids:
+					conf.custom_ssids.append(arg)
+			elif arg_type == MaMe82_IO.MAME82_IOCTL_ARG_TYPE_DEL_CUSTOM_SSID:
+				if conf.custom_ssids != None and arg in conf.custom_ssids:
+					conf.custom_ssids.remove(arg)
+			elif arg_type == MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_CUSTOM_SSIDS:
+				conf.custom_ssids = []
+			elif arg_type == MaMe82_IO.MAME82_IOCTL_ARG_TYPE_CLEAR_KARMA_SSIDS:
+				conf.karma_ssids = []
+			else:
+				# unknown effect, read the firmware on next access
+				self.__conf = None
 
 					
+def nl_portid_test():
+	### Opens the persistent session and afterwards further netlink sockets of the process (ProbeRespTX, one-shot ioctl socket) ######
+
+	# each socket has to get a distinct port ID, which is stamped as nlmsg_pid into its messages
+	session = MaMe82_IO.get_session()
+	if not session.open():
+		return False
+	tx = ProbeRespTX()
+	if not tx.open():
+		print "Failed to open ProbeRespTX socket"
+		return False
+	s = nexconf.openNL_sock()
+	if s == None:
+		return False
+	portids = [session.portid, tx.portid, nexconf.nl_portid(s)]
+	s.close()
+	tx.close()
+	print "Port IDs (session, ProbeRespTX, ioctl socket): {0}".format(portids)
+	frame_portid = ProbeRespTX.NLMSG_HDR.unpack_from(tx.get_frame("\xff" * 6, "\x00" * 6))[4]
+	if len(set(portids)) != len(portids) or frame_portid != tx.portid:
+		print "Port IDs clash or aren't stamped into the messages"
+		return False
+	return True
+
 def ioctl_get_test():
 	### Send ioctl comand via netlink: test of GET (cmd 262, value 'bsscfg:ssid' in a buffer large enough to receive the response) ######
 
@@ -653,7 +1511,10 @@ def ioctl_get_test():
 	#		So this is considered experimental, the correct tool to use is nexutil written by the creators of nexmon ;-)
 
 	ioctl_readvar_ssid = nexconf.create_cmd_ioctl(262, struct.pack("36s", "bsscfg:ssid"), False)
-	res = nexconf.sendNL_IOCTL(ioctl_readvar_ssid)
+	res = MaMe82_IO.send_ioctl(ioctl_readvar_ssid)
+	if res == None:
+		print "No response for 'bsscfg:ssid'"
+		return
 
 	# clamp result string
 	res_len = struct.unpack("I", res[:4])[0]
@@ -697,6 +1558,14 @@ def ioctl_get_test():
 #		payload: '\x04\x00\x00\x00\x01\x00\x00\x00\x01'
 #
 #
+# Example to dump the firmware RAM into an image file (file offset = firmware address), resumable and
+# with crc32 per chunk:
+# ------------------------------------------------------------------------------------------------
+#	>>> from mame82_util import *
+#	>>> FirmwareDumper(checksums=True).dump("fw_ram.bin", resume=True)
+#	True
+#
+#
 
 
 ### Example configuration for MaMe82 KARMA nexmon firmware mod ###
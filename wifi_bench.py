@@ -0,0 +1,409 @@
+#!/usr/bin/python
+from __future__ import print_function
+
+# Micro-benchmarks for the hot paths of the WiFi covert channel server (wifi_server.py)
+#
+# Could be run on the target (Pi0w / Pi3) without firmware or netlink access:
+#	python wifi_bench.py
+
+import os
+import sys
+import time
+from wifi_server import *
+
+
+def bench(name, func, duration=1.0):
+	# calls func repeatedly for roughly 'duration' seconds and prints calls per second
+	count = 0
+	batch = 100
+	start = time.time()
+	elapsed = 0
+	while elapsed < duration:
+		for i in range(batch):
+			func()
+		count += batch
+		elapsed = time.time() - start
+	rate = count / elapsed
+	print("{0:<50} {1:>12.0f} /s".format(name, rate))
+	return rate
+
+
+##### Reference implementation of the legacy string based codec (before struct.Struct / bytearray) #####
+
+def legacy_checksum8(input, len_to_include=-1):
+	sum = 0
+	if len_to_include == -1:
+		len_to_include = len(input)
+
+	for off in range(len_to_include):
+		sum += ord(input[off])
+		sum &= 0xFF
+
+	sum = ~sum
+
+	return sum & 0xFF
+
+def legacy_generateRawSsid(p, with_TL=True):
+	payload = p.pay1[:Packet.PAY1_MAX_LEN]
+	if p.FlagControlMessage:
+		payload = chr(p.ctlm_type) + p.pay1[1:Packet.PAY1_MAX_LEN]
+	pay_len = len(payload)
+	out = payload + (Packet.PAY1_MAX_LEN - pay_len) * "\x00"
+	out += chr(p.ack)
+	out += chr(p.seq)
+	flag_len = pay_len
+	if p.FlagControlMessage:
+		flag_len += 0x80
+	out += chr(flag_len)
+	clientID_srvID = (p.clientID << 4) | (p.srvID & 0x0F)
+	out += chr(clientID_srvID)
+	chk = legacy_checksum8(out)
+	out += chr(chk)
+	if with_TL:
+		out = "\x00\x20" + out
+	return out
+
+def legacy_generateRawVenIe(p, with_TL=True):
+	if p.pay2 == None:
+		return None
+	payload = p.pay2[:236]
+	pay_len = len(payload)
+	out = payload + (236 - pay_len) * "\x00"
+	out += chr(len(payload))
+	chk = legacy_checksum8(out)
+	out += chr(chk)
+	if with_TL:
+		out = "\xDD\xEE" + out
+	return out
+
+def legacy_checkLengthChecksum(raw_ssid_data, raw_ven_ie_data=None):
+	if len(raw_ssid_data) != 32:
+		return False
+	if ord(raw_ssid_data[31]) != legacy_checksum8(raw_ssid_data, 31):
+		return False
+	if raw_ven_ie_data != None:
+		if len(raw_ven_ie_data) != 238:
+			return False
+		if ord(raw_ven_ie_data[237]) != legacy_checksum8(raw_ven_ie_data, 237):
+			return False
+	return True
+
+def legacy_parse2packet(sa, da, raw_ssid_data, raw_ven_ie_data=None):
+	packet = Packet()
+	packet.sa = sa
+	packet.da = da
+	if raw_ven_ie_data != None:
+		pay2_len = ord(raw_ven_ie_data[236])
+		packet.pay2 = raw_ven_ie_data[:pay2_len]
+	packet.ack = ord(raw_ssid_data[27])
+	packet.seq = ord(raw_ssid_data[28])
+	flag_len = ord(raw_ssid_data[29])
+	packet.FlagControlMessage = (flag_len & 0x80) != 0
+	if packet.FlagControlMessage:
+		packet.ctlm_type = ord(raw_ssid_data[0])
+	pay1_len = flag_len & 0x1F
+	packet.pay1 = raw_ssid_data[:pay1_len]
+	clientID_srvID = ord(raw_ssid_data[30])
+	packet.clientID = clientID_srvID >> 4
+	packet.srvID = clientID_srvID & 0x0F
+	return packet
+
+
+def sample_packet():
+	p = Packet()
+	p.sa = "\xde\xad\xbe\xef\x13\x37"
+	p.da = "\x11\x22\x33\x44\x55\x66"
+	p.pay1 = "A" * Packet.PAY1_MAX_LEN
+	p.pay2 = "B" * Packet.PAY2_MAX_LEN
+	p.seq = 23
+	p.ack = 42
+	p.clientID = 3
+	p.srvID = 9
+	return p
+
+def bench_codec(duration):
+	print("Packet codec (frames/s, SSID IE + vendor IE)")
+	print("--------------------------------------------")
+
+	p = sample_packet()
+	raw_ssid = p.generateRawSsid(False)
+	raw_ven_ie = p.generateRawVenIe(False)
+
+	# both implementations have to produce identical frames
+	assert raw_ssid == legacy_generateRawSsid(p, False)
+	assert raw_ven_ie == legacy_generateRawVenIe(p, False)
+	assert Packet.checkLengthChecksum(raw_ssid, raw_ven_ie)
+
+	def tx_old():
+		legacy_generateRawSsid(p, False)
+		legacy_generateRawVenIe(p, False)
+	def tx_new():
+		p.generateRawSsid(False)
+		p.generateRawVenIe(False)
+	def rx_old():
+		if legacy_checkLengthChecksum(raw_ssid, raw_ven_ie):
+			legacy_parse2packet(p.sa, p.da, raw_ssid, raw_ven_ie)
+	def rx_new():
+		if Packet.checkLengthChecksum(raw_ssid, raw_ven_ie):
+			Packet.release(Packet.parse2packet(p.sa, p.da, raw_ssid, raw_ven_ie))
+
+	old = bench("TX encode (before)", tx_old, duration)
+	new = bench("TX encode (after)", tx_new, duration)
+	print("{0:<50} {1:>12.2f} x".format("TX speedup", new / old))
+	old = bench("RX validate + parse (before)", rx_old, duration)
+	new = bench("RX validate + parse (after)", rx_new, duration)
+	print("{0:<50} {1:>12.2f} x".format("RX speedup", new / old))
+	print("")
+
+def bench_batch_validation(duration, burst=32):
+	print("Burst validation (frames/s, bursts of {0} probe requests)".format(burst))
+	print("--------------------------------------------------------")
+	if numpy == None:
+		print("NumPy not installed, skipped\n")
+		return
+
+	p = sample_packet()
+	raw_ssids = [p.generateRawSsid(False)] * burst
+	raw_ven_ies = [p.generateRawVenIe(False)] * burst
+
+	def single():
+		for i in range(burst):
+			Packet.checkLengthChecksum(raw_ssids[i], raw_ven_ies[i])
+	def batch():
+		Packet.checkLengthChecksumBatch(raw_ssids, raw_ven_ies)
+
+	old = bench("per frame checkLengthChecksum", single, duration) * burst
+	new = bench("checkLengthChecksumBatch", batch, duration) * burst
+	print("{0:<50} {1:>12.0f} /s".format("frames per frame", old))
+	print("{0:<50} {1:>12.0f} /s".format("frames batched", new))
+	print("{0:<50} {1:>12.2f} x".format("speedup", new / old))
+	print("")
+
+##### Reference implementation of the legacy probe response TX path (before ProbeRespTX) #####
+
+def legacy_send_probe_resp_to_driver(sa, da, ie_ssid_data, ie_vendor_data, nl_socket_fd):
+	arr_bssid = mac2bstr(sa)
+	arr_da = mac2bstr(da)
+	insert = "\x01\x08\x82\x84\x8b\x96\x12\x24\x48\x6c"
+	insert += "\x03\x01\x0b"
+	insert += "\x7f\x08\x00\x00\x00\x00\x00\x00\x00\x40"
+	len_insert = len(insert)
+	if ie_vendor_data == None:
+		buf = struct.pack("<II6s6sBB32s{0}s".format(len_insert), MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP,
+			48 + len_insert, arr_da, arr_bssid, 0, 32, ie_ssid_data, insert)
+	else:
+		buf = struct.pack("<II6s6sBB32s{0}sBB238s".format(len_insert), MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP,
+			286 + len_insert, arr_da, arr_bssid, 0, 32, ie_ssid_data, insert, 221, 238, ie_vendor_data)
+	ioctl_sendprbrsp = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, buf, True)
+	nexconf.sendNL_IOCTL(ioctl_sendprbrsp, nl_socket_fd=nl_socket_fd)
+
+
+class NullSink:
+	# stands in for the netlink socket (send) and its file object (write), keeps the last written message
+	def __init__(self):
+		self.last = None
+	def send(self, data):
+		self.last = bytes(data)
+		return len(data)
+	def write(self, data):
+		self.last = bytes(data)
+	def flush(self):
+		pass
+
+def bench_probe_resp_tx(duration):
+	print("Probe response TX (probe responses/s, without driver)")
+	print("-----------------------------------------------------")
+
+	p = sample_packet()
+	sink_old = NullSink()
+	sink_new = NullSink()
+	tx = ProbeRespTX(ServerSocket.PROBE_RESP_EXTRA_IES, sink_new)
+
+	# the legacy path used colon separated MAC strings
+	sa_str = Helper.s2mac(p.sa)
+	da_str = Helper.s2mac(p.da)
+
+	def tx_old():
+		legacy_send_probe_resp_to_driver(sa_str, da_str, p.generateRawSsid(False), p.generateRawVenIe(False), sink_old)
+	def tx_new():
+		frame = tx.get_frame(p.da, p.sa, 1) # one vendor IE
+		p.packRawSsidInto(frame, ProbeRespTX.SSID_DATA_OFFSET, False)
+		p.packRawVenIeInto(frame, tx.ven_ie_data_offset, False)
+		tx.send_frame(frame)
+
+	# both paths have to hand identical netlink messages to the driver
+	legacy_send_probe_resp_to_driver(Helper.s2mac(p.sa), Helper.s2mac(p.da), p.generateRawSsid(False), None, sink_old)
+	tx.send(p.da, p.sa, p.generateRawSsid(False))
+	assert sink_old.last == sink_new.last
+	tx_old()
+	tx_new()
+	assert sink_old.last == sink_new.last
+
+	old = bench("legacy struct.pack + ctypes + sendNL_IOCTL", tx_old, duration)
+	new = bench("ProbeRespTX prebuilt frame", tx_new, duration)
+	print("{0:<50} {1:>12.2f} x".format("speedup", new / old))
+
+	# retransmission of an unchanged response (ServerSocket caches the serialized frame on the packet)
+	srv = ServerSocket()
+	srv._ServerSocket__probe_resp_tx = tx
+	p.wire_frame = None
+	srv.sendResponse(p)
+	first = sink_new.last
+	def retransmit():
+		srv.sendResponse(p)
+	retx = bench("ServerSocket.sendResponse retransmit (cached)", retransmit, duration)
+	assert sink_new.last == first
+	print("{0:<50} {1:>12.2f} x".format("retransmit speedup", retx / old))
+	print("")
+
+##### Reference implementation of the legacy accept() loop (before ConnectionQueue.acceptPendingConnection) #####
+
+def legacy_accept(q, event, stop, wakeups):
+	# ServerSocket.accept() with the former ConnectionQueue.waitForPendingAcceptStateChange(), which set the event it
+	# waited for inside its own loop
+	while not stop.isSet():
+		cons_pa = q.getConnectionListByState(ClientSocket.STATE_PENDING_ACCEPT)
+		if len(cons_pa) == 0:
+			while not event.isSet():
+				event.set()
+			event.clear()
+			wakeups[0] += 1
+			continue
+		return cons_pa[0]
+
+def cpu_time():
+	t = os.times()
+	return t[0] + t[1]
+
+def measure_idle(name, start, stop, wakeups, duration):
+	# runs an idle accept() thread for 'duration' seconds and prints the CPU time used and its wakeups per second
+	t0 = time.time()
+	c0 = cpu_time()
+	thread = Thread(target=start)
+	thread.start()
+	time.sleep(duration)
+	stop()
+	thread.join()
+	elapsed = time.time() - t0
+	cpu = cpu_time() - c0
+	print("{0:<50} {1:>10.1f} % CPU {2:>12.0f} wakeups/s".format(name, 100.0 * cpu / elapsed, wakeups() / elapsed))
+
+def bench_idle_accept(duration):
+	print("Idle accept() (no connection attempts)")
+	print("--------------------------------------")
+
+	q = ConnectionQueue(15)
+	event = Event()
+	stop = Event()
+	wakeups = [0]
+	measure_idle("legacy accept (spinning wait)", lambda: legacy_accept(q, event, stop, wakeups), stop.set,
+		lambda: wakeups[0], duration)
+
+	q = ConnectionQueue(15)
+	measure_idle("ConnectionQueue.acceptPendingConnection", q.acceptPendingConnection, q.close,
+		lambda: q.accept_wakeups, duration)
+
+	loop = EventLoop()
+	measure_idle("EventLoop.run", loop.run, loop.stop, lambda: loop.iterations, duration)
+	loop.close()
+	print("")
+
+
+##### Reference implementation of the legacy netlink RX path (before zero-copy drain) #####
+
+def legacy_parse_ies(s):
+	res = {}
+	if len(s) < 2:
+		return res
+	pos = 0
+	while pos < (len(s)-2):
+		t = ord(s[pos])
+		pos+=1
+		l = ord(s[pos])
+		pos+=1
+		v = s[pos:pos+l]
+		pos += l
+		if t in res:
+			res[t].append(v)
+		else:
+			res[t] = [v]
+	return res
+
+def legacy_parse_firmware_event(data):
+	data = data[16:]
+	if data[0] != "\x40":
+		return None
+	f80211_da = data[4:10]
+	f80211_sa = data[10:16]
+	f80211_parameters = data[24:][:-2]
+	ies = legacy_parse_ies(f80211_parameters)
+	if not 0 in ies:
+		return None
+	ssid = ies[0][0]
+	ven_ie = None
+	if 221 in ies:
+		ven_ies = [v for v in ies[221] if len(v) == Packet.RAW_VEN_IE_LEN]
+		if len(ven_ies) == 1:
+			ven_ie = ven_ies[0]
+		elif len(ven_ies) > 1:
+			ven_ie = ven_ies[:Packet.MAX_VEN_IES]
+	return (f80211_sa, f80211_da, ssid, ven_ie)
+
+def sample_firmware_event():
+	# netlink message as sent by the firmware for a probe request (nlmsghdr, 802.11 header, IEs, padding)
+	p = sample_packet()
+	ies = "\x00\x20" + p.generateRawSsid(False) + "\x01\x04\x02\x04\x0b\x16" + "\xdd" + chr(Packet.RAW_VEN_IE_LEN) + p.generateRawVenIe(False)
+	return "\x00" * 16 + "\x40\x00\x00\x00" + p.da + p.sa + p.da + "\x00\x00" + ies + "\x00\x00"
+
+def bench_netlink_rx(duration, burst=32):
+	print("Netlink RX (probe requests/s, bursts of {0} firmware events)".format(burst))
+	print("------------------------------------------------------------")
+	import socket
+	from select import select
+	event = sample_firmware_event()
+	reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+	def legacy():
+		# one select() and one recvfrom() allocating a new string per message
+		for i in range(burst):
+			writer.send(event)
+		for i in range(burst):
+			select([reader], [], [], 0.5)
+			legacy_parse_firmware_event(reader.recvfrom(0xFFFF)[0])
+
+	demux = FirmwareEventDemux()
+	parse = demux._FirmwareEventDemux__parse_firmware_event
+	buf = bytearray(FirmwareEventDemux.RX_BUF_SIZE)
+	view = memoryview(buf)
+	def zero_copy():
+		# one select(), then recv_into() the same buffer till EAGAIN
+		for i in range(burst):
+			writer.send(event)
+		select([reader], [], [], 0.5)
+		while True:
+			try:
+				length = reader.recv_into(buf, 0, socket.MSG_DONTWAIT)
+			except socket.error:
+				break
+			parse(buf, view, length)
+
+	assert legacy_parse_firmware_event(event) == parse(bytearray(event), memoryview(bytearray(event)), len(event))
+	old = bench("select + recvfrom per message, sliced strings", legacy, duration) * burst
+	new = bench("recv_into drain, memoryview", zero_copy, duration) * burst
+	print("{0:<50} {1:>12.0f} /s".format("legacy frames", old))
+	print("{0:<50} {1:>12.0f} /s".format("zero-copy frames", new))
+	print("{0:<50} {1:>12.2f} x".format("speedup", new / old))
+	reader.close()
+	writer.close()
+	print("")
+
+
+if __name__ == "__main__":
+	duration = 1.0
+	if len(sys.argv) > 1:
+		duration = float(sys.argv[1])
+	bench_codec(duration)
+	bench_batch_validation(duration)
+	bench_probe_resp_tx(duration)
+	bench_idle_accept(duration)
+	bench_netlink_rx(duration)
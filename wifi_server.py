@@ -7,12 +7,22 @@ import sys
 import time
 import socket
 import os
+import struct
+import zlib
+import heapq
 import Queue
+from collections import OrderedDict, deque
 from enum import Enum
-from threading import Thread, Event
+import threading
+from threading import Thread, Event, Condition, RLock
 from select import select
 from mame82_util import *
 
+try:
+	import numpy
+except ImportError:
+	numpy = None # batched validation of probe request bursts (FirmwareEventDemux.batch_rx) isn't available
+
 NETLINK_USERSOCK = 2
 NETLINK_ADD_MEMBERSHIP = 1
 SOL_NETLINK = 270
@@ -31,6 +41,26 @@ class Helper:
 		#return "".join(map("0x%2.2x ".__mod__, map(ord, s)))
 		return "".join(map("%2.2x".__mod__, map(ord, s)))
 
+	@staticmethod
+	def waitCondition(cond, deadline=None):
+		# type: (Condition, float) -> bool
+		# waits (lock of cond held) until cond is notified or the deadline (time.time() based, None = forever) has been
+		# reached, returns False if the deadline has passed. Callers re-check their predicate after every return.
+		# On Python 2 Condition.wait() with timeout polls its lock (sleeping up to 50 ms in between), while the untimed
+		# variant isn't interruptible by KeyboardInterrupt. As only the main thread receives KeyboardInterrupt, other
+		# threads block without timeout and the main thread wakes up once per second.
+		if deadline == None:
+			if isinstance(threading.current_thread(), threading._MainThread):
+				cond.wait(1.0)
+			else:
+				cond.wait()
+			return True
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			return False
+		cond.wait(remaining)
+		return True
+
 	@staticmethod
 	def s2mac(s):
 		s = Helper.s2hex(s)
@@ -42,7 +72,7 @@ class Helper:
 		return res
 
 
-class Packet:
+class Packet(object):
 	CTLM_TYPE_CON_INIT_REQ1 = 1
 	CTLM_TYPE_CON_INIT_RSP1 = 2
 	CTLM_TYPE_CON_INIT_REQ2 = 3
@@ -56,9 +86,34 @@ class Packet:
 	CON_RESET_REASON_UNSPECIFIED = 0
 	CON_RESET_REASON_INVALID_CLIENT_ID = 1 
 
+	# Capability byte (pay1[5] of CON_INIT_REQ1, CON_INIT_RSP1, CON_INIT_REQ2 and CON_INIT_RSP2)
+	#
+	# bits 0..1: vendor IE state (RSP1: 1 = no vendor IE received from client, 2 = vendor IE received
+	#            REQ2: 1 = client didn't receive the vendor IE of RSP1, 2 = client received it)
+	# bit 2, bits 4..7: optional capabilities. Legacy clients send REQ1 without capability byte, in this case
+	#            RSP1 carries only the vendor IE state. Otherwise RSP1 offers the subset of the capabilities
+	#            advertised by the client, which are supported by the server. REQ2 accepts a subset of
+	#            the offered ones and RSP2 confirms them (RSP2 carries no capability byte if none are in use).
+	CAP_VEN_IE_MASK = 0x03
+	CAP_EXT_ADDR = 0x04 # extended addressing (8 bit clientID, up to 255 clients), see 'Extended addressing' below. As RSP1
+						# already hands out the clientID, the mode is in use as soon as it is offered in RSP1
+	CAP_COMPRESSION = 0x10 # payload stream is compressed (raw deflate, sync flush per send())
+	CAP_COMPRESSION_DICT = 0x20 # compression uses the preset dictionary ClientSocket.COMPRESSION_DICT
+	CAP_MULTI_VEN_IE = 0x40 # responses carry pay2 in multiple vendor IEs, RSP1 is sent with MAX_VEN_IES vendor IEs,
+							# REQ2 pay1[6] holds the number of vendor IEs the client received
+	CAP_WINDOW = 0x80 # sliding window instead of PingPong, REQ2 pay1[7] holds the requested window size
+	#
+	# If capabilities are accepted, RSP2 confirms them with pay1[5] = accepted capabilities, pay1[6] = vendor IEs per
+	# response, pay1[7] = granted window size (0 = PingPong). REQ2 has to carry pay1[6] if it wants to set pay1[7].
+
 	PAY1_MAX_LEN = 27
+	EXT_PAY1_MAX_LEN = 26 # SSID payload of frames with extended addressing
 	PAY2_MAX_LEN = 236
 
+	FLAG_CTLM = 0x80 # flag_len: FlagControlMessage
+	FLAG_EXT_ADDR = 0x40 # flag_len: extended addressing
+	FLAG_LEN_MASK = 0x1F # flag_len: len_pay1
+
 	# Data encoding
 	#
 	# SSID - 32 BYTES (pay1)
@@ -67,20 +122,57 @@ class Packet:
 	# byte 1..26: pay1[0..27]
 	# byte 27 ack
 	# byte 28 seq
-	# byte 29 flag_len bits: 0 = FlagControlMessage, 1 = reserved, 2 = reserved, 3-7 = len_pay1
+	# byte 29 flag_len bits: 0 = FlagControlMessage, 1 = extended addressing, 2 = reserved, 3-7 = len_pay1
 	# byte 30 clientID_srvID bits: 0..3 = clientID, 4..7 = srvID
 	# byte 31 chk_pay1: 8 bit checksum
 	#
+	# Extended addressing (flag_len bit 1 set, negotiated with CAP_EXT_ADDR)
+	# ----------------------------------------------------------------------
+	# byte 0..25: pay1 (max 26 bytes)
+	# byte 26: srvID
+	# byte 30: clientID (8 bit)
+	# all other bytes as above
+	#
 	# Vendor Specific IE - 238 BYTES (pay2), could be missing
 	# -----------------------------------------------------
 	#
 	# byte 0..235 pay2
-	# byte 236 len_pay2: 
+	# byte 236 len_pay2:
 	# byte 237 chk_pay2: 8 bit checksum
+	#
+	# Extended frames (negotiated with CAP_MULTI_VEN_IE) carry pay2 in up to MAX_VEN_IES vendor IEs of the layout
+	# above, each holding the next 236 byte slice of pay2. The receiver concatenates them in order of appearance.
+
+	RAW_SSID_LEN = 32
+	RAW_VEN_IE_LEN = 238
+	MAX_VEN_IES = 4
+
+	# precompiled layouts for the encoding above (the trailing checksum byte is filled in after packing)
+	RAW_SSID = struct.Struct("<27sBBBB") # pay1, ack, seq, flag_len, clientID_srvID
+	RAW_SSID_TL = struct.Struct("<BB27sBBBB") # IE type + IE len, followed by RAW_SSID
+	RAW_VEN_IE = struct.Struct("<236sB") # pay2, len_pay2
+	RAW_VEN_IE_TL = struct.Struct("<BB236sB") # IE type + IE len, followed by RAW_VEN_IE
+	SSID_TRAILER = struct.Struct("<BBBB") # ack, seq, flag_len, clientID_srvID (at offset PAY1_MAX_LEN)
+	VEN_IE_TRAILER = struct.Struct("<B") # len_pay2 (at offset PAY2_MAX_LEN)
+
+	# reusable scratch buffers for generateRawSsid / generateRawVenIe
+	__raw_ssid_buf = bytearray(2 + RAW_SSID_LEN)
+	__raw_ven_ie_buf = bytearray((2 + RAW_VEN_IE_LEN) * MAX_VEN_IES)
+
+	# fixed attribute layout, no per instance __dict__
+	__slots__ = ("sa", "da", "clientID", "srvID", "pay1", "pay2", "seq", "ack", "FlagControlMessage", "ctlm_type", "ven_ie_count",
+		"ext_addr", "wire_frame", "wire_key")
+
+	# bounded freelist of packets, used to recycle the packets created for inbound probe requests
+	POOL_SIZE = 64
+	__pool = []
 
 	def __init__(self):
-		self.sa = "" # 80211 SA
-		self.da = "" # 80211 DA
+		self.reset()
+
+	def reset(self):
+		self.sa = "" # 80211 SA (6 byte binary)
+		self.da = "" # 80211 DA (6 byte binary)
 		self.clientID = 0 # logical source (as we use scanning, on some devices the 802.11 SA could change and isn't reliable)
 		self.srvID = 0 # logical destination
 		self.pay1 =  "" # encoded in SSID
@@ -89,6 +181,42 @@ class Packet:
 		self.ack = 0
 		self.FlagControlMessage = False # If set, the payload contains a control message, pay1[0] is control message type
 		self.ctlm_type = 0
+		self.ven_ie_count = 1 # number of vendor IEs used to carry pay2 (> 1 only for extended frames)
+		self.ext_addr = False # encode with extended addressing (8 bit clientID)
+		self.wire_frame = None # serialized netlink message of the last transmission of this packet (see wireKey)
+		self.wire_key = None # wireKey() of the packet, when wire_frame was built
+
+	@staticmethod
+	def acquire():
+		# type: () -> Packet
+		# returns a recycled packet from the freelist (or a new one if the freelist is empty)
+		try:
+			return Packet.__pool.pop()
+		except IndexError:
+			return Packet()
+
+	@staticmethod
+	def release(packet):
+		# type: (Packet) -> None
+		# hands a packet back to the freelist, the caller mustn't keep references to it
+		if len(Packet.__pool) < Packet.POOL_SIZE:
+			packet.reset()
+			Packet.__pool.append(packet)
+
+	def copy(self, dst=None):
+		# type: (Packet) -> Packet
+		# copies all fields into dst (a new packet, if dst isn't given) and returns it
+		if dst == None:
+			dst = Packet()
+		for name in Packet.__slots__:
+			setattr(dst, name, getattr(self, name))
+		return dst
+
+	def wireKey(self, tx):
+		# returns everything the serialized probe response of this packet depends on, wire_frame is only valid as long
+		# as this key doesn't change (f.e. seq, ack or payload of a ClientSocket's tx_packet are updated)
+		return (tx, self.sa, self.da, self.pay1, self.pay2, self.seq, self.ack, self.FlagControlMessage, self.ctlm_type,
+			self.clientID, self.srvID, self.ven_ie_count, self.ext_addr)
 
 	@staticmethod
 	def generateResetPacket(req, srvID, resetReason, seq=-1):
@@ -106,108 +234,201 @@ class Packet:
 		resp.srvID = srvID
 		resp.ack = req.seq
 		resp.clientID =	req.clientID
+		resp.ext_addr = req.ext_addr
 		return resp
 
 	@staticmethod
 	def parse2packet(sa, da, raw_ssid_data, raw_ven_ie_data=None):
-		packet = Packet()
+		ack, seq, flag_len, clientID_srvID = Packet.SSID_TRAILER.unpack_from(raw_ssid_data, Packet.PAY1_MAX_LEN)
+		return Packet.fields2packet(sa, da, raw_ssid_data, raw_ven_ie_data, ack, seq, flag_len, clientID_srvID)
+
+	@staticmethod
+	def fields2packet(sa, da, raw_ssid_data, raw_ven_ie_data, ack, seq, flag_len, clientID_srvID):
+		# creates a packet from already decoded SSID trailer fields (see checkLengthChecksumBatch)
+		# raw_ven_ie_data is a single vendor IE or a list of vendor IEs
+		packet = Packet.acquire()
 
 		packet.sa = sa
 		packet.da = da
 
 		if raw_ven_ie_data != None:
-			pay2_len = ord(raw_ven_ie_data[236])
-			packet.pay2 = raw_ven_ie_data[:pay2_len]
+			if isinstance(raw_ven_ie_data, list):
+				pay2 = []
+				for raw_ven_ie in raw_ven_ie_data:
+					pay2_len = Packet.VEN_IE_TRAILER.unpack_from(raw_ven_ie, Packet.PAY2_MAX_LEN)[0]
+					pay2.append(raw_ven_ie[:pay2_len])
+				packet.pay2 = "".join(pay2)
+				packet.ven_ie_count = len(raw_ven_ie_data)
+			else:
+				pay2_len = Packet.VEN_IE_TRAILER.unpack_from(raw_ven_ie_data, Packet.PAY2_MAX_LEN)[0]
+				packet.pay2 = raw_ven_ie_data[:pay2_len]
 
-		packet.ack = ord(raw_ssid_data[27])
-		packet.seq = ord(raw_ssid_data[28])
+		packet.ack = ack
+		packet.seq = seq
 
-		flag_len = ord(raw_ssid_data[29])
-		packet.FlagControlMessage = (flag_len & 0x80) != 0
+		packet.FlagControlMessage = (flag_len & Packet.FLAG_CTLM) != 0
 		if packet.FlagControlMessage:
 			packet.ctlm_type = ord(raw_ssid_data[0])
-		pay1_len = flag_len & 0x1F
-		packet.pay1 = raw_ssid_data[:pay1_len]
+		pay1_len = flag_len & Packet.FLAG_LEN_MASK
 
-		clientID_srvID = ord(raw_ssid_data[30])
-		packet.clientID = clientID_srvID >> 4
-		packet.srvID = clientID_srvID & 0x0F
+		if flag_len & Packet.FLAG_EXT_ADDR:
+			packet.ext_addr = True
+			packet.pay1 = raw_ssid_data[:min(pay1_len, Packet.EXT_PAY1_MAX_LEN)]
+			packet.clientID = clientID_srvID
+			packet.srvID = ord(raw_ssid_data[Packet.EXT_PAY1_MAX_LEN])
+		else:
+			packet.pay1 = raw_ssid_data[:pay1_len]
+			packet.clientID = clientID_srvID >> 4
+			packet.srvID = clientID_srvID & 0x0F
 
 		return packet
 
-	def generateRawSsid(self, with_TL=True):
-		payload = self.pay1[:Packet.PAY1_MAX_LEN] # truncate, ToDo: warn if payload too large
+	def packRawSsidInto(self, buf, offset=0, with_TL=True):
+		# packs the SSID block into the given (preallocated) bytearray, returns number of bytes written
+		pay1_max = Packet.PAY1_MAX_LEN
+		if self.ext_addr:
+			pay1_max = Packet.EXT_PAY1_MAX_LEN
+		payload = self.pay1[:pay1_max] # truncate, ToDo: warn if payload too large
 		if self.FlagControlMessage:
-			payload = chr(self.ctlm_type) + self.pay1[1:Packet.PAY1_MAX_LEN]
-		pay_len = len(payload)
-		out = payload + (Packet.PAY1_MAX_LEN - pay_len) * "\x00" # pad with zeroes
-
-		# ack_seq
-		#ack_seq = (self.ack << 4) | (self.seq & 0x0F)
-		#out += chr(ack_seq)
-		out += chr(self.ack)
-		out += chr(self.seq)
+			payload = chr(self.ctlm_type) + self.pay1[1:pay1_max]
 
 		# flag_len
-		flag_len = pay_len
+		flag_len = len(payload)
 		if self.FlagControlMessage:
-			flag_len += 0x80
-		out += chr(flag_len)
-
+			flag_len += Packet.FLAG_CTLM
 
 		# clientID_srvID
-		clientID_srvID = (self.clientID << 4) | (self.srvID & 0x0F)
-		out += chr(clientID_srvID)
+		if self.ext_addr:
+			flag_len += Packet.FLAG_EXT_ADDR
+			clientID_srvID = self.clientID & 0xFF
+			payload = payload + (Packet.EXT_PAY1_MAX_LEN - len(payload)) * "\x00" + chr(self.srvID & 0xFF)
+		else:
+			clientID_srvID = (self.clientID << 4) | (self.srvID & 0x0F)
+
+		if with_TL:
+			Packet.RAW_SSID_TL.pack_into(buf, offset, 0, Packet.RAW_SSID_LEN, payload, self.ack, self.seq, flag_len, clientID_srvID)
+			offset += 2
+		else:
+			Packet.RAW_SSID.pack_into(buf, offset, payload, self.ack, self.seq, flag_len, clientID_srvID) # payload is padded with zeroes by struct
 
 		# chksum
-		chk = Packet.simpleChecksum8(out)
-		out += chr(chk)
+		buf[offset + Packet.RAW_SSID_LEN - 1] = Packet.simpleChecksum8(buf, Packet.RAW_SSID_LEN - 1, offset)
 
-		if with_TL:
-			out = "\x00\x20" + out
-		return out
+		return offset + Packet.RAW_SSID_LEN
 
-	def generateRawVenIe(self, with_TL=True):
+	def packRawVenIeInto(self, buf, offset=0, with_TL=True, index=0):
+		# packs vendor IE number 'index' (carrying pay2[index*236:(index+1)*236]) into the given (preallocated)
+		# bytearray, returns the end offset of the written data (0 if there's no pay2)
 		if self.pay2 == None:
-			return None
+			return 0
 
-		payload = self.pay2[:236] # truncate, ToDo: warn if payload too large
-		pay_len = len(payload)
-		out = payload + (236 - pay_len) * "\x00" # pad with zeroes
+		payload = self.pay2[index * Packet.PAY2_MAX_LEN:(index + 1) * Packet.PAY2_MAX_LEN] # ToDo: warn if payload too large
 
-		# build len_id octet
-		length = len(payload)
-		out += chr(length)
+		if with_TL:
+			# add vendor IE type 221 and length 238
+			Packet.RAW_VEN_IE_TL.pack_into(buf, offset, 221, Packet.RAW_VEN_IE_LEN, payload, len(payload))
+			offset += 2
+		else:
+			Packet.RAW_VEN_IE.pack_into(buf, offset, payload, len(payload)) # payload is padded with zeroes by struct
 
 		# calculate checksum
-		chk = Packet.simpleChecksum8(out)
-		out += chr(chk)
+		buf[offset + Packet.RAW_VEN_IE_LEN - 1] = Packet.simpleChecksum8(buf, Packet.RAW_VEN_IE_LEN - 1, offset)
 
-		if with_TL:
-			# add SSID type and length
-			out = "\xDD\xEE" + out # type 221, length 238
+		return offset + Packet.RAW_VEN_IE_LEN
 
-		return out
+	def generateRawSsid(self, with_TL=True):
+		# Note: the scratch buffer is shared, which is fine as long as responses are only generated by the firmware event thread
+		buf = Packet.__raw_ssid_buf
+		end = self.packRawSsidInto(buf, 0, with_TL)
+		return bytes(buf[:end])
+
+	def generateRawVenIe(self, with_TL=True):
+		# returns all ven_ie_count vendor IEs concatenated
+		if self.pay2 == None:
+			return None
+
+		buf = Packet.__raw_ven_ie_buf
+		end = 0
+		for i in range(min(self.ven_ie_count, Packet.MAX_VEN_IES)):
+			end = self.packRawVenIeInto(buf, end, with_TL, i)
+		return bytes(buf[:end])
 
 	@staticmethod
 	def checkLengthChecksum(raw_ssid_data, raw_ven_ie_data=None):	
-		if len(raw_ssid_data) != 32:
+		# raw_ven_ie_data is a single vendor IE or a list of vendor IEs
+		if len(raw_ssid_data) != Packet.RAW_SSID_LEN:
 			return False
 		if ord(raw_ssid_data[31]) != Packet.simpleChecksum8(raw_ssid_data, 31):
 			return False
-		if raw_ven_ie_data != None:
-			if len(raw_ven_ie_data) != 238:
+		if isinstance(raw_ven_ie_data, list):
+			for raw_ven_ie in raw_ven_ie_data:
+				if not Packet.checkLengthChecksum(raw_ssid_data, raw_ven_ie):
+					return False
+		elif raw_ven_ie_data != None:
+			if len(raw_ven_ie_data) != Packet.RAW_VEN_IE_LEN:
 				return False
 			if ord(raw_ven_ie_data[237]) != Packet.simpleChecksum8(raw_ven_ie_data, 237):
 				return False
 		return True
 
+	@staticmethod
+	def checkLengthChecksumBatch(raw_ssids, raw_ven_ies):
+		# Vectorized version of checkLengthChecksum for a burst of frames (raw_ven_ies entries could be None, a vendor IE
+		# or a list of vendor IEs).
+		# The SSID and vendor IE blocks are stacked into fixed width arrays, all checksums and trailer fields
+		# are computed in one pass.
+		# Returns the lists valid, ack, seq, flag_len, clientID_srvID (one entry per frame)
+		count = len(raw_ssids)
+		valid = numpy.ones(count, dtype=bool)
+
+		zero_ssid = "\x00" * Packet.RAW_SSID_LEN
+		rows = []
+		for i in range(count):
+			if len(raw_ssids[i]) != Packet.RAW_SSID_LEN:
+				valid[i] = False
+				rows.append(zero_ssid)
+			else:
+				rows.append(raw_ssids[i])
+		ssids = numpy.frombuffer(b"".join(rows), dtype=numpy.uint8).reshape(count, Packet.RAW_SSID_LEN)
+		chk = ~ssids[:, :Packet.RAW_SSID_LEN - 1].sum(axis=1, dtype=numpy.uint32) & 0xFF
+		valid &= chk == ssids[:, Packet.RAW_SSID_LEN - 1]
+
+		# vendor IEs of all frames (a frame could carry a single IE or a list of IEs) are stacked into one array,
+		# owner maps each row back to its frame
+		owner = []
+		rows = []
+		zero_ven_ie = "\x00" * Packet.RAW_VEN_IE_LEN
+		for i in range(count):
+			raw_ven_ie_data = raw_ven_ies[i]
+			if raw_ven_ie_data == None:
+				continue
+			if not isinstance(raw_ven_ie_data, list):
+				raw_ven_ie_data = [raw_ven_ie_data]
+			for raw_ven_ie in raw_ven_ie_data:
+				owner.append(i)
+				if len(raw_ven_ie) != Packet.RAW_VEN_IE_LEN:
+					valid[i] = False
+					rows.append(zero_ven_ie)
+				else:
+					rows.append(raw_ven_ie)
+		if len(rows) > 0:
+			ven_ies = numpy.frombuffer(b"".join(rows), dtype=numpy.uint8).reshape(len(rows), Packet.RAW_VEN_IE_LEN)
+			chk = ~ven_ies[:, :Packet.RAW_VEN_IE_LEN - 1].sum(axis=1, dtype=numpy.uint32) & 0xFF
+			numpy.logical_and.at(valid, owner, chk == ven_ies[:, Packet.RAW_VEN_IE_LEN - 1])
+
+		# trailer fields are converted to python ints, to avoid uint8 wrap arounds in seq/ack arithmetic
+		trailer = ssids[:, Packet.PAY1_MAX_LEN:Packet.PAY1_MAX_LEN + 4].T.tolist()
+		return valid.tolist(), trailer[0], trailer[1], trailer[2], trailer[3]
+
 	def print_out(self):
+		if not logging.getLogger().isEnabledFor(logging.DEBUG):
+			return
 		logging.debug("Packet")
-		logging.debug("\tSA:\t{0}".format(self.sa))
-		logging.debug("\tDA:\t{0}".format(self.da))
+		logging.debug("\tSA:\t{0}".format(Helper.s2mac(self.sa)))
+		logging.debug("\tDA:\t{0}".format(Helper.s2mac(self.da)))
 		logging.debug("\tClientID:\t{0}".format(self.clientID))
 		logging.debug("\tsrvID:\t{0}".format(self.srvID))
+		logging.debug("\tExtended addressing:\t{0}".format(self.ext_addr))
 
 		logging.debug("\tSSID payload len:\t{0}".format(len(self.pay1)))
 		logging.debug("\tSSID payload:\t{0}".format(Helper.s2hex(self.pay1)))
@@ -238,38 +459,106 @@ class Packet:
 
 
 	@staticmethod
-	def simpleChecksum8(input, len_to_include=-1):
-		sum = 0
+	def simpleChecksum8(input, len_to_include=-1, offset=0):
+		# bulk sum over a memoryview (no per byte interpreter loop, no copy of the input)
 		if len_to_include == -1:
-			len_to_include = len(input)
-
-		for off in range(len_to_include):
-			sum += ord(input[off])
-			sum &= 0xFF
+			len_to_include = len(input) - offset
 
-		sum = ~sum
+		chk = ~sum(memoryview(input)[offset:offset+len_to_include].tolist())
 
-		return sum & 0xFF
+		return chk & 0xFF
 
 
 class ConnectionQueue:
+	# Keeps the ClientSockets of a ServerSocket, indexed by client IV, client ID and state (all lookups O(1)).
+	# The state index is updated by the state change callback of the ClientSockets, each state keeps its connections
+	# in order of entering the state. Free client IDs are kept in heaps, thus the lowest free ID is handed out first.
+	# IDs 1..15 fit the legacy 4 bit clientID, higher IDs (up to 255) are only handed out to clients using extended
+	# addressing (which prefer them, to leave the legacy IDs to legacy clients).
+	# Threads waiting in acceptPendingConnection() sleep on a condition, which is notified by transitions into and out of
+	# PENDING_ACCEPT (and by close()).
+	# Additionally each state keeps an LRU of its connections (least recently active first, see touch()), which is used
+	# to pick connections for eviction if no client ID is left.
+
+	LEGACY_MAX_CLIENT_ID = 15
+
 	def __init__(self, max_connections=15):
-		self.__available_client_IDs = []
-		self.__queued_connections = []
-		self.__wait_accept_state_change = Event() # is triggered, when a connection changes to pending_accept or from pending_accept to another state
-		self.__wait_accept_state_change.clear()
-		for ID in range(max_connections):
-			self.__available_client_IDs.insert(0, ID+1)
+		legacy_max = min(max_connections, ConnectionQueue.LEGACY_MAX_CLIENT_ID)
+		self.__available_client_IDs = range(1, legacy_max + 1) # heap of free client IDs, usable in 4 bit clientID field
+		self.__available_ext_client_IDs = range(legacy_max + 1, max_connections + 1) # heap of free client IDs > 15
+		self.__by_id = {} # clientID -> ClientSocket
+		self.__by_iv = {} # clientIV -> ClientSocket
+		self.__by_state = {} # state -> OrderedDict(clientID -> ClientSocket), in order of the state transitions
+		self.__lru_by_state = {} # state -> OrderedDict(clientID -> ClientSocket), least recently active first
+		self.__accept_cond = Condition(RLock()) # notified, when a connection changes to pending_accept or from pending_accept to another state
+		self.accept_wakeups = 0 # number of times a waiting acceptPendingConnection() has been woken up
+		self.accept_callback = None # called (without arguments) when a connection enters pending_accept, f.e. to accept on an EventLoop
+		self.closed = False
 		self.max_connections = max_connections
 
+	@staticmethod
+	def __index(indexes, state):
+		index = indexes.get(state)
+		if index == None:
+			index = OrderedDict()
+			indexes[state] = index
+		return index
+
+	def __stateIndex(self, state):
+		return ConnectionQueue.__index(self.__by_state, state)
+
+	def __lruIndex(self, state):
+		return ConnectionQueue.__index(self.__lru_by_state, state)
+
+	def touch(self, con):
+		# marks the connection as most recently active (called for every request handled by the connection)
+		with self.__accept_cond:
+			lru = self.__lru_by_state.get(con.state)
+			if lru != None and lru.pop(con.clientID, None) is con:
+				lru[con.clientID] = con
+
+	def getLeastRecentlyActive(self, states, min_idle=0, now=None, max_client_id=255, min_state_age=None):
+		# type: (list, float, float, int, dict) -> ClientSocket
+		# returns the least recently active connection of the first state in 'states', which has a connection idle
+		# for at least min_idle seconds, None if there's no such connection. Only connections with a clientID up to
+		# max_client_id are considered (f.e. to free an ID usable by a legacy client). min_state_age maps states to
+		# the seconds a connection has to be in the state, younger ones are skipped.
+		if now == None:
+			now = time.time()
+		with self.__accept_cond:
+			for state in states:
+				lru = self.__lru_by_state.get(state)
+				if not lru:
+					continue
+				min_age = 0
+				if min_state_age != None:
+					min_age = min_state_age.get(state, 0)
+				for con in lru.itervalues():
+					if con.clientID <= max_client_id:
+						if con.getIdleTime(now) < min_idle:
+							break # all following connections have been active more recently
+						if now - con.state_time >= min_age:
+							return con
+		return None
+
 	def __handleConnectionStateChange(self, csock, oldstate, newstate):
 		# type: (ClientSocket, int, int)
 
 		logging.debug("Connection clientID {0}, old state: {1}, new state {2}".format(csock.clientID, oldstate, newstate))
 
-		if newstate == ClientSocket.STATE_PENDING_ACCEPT or oldstate == ClientSocket.STATE_PENDING_ACCEPT:
-			# Trigger event when a connection enters or leaves pending_accept state
-			self.__wait_accept_state_change.set()
+		with self.__accept_cond:
+			if self.__by_id.get(csock.clientID) is csock:
+				self.__stateIndex(oldstate).pop(csock.clientID, None)
+				self.__stateIndex(newstate)[csock.clientID] = csock
+				self.__lruIndex(oldstate).pop(csock.clientID, None)
+				self.__lruIndex(newstate)[csock.clientID] = csock # a state transfer counts as activity
+
+			if newstate == ClientSocket.STATE_PENDING_ACCEPT or oldstate == ClientSocket.STATE_PENDING_ACCEPT:
+				# wake up accept() when a connection enters or leaves pending_accept state
+				self.__accept_cond.notify_all()
+
+		if newstate == ClientSocket.STATE_PENDING_ACCEPT and self.accept_callback != None:
+			self.accept_callback()
 
 		if newstate == ClientSocket.STATE_CLOSE:
 			print("State transfer to CLOSE for Client ID: {0}, IV: {1}".format(csock.clientID, csock.clientIV))
@@ -277,72 +566,303 @@ class ConnectionQueue:
 				# delete closed ClientSockets
 			self.deleteClosedConnections()
 
-	def waitForPendingAcceptStateChange(self):
-		while not self.__wait_accept_state_change.isSet():
-			# interrupted passive wait (interrupt to allow killing thread)
-			self.__wait_accept_state_change.set()
-
-		self.__wait_accept_state_change.clear()
-
-	def provideNewClientSocket(self, srvID):
-		try:
-			clientID = self.__available_client_IDs.pop()
-		except IndexError:
-			# no more client IDs left
-			return None
+	def acceptPendingConnection(self, timeout=None):
+		# type: (float) -> ClientSocket
+		# waits up to timeout seconds (None = forever) for a connection in PENDING_ACCEPT state, transfers the oldest one
+		# to OPEN state and returns it. Returns None on timeout or if the queue has been closed.
+		deadline = None
+		if timeout != None:
+			deadline = time.time() + timeout
+		with self.__accept_cond:
+			while not self.closed:
+				pending = self.__by_state.get(ClientSocket.STATE_PENDING_ACCEPT)
+				if pending:
+					con = next(iter(pending.values()))
+					con.state = ClientSocket.STATE_OPEN
+					return con
+				# the main thread wakes up every second to stay interruptible by KeyboardInterrupt (see Helper.waitCondition)
+				if not Helper.waitCondition(self.__accept_cond, deadline):
+					break
+				self.accept_wakeups += 1
+		return None
+
+	def close(self):
+		# wakes up all threads waiting in acceptPendingConnection()
+		with self.__accept_cond:
+			self.closed = True
+			self.__accept_cond.notify_all()
+
+	def provideNewClientSocket(self, srvID, clientIV=0, extended=False):
+		# extended: the client uses extended addressing, thus could be given an ID > 15
+		with self.__accept_cond:
+			if extended and len(self.__available_ext_client_IDs) > 0:
+				clientID = heapq.heappop(self.__available_ext_client_IDs)
+			elif len(self.__available_client_IDs) > 0:
+				clientID = heapq.heappop(self.__available_client_IDs)
+			else:
+				# no more client IDs left
+				return None
 		newcon = ClientSocket(srvID, self.__handleConnectionStateChange)
 		newcon.clientID = clientID
+		newcon.clientIV = clientIV
 
 		# add to internal queue data
-		self.__queued_connections.append(newcon)
+		with self.__accept_cond:
+			self.__by_id[clientID] = newcon
+			self.__by_iv[clientIV] = newcon
+			self.__stateIndex(newcon.state)[clientID] = newcon
+			self.__lruIndex(newcon.state)[clientID] = newcon
 
 		# return none if no new client is available
 		return newcon
 
 	def getConnectionListByState(self, con_state):
-		res = []
-		for con in self.__queued_connections:
-			if con.state == con_state:
-				res.append(con)
-		return res
+		index = self.__by_state.get(con_state)
+		if index == None:
+			return []
+		return list(index.values())
 
 	def getConnectionByClientIV(self, clientIV):
-		res = None
-		for con in self.__queued_connections:
-			if con.clientIV == clientIV:
-				res = con
-				break
-		return res
+		return self.__by_iv.get(clientIV)
 
 	def getConnectionByClientID(self, clientID):
-		res = None
-		for con in self.__queued_connections:
-			if con.clientID == clientID:
-				res = con
-				break
-		return res
+		return self.__by_id.get(clientID)
+
+	def __removeConnection(self, con):
+		with self.__accept_cond:
+			del self.__by_id[con.clientID]
+			if self.__by_iv.get(con.clientIV) is con:
+				del self.__by_iv[con.clientIV]
+			self.__stateIndex(con.state).pop(con.clientID, None)
+			self.__lruIndex(con.state).pop(con.clientID, None)
+			# add client Id of deleted sock back to the available IDs
+			if con.clientID > ConnectionQueue.LEGACY_MAX_CLIENT_ID:
+				heapq.heappush(self.__available_ext_client_IDs, con.clientID)
+			else:
+				heapq.heappush(self.__available_client_IDs, con.clientID)
 	
 	def deleteClosedConnections(self):
-		closeList = []
-		for con in self.__queued_connections:
-			if con.state == ClientSocket.STATE_CLOSE:
-				closeList.append(con)
+		closeList = self.getConnectionListByState(ClientSocket.STATE_CLOSE)
 				
 		count = 0
 		for con in closeList:
 			print("Removed closed socket for clientID: {0}, clientIV: {1}".format(con.clientID, con.clientIV))
-			self.__queued_connections.remove(con)
-			self.__available_client_IDs.insert(con.clientID, con.clientID) # add client Id of deleted sock back to list of availabl IDs (at position of ID itself)
+			self.__removeConnection(con)
 			count += 1
 		if count > 0:
 			print("Removed {0} closed connections".format(count))
 		return count
 
 
+class StreamBuffer(object):
+	# Thread safe FIFO byte buffer, used for the in- and outbound data of a ClientSocket
+	#
+	# Written data is kept as memoryview chunks (str, bytearray and memoryview aren't copied on write, thus a caller mustn't
+	# modify a written bytearray before it has been transmitted). read() drains an arbitrary number of bytes across chunk
+	# borders, so small writes get coalesced into full packets. Readers could block (with timeout) until data arrives,
+	# they are woken up by write() and close().
+	#
+	# If high_water is set, the buffer is 'full' once it holds high_water bytes and stays full until it has been drained
+	# to low_water bytes. Writers honouring the limit wait for space with writableSpace().
+
+	def __init__(self, high_water=0, low_water=0):
+		self.__chunks = deque()
+		self.__len = 0
+		self.__scanned = 0 # number of bytes at the head of the buffer known to contain no line end (see __findLineEnd)
+		self.__cond = Condition()
+		self.first_write_time = 0 # time at which the buffer went from empty to non-empty
+		self.closed = False # if set, blocking reads return immediately (remaining data could still be read)
+		self.high_water = high_water # 0 = unbounded
+		self.low_water = low_water
+		self.__full = False
+
+	def __len__(self):
+		return self.__len
+
+	def isFull(self):
+		# type: () -> bool
+		return self.__full
+
+	def setWatermarks(self, high_water, low_water):
+		with self.__cond:
+			self.high_water = high_water
+			self.low_water = min(low_water, high_water)
+			self.__updateFull()
+			self.__cond.notify_all()
+
+	def __updateFull(self):
+		# lock held
+		if self.high_water <= 0:
+			self.__full = False
+		elif self.__len >= self.high_water:
+			self.__full = True
+		elif self.__len <= self.low_water:
+			self.__full = False
+
+	def writableSpace(self, timeout=0):
+		# type: (float) -> int
+		# returns the number of bytes which could be written without exceeding high_water, if the buffer is full it waits
+		# up to timeout seconds (None = forever) till it has been drained to low_water. Returns 0 on timeout or if closed.
+		with self.__cond:
+			if self.high_water <= 0:
+				return 0 if self.closed else sys.maxint
+			self.__wait(timeout, lambda: not self.__full)
+			if self.__full or self.closed:
+				return 0
+			return self.high_water - self.__len
+
+	def write(self, data):
+		# type: (str) -> int
+		view = memoryview(data)
+		if len(view) == 0:
+			return 0
+		with self.__cond:
+			if self.__len == 0:
+				self.first_write_time = time.time()
+			self.__chunks.append(view)
+			self.__len += len(view)
+			self.__updateFull()
+			self.__cond.notify_all()
+		return len(view)
+
+	def __wait(self, timeout, predicate):
+		# waits (lock held) until predicate() is true, the buffer is closed or the timeout (seconds, None = forever) is reached
+		if timeout == 0:
+			return predicate()
+		deadline = None
+		if timeout != None:
+			deadline = time.time() + timeout
+		while not predicate() and not self.closed:
+			if not Helper.waitCondition(self.__cond, deadline):
+				break
+		return predicate()
+
+	def __findLineEnd(self):
+		# returns the offset of the first "\n" in the buffered data, -1 if not found (lock held). Data which has been
+		# searched by a previous call isn't searched (and copied) again, thus a line arriving in many chunks costs linear time.
+		pos = 0
+		for chunk in self.__chunks:
+			end = pos + len(chunk)
+			if end > self.__scanned:
+				start = max(self.__scanned - pos, 0)
+				idx = chunk[start:].tobytes().find("\n")
+				if idx >= 0:
+					self.__scanned = pos + start + idx
+					return self.__scanned
+			pos = end
+		self.__scanned = pos
+		return -1
+
+	def wait(self, timeout=None):
+		# type: (float) -> bool
+		# blocks until data is available (or the buffer is closed), returns True if data is available
+		with self.__cond:
+			return self.__wait(timeout, self.__len__) > 0
+
+	def read(self, n, timeout=0):
+		# type: (int, float) -> str
+		# removes up to n bytes from the buffer and returns them, if the buffer is empty it waits up to timeout
+		# seconds (None = forever, 0 = don't block) for data to arrive. Returns an empty string on timeout.
+		with self.__cond:
+			self.__wait(timeout, self.__len__)
+			return self.__read(n)
+
+	def readinto(self, buffer, timeout=0):
+		# type: (bytearray, float) -> int
+		# like read(), but copies the data into the given writable buffer and returns the number of bytes copied
+		target = memoryview(buffer)
+		with self.__cond:
+			self.__wait(timeout, self.__len__)
+			pos = 0
+			while pos < len(target) and len(self.__chunks) > 0:
+				chunk = self.__chunks[0]
+				count = min(len(chunk), len(target) - pos)
+				target[pos:pos + count] = chunk[:count]
+				pos += count
+				if count == len(chunk):
+					self.__chunks.popleft()
+				else:
+					self.__chunks[0] = chunk[count:]
+			self.__len -= pos
+			self.__scanned = max(self.__scanned - pos, 0)
+			self.__updateFull()
+			self.__cond.notify_all()
+		return pos
+
+	def readline(self, limit=-1, timeout=0):
+		# type: (int, float) -> str
+		# removes and returns a line (including the trailing "\n"), waits up to timeout seconds for a complete line.
+		# Returns an empty string if there's no complete line, unless the buffer is closed or limit bytes are
+		# buffered (in this case the available data up to limit is returned).
+		with self.__cond:
+			def line_available():
+				return self.__findLineEnd() >= 0 or (limit >= 0 and self.__len >= limit)
+			if not self.__wait(timeout, line_available) and not self.closed:
+				return ""
+			end = self.__findLineEnd()
+			if end >= 0:
+				n = end + 1
+			else:
+				n = self.__len
+			if limit >= 0:
+				n = min(n, limit)
+			return self.__read(n)
+
+	def __read(self, n):
+		# removes up to n bytes (lock held)
+		parts = []
+		remaining = n
+		while remaining > 0 and len(self.__chunks) > 0:
+			chunk = self.__chunks[0]
+			if len(chunk) <= remaining:
+				self.__chunks.popleft()
+				parts.append(chunk.tobytes())
+				remaining -= len(chunk)
+			else:
+				parts.append(chunk[:remaining].tobytes())
+				self.__chunks[0] = chunk[remaining:]
+				remaining = 0
+		data = "".join(parts)
+		self.__len -= len(data)
+		self.__scanned = max(self.__scanned - len(data), 0)
+		self.__updateFull()
+		self.__cond.notify_all()
+		return data
+
+	def clear(self):
+		with self.__cond:
+			self.__chunks.clear()
+			self.__len = 0
+			self.__scanned = 0
+			self.__updateFull()
+			self.__cond.notify_all()
+
+	def close(self):
+		# wakes up all blocked readers and writers, further blocking calls return immediately
+		with self.__cond:
+			self.closed = True
+			self.__cond.notify_all()
+
+
 class ClientSocket(object):
 	MTU_WITH_VEN_IE = Packet.PAY1_MAX_LEN + Packet.PAY2_MAX_LEN # 28 bytes netto SSID payload + 236 bytes netto vendor ie payload
 	MTU_WITHOUT_VEN_IE = Packet.PAY1_MAX_LEN
 
+	# preset dictionary for payload compression, common tokens of shell in- and output
+	COMPRESSION_DICT = "drwxr-xr-x -rw-r--r-- root root total /usr/bin /bin/ /home/ /etc/ /dev/ /proc/ /tmp/ /var/ " + \
+		"Directory of C:\\Windows\\System32 C:\\Users\\ <DIR> File(s) Dir(s) bytes free .exe .dll .txt " + \
+		"Access is denied. is not recognized as an internal or external command, operable program or batch file. " + \
+		"PID USER TIME COMMAND Image Name Session Name Mem Usage Services Console " + \
+		"ls cd dir ps cat echo whoami ipconfig ifconfig netstat systeminfo tasklist type copy del " + \
+		"\r\n\r\n    \r\n"
+
+	try:
+		# preset dictionaries need python >= 3.3 (zdict argument)
+		zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, COMPRESSION_DICT)
+		SUPPORTED_CAPS = Packet.CAP_COMPRESSION | Packet.CAP_COMPRESSION_DICT | Packet.CAP_MULTI_VEN_IE | Packet.CAP_WINDOW | Packet.CAP_EXT_ADDR
+	except TypeError:
+		SUPPORTED_CAPS = Packet.CAP_COMPRESSION | Packet.CAP_MULTI_VEN_IE | Packet.CAP_WINDOW | Packet.CAP_EXT_ADDR
+
 	STATE_CLOSE = 1 # communication possible
 	STATE_PENDING_OPEN = 2 # connection init started but not done
 	STATE_PENDING_ACCEPT = 3 # connection init done, but connection not accepted
@@ -350,6 +870,16 @@ class ClientSocket(object):
 	STATE_PENDING_CLOSE = 5 # connection is being transfered to close state
 	STATE_DELETE = 6 # connection is ready to be deleted
 
+	TX_WINDOW_MAX = 16 # Windows scan caches hold ~22 probe responses per scan
+
+	# default watermarks (bytes) of the in- and outbound buffers, send() blocks while the outbound buffer is full,
+	# inbound data isn't acknowledged while the inbound buffer is full (the client retransmits and thus throttles)
+	IN_HIGH_WATER = 256 * 1024
+	IN_LOW_WATER = 64 * 1024
+	OUT_HIGH_WATER = 256 * 1024
+	OUT_LOW_WATER = 64 * 1024
+	CTLM_QUEUE_MAX = 32 # pending outbound control messages
+
 	def __init__(self, srvID, stateChangeCallback=None):
 		self.stateChangeCallback = stateChangeCallback
 		self.__state = ClientSocket.STATE_CLOSE
@@ -360,13 +890,37 @@ class ClientSocket(object):
 		self.clientSA = None # Source address used by client IN FIRST CONNECT (could change during scans and isn't updated)
 		self.txVenIeAllowed = False # if true vendor IE could be used when transmitting to client
 		self.rxVenIePossible = False # if true vendor IE could be received from client
-		self.mtu = ClientSocket.MTU_WITH_VEN_IE # mtu (depending on txVenIeAllowed)
+		self.txVenIeCount = 1 # number of vendor IEs per response (> 1 if CAP_MULTI_VEN_IE is in use)
+		self.mtu = ClientSocket.MTU_WITH_VEN_IE # mtu (depending on txVenIeAllowed, txVenIeCount and ext_addr)
+		self.ext_addr = False # extended addressing (CAP_EXT_ADDR) in use
+		self.pay1_max = Packet.PAY1_MAX_LEN # SSID payload per packet (one byte less with extended addressing)
+		self.capabilities = ClientSocket.SUPPORTED_CAPS # optional capabilities, which could be offered to the client on CON_INIT
+		self.offered_caps = 0 # optional capabilities offered to the client in CON_INIT_RSP1
+		self.caps = 0 # optional capabilities in use (accepted by the client in CON_INIT_REQ2)
+		self.__compressor = None
+		self.__decompressor = None
+		self.__compress_lock = threading.Lock() # send() feeds the compressor, the firmware event thread flushes it
+		self.__deflate_pending = 0 # bytes fed to the compressor since its last flush (upper bound of the data it holds back)
+		self.__deflate_pending_since = 0 # time at which __deflate_pending became non-zero
+		self.tx_bytes_raw = 0 # outbound payload bytes handed to send()
+		self.tx_bytes_compressed = 0 # outbound payload bytes after compression
+		self.rx_bytes_raw = 0 # inbound payload bytes after decompression
+		self.rx_bytes_compressed = 0 # inbound payload bytes as received
+		self.tx_window_max = ClientSocket.TX_WINDOW_MAX # maximum window size, which could be granted to the client
+		self.tx_window = 0 # window size in use (CAP_WINDOW), 0 for PingPong
+		self.__tx_unacked = OrderedDict() # retransmit buffer of the window, seq -> Packet (in order of seq)
+		self.__tx_next_seq = 0 # seq for the next packet put into the window
+		self.tx_burst = [] # additional responses to send after the packet returned by handleRequest (window mode)
 		self.last_rx_packet = None
+		self.last_rx_time = time.time() # time of the last request handled by this socket
+		self.state_time = self.last_rx_time # time of the last state transfer
 		self.tx_packet = None
 		self.clientSocket = None
-		self.__in_queue = Queue.Queue()
-		self.__out_queue = Queue.Queue()
-		self.__out_queue_ctlm = Queue.Queue()
+		self.tx_delay = 0 # Nagle like delay (seconds): less than mtu bytes of outbound data are held back up to tx_delay, 0 = off
+		self.__in_buffer = StreamBuffer(ClientSocket.IN_HIGH_WATER, ClientSocket.IN_LOW_WATER) # inbound data (decompressed), consumed by read(), readinto() and readline()
+		self.__out_buffer = StreamBuffer(ClientSocket.OUT_HIGH_WATER, ClientSocket.OUT_LOW_WATER) # outbound data, drained in mtu sized portions when a response is built
+		self.__out_queue_ctlm = Queue.Queue(ClientSocket.CTLM_QUEUE_MAX)
+		self.event_callback = None # called (without arguments) after a request has been handled or a state transfer, see ClientStream
 
 	@property
 	def state(self):
@@ -380,89 +934,181 @@ class ClientSocket(object):
 			# no state transfer
 			return
 		self.__state = value
+		self.state_time = time.time()
+		if oldstate == ClientSocket.STATE_OPEN:
+			# wake up readers blocked on the inbound buffer and writers blocked on the outbound buffer
+			self.__in_buffer.close()
+			self.__out_buffer.close()
 		if self.stateChangeCallback != None:
 			self.stateChangeCallback(self, oldstate, value)
+		if self.event_callback != None:
+			self.event_callback()
 
 	def shutdown(self):
 		# send reset
 		# change state to close
 		pass
 
-	def read(self, bufsize, block=False):
+	def read(self, bufsize, block=False, timeout=None):
+		# type: (int, bool, float) -> str
+		# returns up to bufsize bytes of inbound data. If block is set and no data is available, waits up to timeout
+		# seconds (None = until data arrives or the connection leaves OPEN state). Returns an empty string if no data is available.
 		if self.state != ClientSocket.STATE_OPEN:
 			return ""
+		return self.__in_buffer.read(bufsize, self.__readTimeout(block, timeout))
 
-		if not self.hasInData():
-			return ""
-
-		len_received = 0
-		len_chunk = 0
-		current_chunk = None
-		buf = ""
-
-		while len_received <  bufsize:
-			if self.__in_queue.qsize() == 0:
-				break # stop if no more data in inqueue
-
-			# Caution: This isn't thread safe, as a new element could be put() on the queue by the input_handler AFTER WE STORED len_chunk
-			# ToDo: put a thread LOCK on queue before length check
-			len_chunk = len(self.__in_queue.queue[0])
-
-			if (len_chunk + len_received) >  bufsize:
-				break # abort, as we would exceed the gicen buffer size (before popping from queue)
-
-			current_chunk = self.__in_queue.get()
-
-			if len(current_chunk) == 0:
-				# break after popping from queue
-				break # zero len payload indicates EOF, has to be replaced by dedicated CTLM_TYPE (no priority, arriving in order)
-
-			buf += current_chunk
-			len_received += len(current_chunk)
-
-		return buf
-
+	def readinto(self, buffer, block=False, timeout=None):
+		# type: (bytearray, bool, float) -> int
+		# like read(), but copies the inbound data into the given writable buffer, returns the number of bytes copied
+		if self.state != ClientSocket.STATE_OPEN:
+			return 0
+		return self.__in_buffer.readinto(buffer, self.__readTimeout(block, timeout))
 
-	def sendCtlMessage(self, ctlm_type, data):
-		self.__pushOutboundCtrlMsg(ctlm_type, data[:self.mtu])
+	def readline(self, limit=-1, block=False, timeout=None):
+		# type: (int, bool, float) -> str
+		# returns the next complete line of inbound data (including "\n"), an empty string if there is none
+		if self.state != ClientSocket.STATE_OPEN:
+			return ""
+		return self.__in_buffer.readline(limit, self.__readTimeout(block, timeout))
 
-	# note: block parameter is currently always assumed to be True
-	def send(self, string, block=True):
-		for off in range(0, len(string), self.mtu):
-			chunk = string[off:off+self.mtu]
+	@staticmethod
+	def __readTimeout(block, timeout):
+		if not block:
+			return 0
+		return timeout
+
+
+	def sendCtlMessage(self, ctlm_type, data, block=True, timeout=None):
+		# type: (int, str, bool, float) -> bool
+		# returns False if the control message queue is full (after timeout, if block is set)
+		return self.__pushOutboundCtrlMsg(ctlm_type, data[:self.mtu], block, timeout)
+
+	def send(self, string, block=True, timeout=None):
+		# type: (str, bool, float) -> int
+		# string could be a str, bytearray or memoryview (not copied if compression isn't in use), the data is
+		# split into packets when responses are built, thus consecutive small sends share packets
+		#
+		# If the outbound buffer is full, send() waits till it has been drained to its low watermark (block set, up to timeout
+		# seconds, None = forever) or returns immediately (block unset). Returns the number of bytes accepted, which is less
+		# than len(string) if the timeout has been reached, the buffer was full (non-blocking) or the connection left OPEN state.
+		view = memoryview(string)
+		sent = 0
+		if not block:
+			timeout = 0
+		deadline = None
+		if timeout != None:
+			deadline = time.time() + timeout
+		while sent < len(view):
+			wait = None
+			if deadline != None:
+				wait = max(0, deadline - time.time())
+			space = self.__out_buffer.writableSpace(wait)
+			if space == 0:
+				break
+			# the buffer holds compressed data, data held back by the compressor counts against its space
+			space -= self.__deflate_pending
+			if space <= 0:
+				self.__flushCompressor()
+				continue
+			chunk = view[sent:sent + space]
 			self.__pushOutboundData(chunk)
+			sent += len(chunk)
+		return sent
 
-	def __pushOutboundCtrlMsg(self, ctlm_type, data, block=True):
+	def __pushOutboundCtrlMsg(self, ctlm_type, data, block=True, timeout=None):
 		# ToDo: check if valid ctlm_type
 		payload = chr(ctlm_type) + data
 		logging.debug("Pushing controlmessage type: {0}, outdata {1}".format(ctlm_type, data))
-		self.__out_queue_ctlm.put(payload, block=block)	
-
-	def __pushOutboundData(self, data, block=True):
-		logging.debug("Pushing outdata {0}".format(data))
-		self.__out_queue.put(data, block=block)
+		try:
+			self.__out_queue_ctlm.put(payload, block, timeout)
+		except Queue.Full:
+			logging.debug("Control message queue of client {0} full, control message type {1} dropped".format(self.clientID, ctlm_type))
+			return False
+		return True
 
-	def __popInboundData(self):
-		if self.hasInData():
-			return self.__in_queue.get()
-		else:
-			return ""
+	def __pushOutboundData(self, data):
+		# compresses (if enabled) and buffers data, the caller has checked the watermark
+		# The compressor isn't flushed here (every Z_SYNC_FLUSH adds about 5 bytes, which would expand small writes),
+		# but when a packet is built and the buffered compressed data doesn't fill it (see __flushCompressor)
+		self.tx_bytes_raw += len(data)
+		if self.__compressor == None:
+			self.tx_bytes_compressed += len(data)
+			self.__out_buffer.write(data)
+			return
+		with self.__compress_lock:
+			if self.__deflate_pending == 0:
+				self.__deflate_pending_since = time.time()
+			self.__deflate_pending += len(data)
+			data = self.__compressor.compress(data.tobytes())
+			self.tx_bytes_compressed += len(data)
+			logging.debug("Pushing {0} bytes outdata".format(len(data)))
+			self.__out_buffer.write(data)
+
+	def __flushCompressor(self):
+		# moves the data held back by the compressor into the outbound buffer, ending on a byte boundary the client
+		# could decompress up to
+		with self.__compress_lock:
+			if self.__deflate_pending == 0:
+				return
+			data = self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+			self.__deflate_pending = 0
+			self.tx_bytes_compressed += len(data)
+			self.__out_buffer.write(data)
 
 	def disconnect(self, reason_code=Packet.CON_RESET_REASON_UNSPECIFIED):
 		reasonCodeChr = chr(reason_code)
-		self.sendCtlMessage(Packet.CTLM_TYPE_CON_RESET, reasonCodeChr)
+		self.sendCtlMessage(Packet.CTLM_TYPE_CON_RESET, reasonCodeChr, block=False)
 		self.state = ClientSocket.STATE_CLOSE
 
 	def hasInData(self):
 		# type: () -> bool
-		return self.__in_queue.qsize() > 0
+		return len(self.__in_buffer) > 0
+
+	def getQueueDepths(self):
+		# type: () -> (int, int, int, int)
+		# returns (buffered inbound bytes, buffered outbound bytes, pending outbound control messages, unacknowledged packets in the window)
+		return (len(self.__in_buffer), len(self.__out_buffer), self.__out_queue_ctlm.qsize(), len(self.__tx_unacked))
+
+	def setWatermarks(self, in_high, in_low, out_high, out_low):
+		# watermarks in bytes, a high watermark of 0 disables the limit
+		self.__in_buffer.setWatermarks(in_high, in_low)
+		self.__out_buffer.setWatermarks(out_high, out_low)
+
+	def waitForInData(self, timeout=None):
+		# type: (float) -> bool
+		# blocks until inbound data is available (or the connection leaves OPEN state), returns True if data is available
+		return self.__in_buffer.wait(timeout)
+
+	def __enableCapabilities(self, caps):
+		self.caps = caps
+		if caps & Packet.CAP_COMPRESSION:
+			if caps & Packet.CAP_COMPRESSION_DICT:
+				self.__compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, ClientSocket.COMPRESSION_DICT)
+				self.__decompressor = zlib.decompressobj(-15, ClientSocket.COMPRESSION_DICT)
+			else:
+				self.__compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -15)
+				self.__decompressor = zlib.decompressobj(-15)
+
+	def getCompressionRatio(self):
+		# type: () -> (float, float)
+		# returns the achieved compression ratio (uncompressed size / transmitted size) for outbound and inbound data
+		tx_ratio = 1.0
+		rx_ratio = 1.0
+		if self.tx_bytes_compressed > 0:
+			tx_ratio = float(self.tx_bytes_raw) / self.tx_bytes_compressed
+		if self.rx_bytes_compressed > 0:
+			rx_ratio = float(self.rx_bytes_raw) / self.rx_bytes_compressed
+		return (tx_ratio, rx_ratio)
 
 	def handleRequest(self, req):
 		# type: (Packet) -> Packet
 
+		self.tx_burst = []
+		self.last_rx_time = time.time()
+
 
 		# cases for connection reset (disconnect):
-		# 1) Everytime a client tries to connect (has to be handled in ServerSocket.handle_request)
+		# 1) DONE: Everytime a client tries to connect and no client ID is left (ServerSocket.__admit)
 		#	1.1) delete all client_sockets in state CLOSE
 		#	1.2) If no socket deleted: transfer oldest* client_socket in state PENDING_OPEN to CLOSE + send reset
 		#	1.4) If no socket transfered to CLOSE: transfer *oldest client_socket in state PENDING_ACCEPT to CLOSE + send reset
@@ -484,7 +1130,7 @@ class ClientSocket(object):
 
 				# generate response
 				resp = Packet()
-				resp.sa = "11:22:33:44:55:66"
+				resp.sa = "\x11\x22\x33\x44\x55\x66"
 				resp.da = req.sa # direct probe response, even if SA changes
 				resp.pay1 = chr(Packet.CTLM_TYPE_CON_INIT_RSP1) + self.clientIVBytes
 				resp.pay2 = self.clientIVBytes
@@ -494,18 +1140,31 @@ class ClientSocket(object):
 				# if we received a vendor IE, we inform the client by appending 0x02 at resp.pay1[5]
 				# if we aren't able to receive the vendor IE, we inform the client by appending 0x01 at resp.pay1[5]
 				if req.pay2 != None:
-					resp.pay1 += chr(2)
+					caps = 2
 					self.rxVenIePossible = True
 				else:
-					resp.pay1 += chr(1)
+					caps = 1
 					self.rxVenIePossible = False
+				# optional capabilities are only offered, if the client advertised them (legacy clients don't send a capability byte)
+				if len(req.pay1) > 5:
+					self.offered_caps = ord(req.pay1[5]) & self.capabilities & ~Packet.CAP_VEN_IE_MASK
+					caps |= self.offered_caps
+				resp.pay1 += chr(caps)
+				if self.offered_caps & Packet.CAP_EXT_ADDR:
+					# the client advertised extended addressing, thus RSP1 (carrying the clientID) already uses it
+					self.ext_addr = True
+					self.pay1_max = Packet.EXT_PAY1_MAX_LEN
+					resp.ext_addr = True
+				if self.offered_caps & Packet.CAP_MULTI_VEN_IE:
+					# send the maximum number of vendor IEs, the client reports how many of them passed its driver
+					resp.ven_ie_count = Packet.MAX_VEN_IES
 				# we hand out a new clientID to the pending (not yet established) connection
 				resp.clientID = self.clientID
 				resp.srvID = self.srvID
 				resp.ack = req.seq
 
 				self.tx_packet = resp
-				self.last_rx_packet = req
+				self.last_rx_packet = req.copy(self.last_rx_packet)
 				resp.print_out()
 
 
@@ -522,7 +1181,7 @@ class ClientSocket(object):
 				print("Invalid socket state {0} for CTLM_TYPE_CON_INIT_REQ1".format(self.state))
 				resp= Packet.generateResetPacket(req, self.srvID, Packet.CON_RESET_REASON_UNSPECIFIED, seq=1)
 				self.tx_packet = resp
-				self.last_rx_packet = req
+				self.last_rx_packet = req.copy(self.last_rx_packet)
 				self.state = ClientSocket.STATE_PENDING_CLOSE
 				return self.tx_packet
 		elif req.seq == 2 and req.ctlm_type == Packet.CTLM_TYPE_CON_INIT_REQ2:
@@ -534,14 +1193,15 @@ class ClientSocket(object):
 				resp.seq = 2
 				resp.ctlm_type = Packet.CTLM_TYPE_CON_INIT_RSP2
 				resp.pay1 = chr(Packet.CTLM_TYPE_CON_INIT_RSP2) + self.clientIVBytes
-				self.last_rx_packet = req
+				self.last_rx_packet = req.copy(self.last_rx_packet)
 				self.tx_packet = resp
 
-				if ord(req.pay1[5]) == 2:
+				caps = ord(req.pay1[5])
+				if caps & Packet.CAP_VEN_IE_MASK == 2:
 					# client received vendor IE in response1
 					self.txVenIeAllowed = True
 					self.mtu = ClientSocket.MTU_WITH_VEN_IE
-				elif ord(req.pay1[5]) == 1:
+				elif caps & Packet.CAP_VEN_IE_MASK == 1:
 					# client didn't receive vendor IE from response1
 					self.txVenIeAllowed = False
 					self.mtu = ClientSocket.MTU_WITHOUT_VEN_IE
@@ -550,6 +1210,37 @@ class ClientSocket(object):
 					logging.debug("Received invalid information for ven IE receive caps from clientID {0}, dropped...",  req.clientID)
 					return None
 
+				# enable the optional capabilities accepted by the client and confirm them in response2
+				accepted = caps & self.offered_caps
+				if self.ext_addr:
+					accepted |= Packet.CAP_EXT_ADDR # addressing mode is fixed since RSP1
+				self.__enableCapabilities(accepted)
+
+				resp.ven_ie_count = 1
+				if accepted & Packet.CAP_MULTI_VEN_IE:
+					# number of vendor IEs the client received in response1
+					count = 1
+					if len(req.pay1) > 6:
+						count = max(1, min(ord(req.pay1[6]), Packet.MAX_VEN_IES))
+					self.txVenIeCount = count
+					if self.txVenIeAllowed:
+						self.mtu = ClientSocket.MTU_WITHOUT_VEN_IE + count * Packet.PAY2_MAX_LEN
+
+				if self.ext_addr:
+					self.mtu -= Packet.PAY1_MAX_LEN - Packet.EXT_PAY1_MAX_LEN
+
+				if accepted & Packet.CAP_WINDOW:
+					# window size requested by the client
+					window = 1
+					if len(req.pay1) > 7:
+						window = max(1, min(ord(req.pay1[7]), self.tx_window_max))
+					self.tx_window = window
+					self.__tx_unacked.clear()
+					self.__tx_next_seq = 3 # first seq following response2
+
+				if accepted != 0:
+					resp.pay1 += chr(accepted) + chr(self.txVenIeCount) + chr(self.tx_window)
+
 
 				# Handover to accept() method !!
 				self.state = ClientSocket.STATE_PENDING_ACCEPT # done by event emitter in setter of state
@@ -570,7 +1261,7 @@ class ClientSocket(object):
 				logging.debug("Invalid socket state {0} for CTLM_TYPE_CON_INIT_REQ2".format(self.state))
 				resp= Packet.generateResetPacket(req, self.srvID, Packet.CON_RESET_REASON_UNSPECIFIED, seq=2)
 				self.tx_packet = resp
-				self.last_rx_packet = req
+				self.last_rx_packet = req.copy(self.last_rx_packet)
 				self.state = ClientSocket.STATE_PENDING_CLOSE
 				return self.tx_packet
 
@@ -583,7 +1274,8 @@ class ClientSocket(object):
 		# != tx.seq	!= last_rx.seq+1	--> tx.seq = last_tx.seq, tx.ack = last_tx.ack , resend last_tx_packet
 		# != tx.seq	== last_rx.seq+1	--> tx.seq = last_tx.seq, tx.ack = rx.seq, put indata into input queue, update last_rx_packet
 
-		# Note on flow control: PingPong, no slinding window, although it'd be usefull for bulk probe responses ... anyway, this is only a PoC
+		# Note on flow control: PingPong by default. If CAP_WINDOW has been negotiated, up to tx_window packets with distinct
+		# seq are outstanding and every request is answered with a burst of all unacknowledged packets (see __handleDataWindowed)
 
 		if not req.FlagControlMessage:
 			if self.state != ClientSocket.STATE_OPEN:
@@ -591,322 +1283,915 @@ class ClientSocket(object):
 				return None
 			
 			# check if seq has advanced
-			if req.seq == ((self.last_rx_packet.seq + 1) & 0xFF):
+			if req.seq == ((self.last_rx_packet.seq + 1) & 0xFF) and self.__in_buffer.isFull():
+				# backpressure: the packet isn't acknowledged until the consumer drained the inbound buffer, the
+				# client keeps retransmitting it
+				logging.debug("Inbound buffer of client {0} full, packet with seq {1} not acknowledged".format(self.clientID, req.seq))
+			elif req.seq == ((self.last_rx_packet.seq + 1) & 0xFF):
 				# new input packet, push data to in_queue
 				indata = req.pay1
 				if req.pay2 != None:
 					indata += req.pay2
-				self.__in_queue.put(indata)
-				logging.debug("Enqueueing indata (client {0}): '{1}'".format(self.clientID,  indata))
+				self.rx_bytes_compressed += len(indata)
+				if self.__decompressor != None:
+					try:
+						indata = self.__decompressor.decompress(indata)
+					except zlib.error as e:
+						# corrupted packet (passed the checksum) or no deflate data, the stream can't be recovered
+						logging.warning("Decompression of inbound data from client {0} failed ({1}), resetting connection".format(self.clientID, e))
+						resp = Packet.generateResetPacket(req, self.srvID, Packet.CON_RESET_REASON_UNSPECIFIED)
+						self.tx_packet = resp
+						self.last_rx_packet = req.copy(self.last_rx_packet)
+						self.state = ClientSocket.STATE_CLOSE # deletes the socket, retransmissions are answered with a reset for the unknown client ID
+						return self.tx_packet
+				# a packet could end inside a deflate block, in this case there's no new data yet
+				if len(indata) > 0:
+					self.rx_bytes_raw += len(indata)
+					self.__in_buffer.write(indata)
+					logging.debug("Enqueueing indata (client {0}): '{1}'".format(self.clientID,  indata))
 
 				# update last packet
-				self.last_rx_packet = req
+				self.last_rx_packet = req.copy(self.last_rx_packet)
 
 				# update tx ack
 				self.tx_packet.ack = req.seq
 
+			if self.tx_window > 0:
+				return self.__handleDataWindowed(req)
+
 			# check if ack is fitting last transmitted seq, thus we could push a new outbound packet
 			if req.ack == self.tx_packet.seq:
 				# advance tx seq
 				self.tx_packet.seq += 1
 				self.tx_packet.seq &= 0xFF # modulo 256
 
+				self.__fillPacket(self.tx_packet)
 
-				outdata = ""
-
-				# before we send data, we check if we have pending outbound control messages (priority)
-				self.tx_packet.FlagControlMessage = False # only true if ctlm (false for empty heartbeat od data)
-				if self.__out_queue_ctlm.qsize() > 0:
-					outdata = self.__out_queue_ctlm.get()
-					self.tx_packet.ctlm_type = ord(outdata[0])
-					self.tx_packet.FlagControlMessage = True
-				# pop data from out_queue and update payload NOTE: data from queue should always be <= self.mtu
-				elif self.__out_queue.qsize() > 0:
-					outdata = self.__out_queue.get()
-
-				logging.debug("sending outdata in seq {1}: {0}".format(Helper.s2hex(outdata),  self.tx_packet.seq))
+			return self.tx_packet
 
-				# THIS SHOULD NEVER HAPPEN
-				if len(outdata) > self.mtu:
-					logging.debug("Error: Outdata has been truncate, because it was larger than MTU")
-					outdata = outdata[:self.mtu]
+	def __hasOutboundData(self):
+		return self.__out_queue_ctlm.qsize() > 0 or self.__hasSendableData()
+
+	def __hasSendableData(self):
+		# false if there's no outbound data, or the data doesn't fill a packet and is held back by tx_delay
+		pending = len(self.__out_buffer)
+		first_write_time = self.__out_buffer.first_write_time
+		if self.__deflate_pending > 0:
+			if pending == 0:
+				first_write_time = self.__deflate_pending_since
+			pending += self.__deflate_pending
+		if pending == 0:
+			return False
+		if self.tx_delay > 0 and pending < self.mtu:
+			return time.time() - first_write_time >= self.tx_delay
+		return True
 
-				self.tx_packet.pay1 = outdata[:Packet.PAY1_MAX_LEN]	
-				if len(outdata) > Packet.PAY1_MAX_LEN:
-					self.tx_packet.pay2 = outdata[Packet.PAY1_MAX_LEN:]
-				else:
-					self.tx_packet.pay2 = None
+	def __fillPacket(self, packet):
+		# pops the next outbound chunk (empty heartbeat if there's none) and puts it into the payload of the given packet
+		outdata = ""
+
+		# before we send data, we check if we have pending outbound control messages (priority)
+		packet.FlagControlMessage = False # only true if ctlm (false for empty heartbeat od data)
+		if self.__out_queue_ctlm.qsize() > 0:
+			outdata = self.__out_queue_ctlm.get()
+			packet.ctlm_type = ord(outdata[0])
+			packet.FlagControlMessage = True
+		# take as much outbound data as fits into the packet (mtu is the current one, f.e. after vendor IE negotiation)
+		elif self.__hasSendableData():
+			if len(self.__out_buffer) < self.mtu:
+				self.__flushCompressor()
+			outdata = self.__out_buffer.read(self.mtu)
+
+		logging.debug("sending outdata in seq {1}: {0}".format(Helper.s2hex(outdata),  packet.seq))
+
+		# THIS SHOULD NEVER HAPPEN
+		if len(outdata) > self.mtu:
+			logging.debug("Error: Outdata has been truncate, because it was larger than MTU")
+			outdata = outdata[:self.mtu]
+
+		packet.pay1 = outdata[:self.pay1_max]
+		if len(outdata) > self.pay1_max:
+			packet.pay2 = outdata[self.pay1_max:]
+			# only as many vendor IEs as needed for the payload
+			packet.ven_ie_count = (len(packet.pay2) + Packet.PAY2_MAX_LEN - 1) // Packet.PAY2_MAX_LEN
+		else:
+			packet.pay2 = None
 
+	def __handleDataWindowed(self, req):
+		# type: (Packet) -> Packet
 
+		# cumulative ack: every outstanding packet up to (and including) req.ack has been received by the client
+		if req.ack in self.__tx_unacked:
+			while True:
+				seq = self.__tx_unacked.popitem(last=False)[0]
+				if seq == req.ack:
+					break
+
+		# fill the window with new packets
+		while len(self.__tx_unacked) < self.tx_window and self.__hasOutboundData():
+			packet = Packet()
+			packet.sa = self.tx_packet.sa
+			packet.da = self.tx_packet.da
+			packet.clientID = self.clientID
+			packet.srvID = self.srvID
+			packet.ext_addr = self.ext_addr
+			packet.seq = self.__tx_next_seq
+			self.__tx_next_seq = (self.__tx_next_seq + 1) & 0xFF
+			self.__fillPacket(packet)
+			self.__tx_unacked[packet.seq] = packet
+
+		if len(self.__tx_unacked) == 0:
+			# nothing outstanding, answer with an ack only packet (repeats the last seq acknowledged by the client)
+			self.tx_packet.seq = (self.__tx_next_seq - 1) & 0xFF
+			self.tx_packet.FlagControlMessage = False
+			self.tx_packet.pay1 = ""
+			self.tx_packet.pay2 = None
 			return self.tx_packet
 
+		# burst of all unacknowledged packets (oldest first), carrying the current ack
+		burst = list(self.__tx_unacked.values())
+		for packet in burst:
+			packet.ack = self.tx_packet.ack
+		self.tx_burst = burst[1:]
+		return burst[0]
 
-
+	def getIdleTime(self, now):
+		# type: (float) -> float
+		# seconds since the last request has been received or the last state transfer happened (whatever is newer)
+		return now - max(self.last_rx_time, self.state_time)
 
 	def print_out(self):
+		if not logging.getLogger().isEnabledFor(logging.DEBUG):
+			return
 		logging.debug("Connection")
 		logging.debug("\tClientID:\t{0}".format(self.clientID))
 		logging.debug("\tClientIV bytes:\t{0}".format(Helper.s2hex(self.clientIVBytes)))
-		logging.debug("\tClientSA:\t{0}".format(self.clientSA))
+		logging.debug("\tClientSA:\t{0}".format(Helper.s2mac(self.clientSA)))
 		logging.debug("\tTX vendor IE possible:\t{0}".format(self.txVenIeAllowed))
 		logging.debug("\tRX vendor IE possible:\t{0}".format(self.rxVenIePossible))
+		logging.debug("\tTX vendor IEs per response:\t{0}".format(self.txVenIeCount))
 		logging.debug("\tTX MTU:\t{0}".format(self.mtu))
+		logging.debug("\tExtended addressing:\t{0}".format(self.ext_addr))
+		logging.debug("\tTX window:\t{0}".format(self.tx_window))
+		logging.debug("\tCapabilities:\t{0}".format(hex(self.caps)))
+		logging.debug("\tQueue depths (in, out, ctlm, unacked):\t{0}".format(self.getQueueDepths()))
 
 
-class ServerSocket:
-	MAX_CONNECTIONS_LIMIT = 15 # more clients aren't allowed
-	__global_firmware_event_queue = None
-	__global_firmware_event_thread = None
-	__nl_in_socket = None
-	__nl_out_socket = None
-	__nl_out_socket_fd = None
-	__nl_thread_stop = Event()
+class TimerWheel(object):
+	# Hashed timer wheel
+	#
+	# Timers are hashed into 'slots' buckets by the tick (multiple of 'resolution' seconds) they expire in, advance() only
+	# visits the buckets of the ticks passed since its last call. Timers more than one revolution ahead stay in their
+	# bucket for additional rounds. Scheduling is O(1), timers aren't cancelled but checked by their owner when they expire.
+
+	def __init__(self, resolution=0.5, slots=64, now=None):
+		if now == None:
+			now = time.time()
+		self.resolution = resolution
+		self.__slots = [[] for i in range(slots)]
+		self.__tick = int(now / resolution) # last tick processed by advance()
+		self.__count = 0
+
+	def __len__(self):
+		return self.__count
+
+	def schedule(self, deadline, item):
+		# item is returned by the first call of advance() with now >= deadline (rounded up to the next tick)
+		tick = int(deadline / self.resolution) + 1
+		if tick <= self.__tick:
+			tick = self.__tick + 1
+		self.__slots[tick % len(self.__slots)].append((tick, item))
+		self.__count += 1
+
+	def advance(self, now):
+		# returns the list of items which expired since the last call
+		tick = int(now / self.resolution)
+		expired = []
+		slot_count = len(self.__slots)
+		for t in range(self.__tick + 1, min(tick, self.__tick + slot_count) + 1):
+			bucket = self.__slots[t % slot_count]
+			if len(bucket) == 0:
+				continue
+			remaining = []
+			for entry in bucket:
+				if entry[0] <= tick:
+					expired.append(entry[1])
+				else:
+					remaining.append(entry) # due in a later round
+			self.__slots[t % slot_count] = remaining
+		if tick > self.__tick:
+			self.__tick = tick
+		self.__count -= len(expired)
+		return expired
+
+
+class DuplicateRequestCache(object):
+	# Time bounded LRU of recently dispatched probe requests.
+	# Clients repeat the same probe request several times per scan and the firmware reports every copy, thus exact duplicates
+	# (same SSID IE and vendor IE data) arriving within 'window' seconds are answered from this cache instead of
+	# running the connection lookup and state machine again. If responses (their serialized frames) are recorded for an
+	# entry, they could be re-sent, otherwise the duplicate is only dropped.
+
+	def __init__(self, window=1.0, max_entries=128):
+		self.window = window # seconds a request is considered a duplicate after it has been seen first
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.__entries = OrderedDict() # key -> (timestamp of first reception, list of recorded response frames), oldest first
 
+	@staticmethod
+	def request_key(raw_ssid_data, raw_ven_ie_data=None):
+		# the complete SSID IE and vendor IE data (the 8 bit checksums alone would let about one of 256 different
+		# requests with the same seq and ack pass as duplicate), the dict compares the bytes, thus there are no collisions
+		if raw_ven_ie_data == None:
+			return raw_ssid_data
+		if isinstance(raw_ven_ie_data, list):
+			return raw_ssid_data + "".join(raw_ven_ie_data)
+		return raw_ssid_data + raw_ven_ie_data
+
+	def lookup(self, key, now):
+		# returns the list of responses recorded for a duplicate of 'key', None if the request hasn't been seen within the window
+		entry = self.__entries.get(key)
+		if entry != None and now - entry[0] <= self.window:
+			self.hits += 1
+			# refresh LRU position, but keep the time of first reception (a steady stream of copies doesn't extend the window)
+			del self.__entries[key]
+			self.__entries[key] = entry
+			return entry[1]
+		self.misses += 1
+		return None
+
+	def insert(self, key, now):
+		# adds 'key' and returns the (empty) list the response frames to the request should be recorded in
+		if key in self.__entries:
+			del self.__entries[key]
+		responses = []
+		self.__entries[key] = (now, responses)
+		while len(self.__entries) > self.max_entries:
+			self.__entries.popitem(last=False)
+		return responses
+
+	def clear(self):
+		self.__entries.clear()
+
+	def getStats(self):
+		return (self.hits, self.misses)
+
+
+class EventLoop(object):
+	# Single threaded select() reactor, serves ServerSockets (see ServerSocket.listen() and acceptAsync()) and their
+	# sessions (see ClientStream) without reader, accept or polling threads.
+	#
+	# Readable file descriptors and timers (heap ordered by deadline) dispatch callbacks in the thread calling run().
+	# Python 2 has no asyncio, thus sessions are driven by callbacks instead of coroutines. callSoonThreadsafe() and
+	# stop() could be called from other threads, they wake up select() by writing to a pipe.
 
 	def __init__(self):
-		self.nl_out_socket = None
-
-		self.__connection_queue = None
-
-		self.srvID = 7 # identifies the server (could be seen as IP, possible values 1..15)
-		self.max_connections = 7
-		self.isBound = False
-		self.isListening = False
+		self.__readers = {} # fd -> callback, called without arguments if fd is readable
+		self.__timers = [] # heap of timers [deadline, sequence number, callback, args], callback is None if cancelled
+		self.__timer_seq = 0
+		self.__pending = deque() # (callback, args) queued by callSoonThreadsafe()
+		self.__pending_lock = RLock()
+		self.__wakeup_r, self.__wakeup_w = os.pipe()
+		self.__wakeup_pending = False # a byte has been written to the wakeup pipe and not been read, yet
+		self.running = False
+		self.iterations = 0 # number of select() calls (wakeups) of the loop
+
+	def addReader(self, fd, callback):
+		self.__readers[fd] = callback
+
+	def removeReader(self, fd):
+		self.__readers.pop(fd, None)
+
+	def callAt(self, deadline, callback, *args):
+		# returns the timer, which could be passed to cancel()
+		self.__timer_seq += 1
+		timer = [deadline, self.__timer_seq, callback, args]
+		heapq.heappush(self.__timers, timer)
+		return timer
+
+	def callLater(self, delay, callback, *args):
+		return self.callAt(time.time() + delay, callback, *args)
+
+	def callSoon(self, callback, *args):
+		return self.callAt(0, callback, *args)
 
 	@staticmethod
-	def eprint(message):
-		sys.stderr.write("WiFiSocket ERROR: "+message + "\n")
-
-	@staticmethod
-	def __parse_ies(s):
-		res = {}
-		if len(s) < 2:
-			return res
-		pos = 0	
-		while pos < (len(s)-2):
-			t = ord(s[pos])
-			pos+=1
-			l = ord(s[pos])
-			pos+=1
-			v = s[pos:pos+l]
-			pos += l
-			res.update({t: [l, v]})
-
-		return res
-
-
-	def bind(self, srvID=7):
-		self.srvID = srvID
-
-		if ServerSocket.__global_firmware_event_queue == None:
-			ServerSocket.__global_firmware_event_queue = Queue.Queue()
-
-		if not ServerSocket.__nl_in_socket == None:
-			ServerSocket.eprint("bind() netlink multicast listener already running...")
-			self.isBound = True
-			return None
-
+	def cancel(timer):
+		timer[2] = None
+
+	def callSoonThreadsafe(self, callback, *args):
+		with self.__pending_lock:
+			self.__pending.append((callback, args))
+			if self.__wakeup_pending:
+				return
+			self.__wakeup_pending = True
+		os.write(self.__wakeup_w, "\x00")
+
+	def stop(self):
+		# run() returns after the current iteration
+		self.callSoonThreadsafe(self.__stop)
+
+	def __stop(self):
+		self.running = False
+
+	def run(self):
+		self.running = True
+		while self.running:
+			self.runOnce()
+
+	def runOnce(self, timeout=None):
+		# waits for readable file descriptors up to the next timer deadline (or timeout, if given and less) and
+		# dispatches the callbacks of the readable file descriptors and due timers
+		if len(self.__timers) > 0:
+			wait = max(0, self.__timers[0][0] - time.time())
+			if timeout == None or wait < timeout:
+				timeout = wait
+		fds = list(self.__readers)
+		fds.append(self.__wakeup_r)
+		readable = select(fds, [], [], timeout)[0]
+		self.iterations += 1
+
+		for fd in readable:
+			if fd == self.__wakeup_r:
+				self.__runPending()
+				continue
+			callback = self.__readers.get(fd)
+			if callback != None:
+				callback()
+
+		# timers scheduled by the callbacks below are dispatched in the next iteration (without waiting)
+		now = time.time()
+		due = []
+		while len(self.__timers) > 0 and self.__timers[0][0] <= now:
+			due.append(heapq.heappop(self.__timers))
+		for timer in due:
+			callback = timer[2]
+			if callback != None:
+				timer[2] = None
+				callback(*timer[3])
+
+	def __runPending(self):
+		os.read(self.__wakeup_r, 4096)
+		with self.__pending_lock:
+			self.__wakeup_pending = False
+			pending = list(self.__pending)
+			self.__pending.clear()
+		for callback, args in pending:
+			callback(*args)
+
+	def close(self):
+		os.close(self.__wakeup_r)
+		os.close(self.__wakeup_w)
+
+
+class ClientStream(object):
+	# Event loop front end of an accepted ClientSocket, the callback counterpart of an asyncio StreamReader/StreamWriter
+	# pair. The ClientSocket reports every handled request and state transfer (event_callback), the stream completes
+	# pending reads and hands buffered writes to the ClientSocket on the loop in response, thus it never blocks or polls.
+	# All methods have to be called in the thread running the loop, the ClientSocket could be served by another thread.
+
+	def __init__(self, client_socket, loop):
+		# type: (ClientSocket, EventLoop) -> None
+		self.client_socket = client_socket
+		self.loop = loop
+		self.__reads = deque() # pending reads (readline, size or limit, callback)
+		self.__writes = deque() # outbound data not accepted by the ClientSocket yet (outbound buffer full)
+		self.__write_size = 0 # bytes in __writes
+		self.__drain_callbacks = []
+		self.__scheduled = False
+		client_socket.event_callback = self.__onEvent
+
+	def read(self, n, callback):
+		# callback(data) is called with up to n bytes of inbound data, as soon as there are some, with "" if the
+		# connection has been closed
+		self.__reads.append((False, n, callback))
+		self.__onEvent()
+
+	def readline(self, callback, limit=-1):
+		# callback(line) is called with the next complete line of inbound data (including "\n"), with "" if the
+		# connection has been closed
+		self.__reads.append((True, limit, callback))
+		self.__onEvent()
+
+	def write(self, data):
+		# never blocks, data which doesn't fit into the outbound buffer of the ClientSocket is kept by the stream
+		if len(data) == 0 or self.atEof():
+			return
+		self.__writes.append(memoryview(data))
+		self.__write_size += len(data)
+		self.__flush()
+
+	def drain(self, callback):
+		# callback() is called when all written data has been handed to the ClientSocket (or the connection is closed)
+		self.__drain_callbacks.append(callback)
+		self.__onEvent()
+
+	def getWriteBufferSize(self):
+		return self.__write_size
+
+	def atEof(self):
+		return self.client_socket.state != ClientSocket.STATE_OPEN
+
+	def close(self, reason_code=Packet.CON_RESET_REASON_UNSPECIFIED):
+		self.client_socket.disconnect(reason_code)
+
+	def __onEvent(self):
+		# callbacks are deferred to the loop, as events are reported while the ClientSocket handles a request. Events
+		# are reported by the firmware event thread, if the server has been started by listen() without a loop, thus
+		# the thread safe variant is used.
+		if not self.__scheduled:
+			self.__scheduled = True
+			self.loop.callSoonThreadsafe(self.__process)
+
+	def __process(self):
+		self.__scheduled = False
+		self.__flush()
+		cs = self.client_socket
+		while len(self.__reads) > 0:
+			readline, size, callback = self.__reads[0]
+			if readline:
+				data = cs.readline(size)
+			else:
+				data = cs.read(size)
+			if len(data) == 0 and not self.atEof():
+				break # wait for the next event
+			self.__reads.popleft()
+			callback(data)
+
+	def __flush(self):
+		cs = self.client_socket
+		while len(self.__writes) > 0 and not self.atEof():
+			chunk = self.__writes[0]
+			sent = cs.send(chunk, block=False)
+			self.__write_size -= sent
+			if sent < len(chunk):
+				self.__writes[0] = chunk[sent:]
+				break
+			self.__writes.popleft()
+		if self.atEof():
+			self.__writes.clear()
+			self.__write_size = 0
+		if len(self.__writes) == 0 and len(self.__drain_callbacks) > 0:
+			callbacks = self.__drain_callbacks
+			self.__drain_callbacks = []
+			for callback in callbacks:
+				callback()
+
+
+class FirmwareEventDemux(object):
+	# Owns the netlink sockets shared by all ServerSockets of the process: the multicast socket receiving probe requests
+	# reported by the firmware and the unicast socket (ProbeRespTX engine) used to send probe responses.
+	# A single reader thread drains, parses and validates the firmware events once and routes the resulting packets by
+	# srvID to the ServerSocket bound to it (virtual servers, each with its own ConnectionQueue). Instead of the thread,
+	# the netlink socket and the timers of the servers could be registered with an EventLoop (see start()).
+
+	MAX_RX_BATCH = 64 # maximum number of firmware events validated and dispatched at once
+	RX_BUF_SIZE = 0xFFFF # size of the receive buffer reused for every netlink message
+	TIMER_INTERVAL = 0.5 # seconds between handleTimers() calls of the servers (if there are no firmware events)
+
+	def __init__(self, extra_ies=""):
+		self.extra_ies = extra_ies # additional IEs of probe responses (see ServerSocket.PROBE_RESP_EXTRA_IES)
+		self.nl_in_socket = None
+		self.nl_out_socket = None
+		self.probe_resp_tx = None # ProbeRespTX engine writing probe responses to nl_out_socket
+		self.batch_rx = numpy != None # validate drained bursts of probe requests vectorized (needs NumPy)
+		self.__servers = {} # srvID -> ServerSocket, replaced (not modified) on changes, as the reader thread iterates it
+		self.rx_wakeups = 0 # number of times the reader woke up with pending messages
+		self.rx_syscalls = 0 # number of recv calls (including the one returning EAGAIN after each drain)
+		self.rx_frames = 0 # number of probe requests with SSID IE received
+		self.rx_allocations = 1 # number of objects allocated for received data (receive buffer and copied out fields)
+		self.__thread = None
+		self.__stop = Event()
+		self.__loop = None # EventLoop the netlink socket is registered with (instead of running the reader thread)
+		self.__loop_timer = None
+
+		# every message is received into the same buffer, the fields needed beyond the current message are copied out by
+		# the parser (MAC addresses, SSID and vendor IEs), nothing else is allocated per message
+		self.__rx_buf = bytearray(FirmwareEventDemux.RX_BUF_SIZE)
+		self.__rx_view = memoryview(self.__rx_buf)
+
+	def open(self):
 		# open socket to receive multicast message from firmware
 		#########################################################
 		try:
 			s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_USERSOCK)
 		except socket.error:
 			ServerSocket.eprint("Error creating netlink socket for Firmware multicasts")
-			return None
+			return False
 
-		# bind to kernel
-		s.bind((os.getpid(), 0))
+		# bind to a port ID chosen by the kernel (see nexconf.openNL_sock())
+		s.bind((0, 0))
 
 		# 270 is SOL_NETLINK and 1 is NETLINK_ADD_MEMBERSHIP
 		try:
 			s.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, nlgroup)
 		except socket.error:
 			ServerSocket.eprint("Failed to attach to netlink multicast group {0}, try with root permissions".format(nlgroup))
-			return None
+			s.close()
+			return False
 
-		ServerSocket.__nl_in_socket = s
+		self.nl_in_socket = s
 
 		# open socket for unicat messages to firmware #
 		###############################################
 		s = nexconf.openNL_sock()
-		ServerSocket.__nl_out_socket = s # socket
-		ServerSocket.__nl_out_socket_fd = os.fdopen(s.fileno(), 'w+b') # writable FD
-
-		print("Bound to server ID {0}".format(self.srvID))
-
-
-
-		self.isBound = True
+		self.nl_out_socket = s # socket
+		self.probe_resp_tx = ProbeRespTX(self.extra_ies, s)
+		return True
 
-	def unbind(self):
+	def close(self):
 		# stop event listener thread for Kernel NL multicasts
 		logging.debug("Stop listening for firmware events...")
-		self.__nl_thread_stop.set()
+		self.__stop.set()
+		if self.__thread != None and self.__thread is not threading.current_thread():
+			self.__thread.join()
+		self.__thread = None
+		if self.__loop != None:
+			if self.nl_in_socket != None:
+				self.__loop.removeReader(self.nl_in_socket.fileno())
+			EventLoop.cancel(self.__loop_timer)
+			self.__loop = None
+			self.__loop_timer = None
 		logging.debug("Unregistering firmware event listener")
-		ServerSocket.__nl_in_socket.close()
-		ServerSocket.__nl_out_socket_fd.close()
-		ServerSocket.__nl_out_socket.close()
-		self.isListening = False
-		self.isBound = False
+		if self.nl_in_socket != None:
+			self.nl_in_socket.close()
+			self.nl_in_socket = None
+		self.probe_resp_tx = None
+		if self.nl_out_socket != None:
+			self.nl_out_socket.close()
+			self.nl_out_socket = None
+
+	def register(self, server):
+		# type: (ServerSocket) -> bool
+		if server.srvID in self.__servers:
+			return False
+		servers = dict(self.__servers)
+		servers[server.srvID] = server
+		self.__servers = servers
+		return True
 
+	def unregister(self, server):
+		if self.__servers.get(server.srvID) is server:
+			servers = dict(self.__servers)
+			del servers[server.srvID]
+			self.__servers = servers
+		return len(self.__servers)
 
-	def listen(self, max_connections=7):
-		if max_connections > ServerSocket.MAX_CONNECTIONS_LIMIT:
-			ServerSocket.eprint("Max connections limited to {0}, but {1} given on listen()".format(ServerSocket.MAX_CONNECTIONS_LIMIT, max_connections))
+	def getServer(self, srvID):
+		return self.__servers.get(srvID)
+
+	def fileno(self):
+		return self.nl_in_socket.fileno()
+
+	def start(self, loop=None):
+		# starts the reader thread or, if an EventLoop is given, registers the netlink socket and the timers with the
+		# loop (if not running already)
+		if self.__thread != None or self.__loop != None:
 			return
-		if not self.isBound:
-			ServerSocket.eprint("Socket isn't bound, listening not possible. Call bind() first.")
+		if loop != None:
+			self.__loop = loop
+			loop.addReader(self.fileno(), self.processEvents)
+			self.__loop_timer = loop.callLater(FirmwareEventDemux.TIMER_INTERVAL, self.__onLoopTimer)
 			return
-		self.max_connections = max_connections
-		self.__connection_queue = ConnectionQueue(max_connections)
+		self.__stop.clear()
+		self.__thread = Thread(target = self.__firmware_event_reader, name = "WiFiSocket Firmware event thread", args = ( ))
+		self.__thread.start()
 
+	def __onLoopTimer(self):
+		self.handleTimers(time.time())
+		if self.__loop != None:
+			self.__loop_timer = self.__loop.callLater(FirmwareEventDemux.TIMER_INTERVAL, self.__onLoopTimer)
 
-		# start Thread which handles incoming probe events
-		ServerSocket.__global_firmware_event_thread = Thread(target = self.__firmware_event_reader, name = "WiFiSocket Firmware event thread", args = ( ))
-		ServerSocket.__global_firmware_event_thread.start()
+	def handleTimers(self, now):
+		for server in self.__servers.values():
+			server.handleTimers(now)
 
-		self.isListening = True
-		print("Listening for incoming connections (max {0})".format(max_connections))
+	def getRxStats(self):
+		# returns (wakeups with pending data, recv syscalls, frames, allocations, frames per wakeup)
+		per_wakeup = float(self.rx_frames) / self.rx_wakeups if self.rx_wakeups > 0 else 0.0
+		return (self.rx_wakeups, self.rx_syscalls, self.rx_frames, self.rx_allocations, per_wakeup)
 
 	def __firmware_event_reader(self):
 		logging.debug("Listening for WiFi firmware events")
-		sfd = ServerSocket.__nl_in_socket.fileno()
+		sfd = self.nl_in_socket.fileno()
 
-		while not ServerSocket.__nl_thread_stop.isSet():
+		while not self.__stop.isSet():
 			
 
 			# instead of blocking read, we poll the socket (blocking, but with timeout)
 			# this is used to keep the thread responsive in order to allow ending it (at least with a delay of read_timeout)
-			read_timeout = 0.5
+			read_timeout = FirmwareEventDemux.TIMER_INTERVAL
 			sel = select([sfd], [], [], read_timeout) # test if readable data arrived on nl_socket, interrupt after timeout
+			self.handleTimers(time.time())
 			if len(sel[0]) == 0:
 				# no data arrived
 #				print "No data"
 				continue
 
-			data = ServerSocket.__nl_in_socket.recvfrom(0xFFFF)[0]
+			self.processEvents()
 
-			# parse data
-			data = data[16:] # strip off nlmsghdr (16)
-			f80211_fc_type_subtype = data[0] # store FC
-			if f80211_fc_type_subtype != "\x40":
-				logging.debug("Firmware event received, but frame isn't a mgmt probe request")
+
+		logging.debug("... stopped listening for firmware events")
+
+	def processEvents(self):
+		# called when the netlink socket is readable (by the reader thread or the EventLoop)
+		# probe requests arrive in bursts, so we drain everything which is pending (non-blocking, till EAGAIN),
+		# validating and dispatching chunks of up to MAX_RX_BATCH frames
+		s = self.nl_in_socket
+		buf = self.__rx_buf
+		view = self.__rx_view
+		self.rx_wakeups += 1
+		drained = False
+		while not drained:
+			frames = []
+			while len(frames) < FirmwareEventDemux.MAX_RX_BATCH:
+				self.rx_syscalls += 1
+				try:
+					length = s.recv_into(buf, 0, socket.MSG_DONTWAIT)
+				except socket.error:
+					drained = True # no more pending messages
+					break
+				frame = self.__parse_firmware_event(buf, view, length)
+				if frame != None:
+					frames.append(frame)
+
+			if len(frames) == 0:
 				continue
-			f80211_fc_flags = data[1] # store flags
-			f80211_duration = data[2:4] # store duration
-			f80211_da = data[4:10] # store destinatioon address
-			f80211_sa = data[10:16] # store source address
-			f80211_bssid = data[16:22] # store bssid
-			f80211_fragment = data[22:24] # store fragment
-			f80211_parameters = data[24:] # store additional IEs (TLV list)
-			f80211_parameters = f80211_parameters[:-2] # fix to avoid parsing 0x0000 padding as SSID type
-
-			#print("IEs: {0}".format(Helper.s2hex(f80211_parameters)))
-
-			ies = ServerSocket.__parse_ies(f80211_parameters)
-
-			# check fo SSID
-			ssid = None
-			ssid_len = 0
-			if 0 in ies:
-				ssid_len = ies[0][0]
-				ssid = ies[0][1]
+			self.rx_frames += len(frames)
+			self.__dispatch(frames)
+
+	def __dispatch(self, frames):
+		if self.batch_rx and len(frames) > 1:
+			packets = FirmwareEventDemux.__validate_batch(frames)
+		else:
+			packets = []
+			for sa, da, ssid, ven_ie in frames:
+				if not Packet.checkLengthChecksum(ssid,  ven_ie):
+					#logging.debug("Packet dropped because length or checksum are wrong")
+					continue
+				packets.append((Packet.parse2packet(sa, da, ssid, ven_ie), ssid, ven_ie))
+
+		# route valid packets to the server bound to their srvID, afterwards they are recycled (ClientSockets keep
+		# copies of packets they need to retain)
+		now = time.time()
+		servers = self.__servers
+		for packet, ssid, ven_ie in packets:
+			server = servers.get(packet.srvID)
+			if server != None:
+				server.handlePacket(packet, ssid, ven_ie, now)
 			else:
-				continue
+				logging.debug("Packet for srvID {0} dropped, no server bound to it".format(packet.srvID))
+			Packet.release(packet)
 
+	def __parse_firmware_event(self, buf, view, length):
+		# type: (bytearray, memoryview, int) -> tuple
+		# returns (sa, da, ssid, ven_ie) of a probe request carrying an SSID IE, None otherwise
+		# buf holds a netlink message of the given length: nlmsghdr (16), 802.11 header (24), IEs (TLV list), 0x0000 padding.
+		# Header bytes and IE TLVs are read in place (view is a memoryview of buf), only the returned fields are copied.
+
+		if length < 40 or buf[16] != 0x40:
+			logging.debug("Firmware event received, but frame isn't a mgmt probe request")
+			return None
+
+		# walk the IEs, the last 2 bytes are skipped to avoid parsing 0x0000 padding as SSID type
+		ssid = None
+		ven_ies = None
+		end = length - 2
+		pos = 40
+		while pos < end - 2:
+			t = buf[pos]
+			l = buf[pos+1]
+			pos += 2
+			if t == 0:
+				if ssid == None:
+					ssid = view[pos:min(pos+l, end)].tobytes()
+					self.rx_allocations += 1
+			elif t == 221 and l == Packet.RAW_VEN_IE_LEN and pos + l <= end:
+				# only IEs of our length are taken into account (the client's driver could add its own)
+				if ven_ies == None:
+					ven_ies = []
+				ven_ies.append(view[pos:pos+l].tobytes())
+				self.rx_allocations += 1
+			pos += l
+
+		if ssid == None:
+			return None
 
-			# check for vendor specific IE (we only check one of the possible vendor IEs)
-			ven_ie = None
-			ven_ie_len = 0
-			if 221 in ies:
-				ven_ie_len = ies[221][0]
-				ven_ie = ies[221][1]
+		ven_ie = None
+		if ven_ies != None:
+			if len(ven_ies) == 1:
+				ven_ie = ven_ies[0]
+			else:
+				ven_ie = ven_ies[:Packet.MAX_VEN_IES]
 
+		self.rx_allocations += 2
+		return (view[26:32].tobytes(), view[20:26].tobytes(), ssid, ven_ie) # sa, da
 
-			if not Packet.checkLengthChecksum(ssid,  ven_ie):
-				#logging.debug("Packet dropped because length or checksum are wrong")
+	@staticmethod
+	def __validate_batch(frames):
+		# validates a burst of (sa, da, ssid, ven_ie) frames in a single vectorized pass and returns (packet, ssid, ven_ie) for the valid ones
+		ssids = [frame[2] for frame in frames]
+		ven_ies = [frame[3] for frame in frames]
+		valid, acks, seqs, flag_lens, clientIDs_srvIDs = Packet.checkLengthChecksumBatch(ssids, ven_ies)
+
+		packets = []
+		for i in range(len(frames)):
+			if not valid[i]:
 				continue
+			sa, da, ssid, ven_ie = frames[i]
+			packets.append((Packet.fields2packet(sa, da, ssid, ven_ie, acks[i], seqs[i], flag_lens[i], clientIDs_srvIDs[i]), ssid, ven_ie))
+		return packets
 
 
+class ServerSocket:
+	MAX_CONNECTIONS_LIMIT = 255 # more clients aren't allowed (clients beyond 15 need extended addressing, see Packet.CAP_EXT_ADDR)
+	CLIENT_SCAN_INTERVAL = 10 # seconds between two scans of a client (worst case), its next request could take as long
+	__demux = None # FirmwareEventDemux shared by all ServerSockets of the process
+
+	# For Atheros AR9271:
+	# 	Supported rates IE and DS parameter set IE have to be present in probe response, otherwise the frame is discarded
+	#	additional note on Atheros: 
+	# 		- vendor IEs isn't transmitted for probe requests issued by scans from Windows, thus the client-to-server mtu is only 7 bytes
+	#		- vendor IEs from probe responses could be read back (as long as the IEs highlighted above are added), thus client to server MTU is 264 bytes
+	#		- a single scan takes less than 4 seconds
+	#		- a scan caches up to 22 received probe responses (based on observations). We only have 16 sequence numbers, this would break the
+	#		flow control (doubled seq/ack). Luckily the Windows driver returns the list in order of reception, which means the last SSID in the
+	#		list of scan results, is the newest Probe Response received. By iterating over the list in reverse order, we could discard older packets
+	#		with repeated sequence number relaibly.
+	#		- the "automatic mtu scaling" works nicely ... client to server data uses only the SSID IE, server to client data contains an additional
+	#		vendor IE and thus has a larger MTU
+	# For 'Intel(R) Dual Band Wireless-AC 3160'
+	#	no additional IEs (beside SSID and Vendor specific IE with data), have to be present in order to work
+	#		- MTU in both directions is 264 bytes, but a single scan takes ~4 seconds
+	PROBE_RESP_EXTRA_IES = "\x01\x08\x82\x84\x8b\x96\x12\x24\x48\x6c" # Supported Rates 1(B), 2(B), 5.5(B), 11(B), 6(B), 9, 12(B), 18, [Mbit/sec]
+	PROBE_RESP_EXTRA_IES += "\x03\x01\x0b" # DS Parameter set: Current Channel: 11
+	PROBE_RESP_EXTRA_IES += "\x7f\x08\x00\x00\x00\x00\x00\x00\x00\x40" # Extended capabilities
 
-			# create a packet and dispatch it
-			packet = Packet.parse2packet(Helper.s2mac(f80211_sa), Helper.s2mac(f80211_da), ssid, ven_ie)
-			self.__inbound_dispatcher(packet)
 
+	def __init__(self):
+		self.__probe_resp_tx = None # ProbeRespTX engine of the FirmwareEventDemux
 
-		logging.debug("... stopped listening for firmware events")
+		self.__connection_queue = None
+		self.__loop = None # EventLoop given to listen()
+		self.__accept_callback = None
+
+		self.srvID = 7 # identifies the server (could be seen as IP, possible values 1..15)
+		self.max_connections = 7
+		self.isBound = False
+		self.isListening = False
+		self.capabilities = ClientSocket.SUPPORTED_CAPS # optional capabilities offered to clients on CON_INIT (Packet.CAP_*)
+		self.dedup_cache = DuplicateRequestCache() # suppresses repeated copies of the same probe request, None to disable
+		self.dedup_reanswer = True # re-send the recorded probe responses for a duplicate, if False duplicates are dropped silently
+		self.__dedup_responses = None # response list of the request currently dispatched (recorded by sendResponse)
+
+		# idle timeouts (seconds without a request from the client) per ClientSocket state, None = never expire
+		self.idle_timeouts = {
+			ClientSocket.STATE_PENDING_OPEN: 30,
+			ClientSocket.STATE_PENDING_ACCEPT: 120,
+			ClientSocket.STATE_OPEN: 300,
+		}
+		self.idle_check_interval = 30 # re-check interval for sessions in states without idle timeout
+		self.sessions_expired = 0 # number of sessions closed because of idle timeout
+
+		# admission control: if no client ID is left for a new client, the least recently active connection of the
+		# first state in evictable_states is reset (connections in other states, f.e. OPEN, are never evicted)
+		self.evictable_states = [ClientSocket.STATE_PENDING_OPEN, ClientSocket.STATE_PENDING_ACCEPT]
+		self.eviction_min_idle = ServerSocket.CLIENT_SCAN_INTERVAL # seconds a connection has to be idle, before it could be evicted
+		# connections which entered the state less than this ago aren't evicted, f.e. a client which received
+		# CON_INIT_RSP1 sends its CON_INIT_REQ2 with the next scan (otherwise new clients could evict each others
+		# handshakes, without any of them completing)
+		self.eviction_min_state_age = {ClientSocket.STATE_PENDING_OPEN: ServerSocket.CLIENT_SCAN_INTERVAL}
+		self.admissions = 0 # new clients which got a client ID
+		self.evictions = 0 # connections reset to make room for a new client
+		self.rejections = 0 # new clients dropped, because no client ID was left
+		self.__session_timers = TimerWheel() # one timer per ClientSocket, serviced by the firmware event thread
 
 	@staticmethod
-	def __send_probe_resp_to_driver(sa, da, ie_ssid_data, ie_vendor_data=None):
-		if ServerSocket.__nl_out_socket_fd == None:
-			ServerSocket.eprint("Socket FD for unicast to device driver not defined")
+	def eprint(message):
+		sys.stderr.write("WiFiSocket ERROR: "+message + "\n")
+
+	def bind(self, srvID=7):
+		# registers the server for srvID at the firmware event demultiplexer (which is created on first bind)
+		self.srvID = srvID
+
+		demux = ServerSocket.__demux
+		if demux == None:
+			demux = FirmwareEventDemux(ServerSocket.PROBE_RESP_EXTRA_IES)
+			if not demux.open():
+				return None
+			ServerSocket.__demux = demux
+
+		if not demux.register(self):
+			ServerSocket.eprint("bind() server ID {0} is already bound".format(srvID))
+			return None
+
+		self.__probe_resp_tx = demux.probe_resp_tx
+
+		print("Bound to server ID {0}".format(self.srvID))
+
+
+
+		self.isBound = True
+
+	def unbind(self):
+		if not self.isBound:
 			return
+		self.isListening = False
+		if self.__connection_queue != None:
+			self.__connection_queue.close() # wake up threads blocked in accept()
+		self.__probe_resp_tx = None
+		self.__accept_callback = None
+		self.isBound = False
 
-		arr_bssid = mac2bstr(sa)
-		arr_da = mac2bstr(da)
-
-		ie_ssid_type = 0
-		ie_ssid_len = 32
-		ie_vendor_type = 221
-		ie_vendor_len = 238
-
-		buf = ""
-
-
-		# For Atheros AR9271:
-		# 	Supported rates IE and DS parameter set IE have to be present in probe response, otherwise the frame is discarded
-		#	additional note on Atheros: 
-		# 		- vendor IEs isn't transmitted for probe requests issued by scans from Windows, thus the client-to-server mtu is only 7 bytes
-		#		- vendor IEs from probe responses could be read back (as long as the IEs highlighted above are added), thus client to server MTU is 264 bytes
-		#		- a single scan takes less than 4 seconds
-		#		- a scan caches up to 22 received probe responses (based on observations). We only have 16 sequence numbers, this would break the
-		#		flow control (doubled seq/ack). Luckily the Windows driver returns the list in order of reception, which means the last SSID in the
-		#		list of scan results, is the newest Probe Response received. By iterating over the list in reverse order, we could discard older packets
-		#		with repeated sequence number relaibly.
-		#		- the "automatic mtu scaling" works nicely ... client to server data uses only the SSID IE, server to client data contains an additional
-		#		vendor IE and thus has a larger MTU
-		# For 'Intel(R) Dual Band Wireless-AC 3160'
-		#	no additional IEs (beside SSID and Vendor specific IE with data), have to be present in order to work
-		#		- MTU in both directions is 264 bytes, but a single scan takes ~4 seconds
-		
-		insert = "\x01\x08\x82\x84\x8b\x96\x12\x24\x48\x6c" # Supported Rates 1(B), 2(B), 5.5(B), 11(B), 6(B), 9, 12(B), 18, [Mbit/sec]
-		insert += "\x03\x01\x0b" # DS Parameter set: Current Channel: 11
-		
-		
-		insert += "\x7f\x08\x00\x00\x00\x00\x00\x00\x00\x40"
-
-		
-		
-		len_insert =  len(insert)
-		if ie_vendor_data == None:
-			buf = struct.pack("<II6s6sBB32s{0}s".format(len_insert), 
-                                          MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP, 
-                                48 + len_insert, # 6 + 6 + 1 + 1 +32 + 1 + 1 + 238
-                                arr_da, 
-                                arr_bssid,
-                                ie_ssid_type,
-                                ie_ssid_len,
-                                ie_ssid_data,
-			        insert)
-		else:
-			buf = struct.pack("<II6s6sBB32s{0}sBB238s".format(len_insert), 
-                                          MaMe82_IO.MAME82_IOCTL_ARG_TYPE_SEND_PROBE_RESP, 
-                                286 + len_insert, # 6 + 6 + 1 + 1 +32 + 1 + 1 + 238
-                                arr_da, 
-                                arr_bssid,
-                                ie_ssid_type,
-                                ie_ssid_len,
-                                ie_ssid_data,
-                                # insert additional IEs here
-			        insert, 
-                                ie_vendor_type,
-                                ie_vendor_len,
-                                ie_vendor_data)
-
-		#print("Outbuf to driver: {0}".format(Helper.s2hex(buf)))
-		
-		ioctl_sendprbrsp = nexconf.create_cmd_ioctl(MaMe82_IO.CMD, buf, True)
-		nexconf.sendNL_IOCTL(ioctl_sendprbrsp, nl_socket_fd=ServerSocket.__nl_out_socket_fd)
+		demux = ServerSocket.__demux
+		if demux != None and demux.unregister(self) == 0:
+			# last server gone
+			demux.close()
+			ServerSocket.__demux = None
+
+
+	def listen(self, max_connections=7, loop=None):
+		# if an EventLoop is given, firmware events and timers are handled by the loop instead of a reader thread (this
+		# has to be the same for all ServerSockets of the process, see FirmwareEventDemux.start())
+		if max_connections > ServerSocket.MAX_CONNECTIONS_LIMIT:
+			ServerSocket.eprint("Max connections limited to {0}, but {1} given on listen()".format(ServerSocket.MAX_CONNECTIONS_LIMIT, max_connections))
+			return
+		if not self.isBound:
+			ServerSocket.eprint("Socket isn't bound, listening not possible. Call bind() first.")
+			return
+		self.max_connections = max_connections
+		self.__connection_queue = ConnectionQueue(max_connections)
+
+
+		# start Thread which handles incoming probe events (shared with other servers)
+		ServerSocket.__demux.start(loop)
+		self.__loop = loop
+
+		self.isListening = True
+		print("Listening for incoming connections (max {0})".format(max_connections))
+
+	def handlePacket(self, req, raw_ssid_data, raw_ven_ie_data, now):
+		# called by the firmware event thread for packets addressed to our srvID
+		self.__dispatch_deduplicated(req, raw_ssid_data, raw_ven_ie_data, now)
+
+	def handleTimers(self, now):
+		# called by the firmware event thread on every wakeup
+		self.__expire_idle_sessions(now)
+
+	def __send_probe_resp_to_driver(self, sa, da, resp):
+		# type: (str, str, Packet) -> None
+		# sa and da are 6 byte binary MACs
+		tx = self.__probe_resp_tx
+		if tx == None:
+			ServerSocket.eprint("Socket for unicast to device driver not defined")
+			return
+
+		# retransmissions (f.e. a ClientSocket's tx_packet re-sent because the client's ack didn't advance) reuse the
+		# message serialized on first transmission
+		key = resp.wireKey(tx)
+		if resp.wire_frame != None and resp.wire_key == key:
+			tx.send_frame(resp.wire_frame)
+			return
+
+		# the SSID IE and vendor IE are packed directly into the prebuilt netlink message
+		ven_ie_count = 0
+		if resp.pay2 != None:
+			ven_ie_count = min(resp.ven_ie_count, ProbeRespTX.MAX_VEN_IES)
+		frame = tx.get_frame(da, sa, ven_ie_count)
+		resp.packRawSsidInto(frame, ProbeRespTX.SSID_DATA_OFFSET, False)
+		for i in range(ven_ie_count):
+			resp.packRawVenIeInto(frame, tx.ven_ie_data_offset + i * ProbeRespTX.VEN_IE_STRIDE, False, i)
+
+		#print("Outbuf to driver: {0}".format(Helper.s2hex(frame)))
+
+		# keep a copy, as the prebuilt message is reused for the next response
+		resp.wire_frame = bytes(frame)
+		resp.wire_key = key
+		tx.send_frame(resp.wire_frame)
+
+	def __dispatch_deduplicated(self, req, raw_ssid_data, raw_ven_ie_data, now):
+		# forwards req to the inbound dispatcher, unless it is an exact duplicate of a request dispatched within the window of the cache
+		cache = self.dedup_cache
+		if cache == None:
+			self.__inbound_dispatcher(req)
+			return
+
+		key = DuplicateRequestCache.request_key(raw_ssid_data, raw_ven_ie_data)
+		responses = cache.lookup(key, now)
+		if responses != None:
+			if self.dedup_reanswer and self.__probe_resp_tx != None:
+				for frame in responses:
+					self.__probe_resp_tx.send_frame(frame)
+			return
+
+		responses = cache.insert(key, now)
+		if self.dedup_reanswer:
+			self.__dedup_responses = responses
+		try:
+			self.__inbound_dispatcher(req)
+		finally:
+			self.__dedup_responses = None
 
 	tmp = 0
 	def __inbound_dispatcher(self, req):
@@ -932,11 +2217,17 @@ class ServerSocket:
 
 
 
-	def sendResponse(self, resp):
-		# type: (Packet) -> None
+	def sendResponse(self, resp, record=True):
+		# type: (Packet, bool) -> None
+		# record=False for packets which aren't an answer to the request currently dispatched (f.e. resets sent to
+		# other clients), these aren't re-sent for duplicates of the request
 		if len(resp.sa) == 0:
-			resp.sa = "de:ad:be:ef:13:37" # ToDo: randomize bssid/sa
-		ServerSocket.__send_probe_resp_to_driver(resp.sa, resp.da, resp.generateRawSsid(False), resp.generateRawVenIe(False))
+			resp.sa = "\xde\xad\xbe\xef\x13\x37" # ToDo: randomize bssid/sa
+		self.__send_probe_resp_to_driver(resp.sa, resp.da, resp)
+		if record and self.__dedup_responses != None and resp.wire_frame != None:
+			# the serialized frame is immutable, thus it could be recorded without copying, although the client socket
+			# keeps modifying its tx_packet
+			self.__dedup_responses.append(resp.wire_frame)
 
 	def handle_request(self, req):
 		# ToDo: this method handles everything, thus code should be moved to inbound dispatcher
@@ -958,20 +2249,23 @@ class ServerSocket:
 				print("InReq1: Connection request from client IV: {0}".format(iv))
 				req.print_out()
 
-				cl_sock = q.provideNewClientSocket(self.srvID)
+				extended = len(req.pay1) > 5 and (ord(req.pay1[5]) & self.capabilities & Packet.CAP_EXT_ADDR) != 0
+				cl_sock = self.__admit(iv, extended)
 				if cl_sock == None:
 					logging.debug("No additional connections possible")
 					# no need to send a connection reset, as the client is still in initial state and continues trying to connect
 					return
 
-				cl_sock.clientIV = iv
 				cl_sock.clientIVBytes = req.pay1[1:5]
+				cl_sock.capabilities = self.capabilities
+				self.__schedule_idle_check(cl_sock, time.time())
 
 				resp = cl_sock.handleRequest(req)
 				print("... InRsp1: Handing out client ID {0}".format(resp.clientID))
 				self.sendResponse(resp)
 			# ClientSocket for given IV exists already
 			else:
+				q.touch(con_pending_open)
 				resp = con_pending_open.handleRequest(req)
 				if resp != None:
 					self.sendResponse(resp)
@@ -983,12 +2277,18 @@ class ServerSocket:
 		else:
 			cl_sock = q.getConnectionByClientID(req.clientID)
 			if cl_sock != None:
+				q.touch(cl_sock)
 				resp = cl_sock.handleRequest(req)
 				if resp != None:
 					self.sendResponse(resp)
+					# remaining packets of the window (sliding window mode only)
+					for burst_resp in cl_sock.tx_burst:
+						self.sendResponse(burst_resp)
 				else:
 					logging.debug("Clientsocket has no response for following request")
 					req.print_out()
+				if cl_sock.event_callback != None:
+					cl_sock.event_callback()
 			else:
 				logging.debug("No target socket for following request from clientID {0}, sending reset...".format(req.clientID))
 				req.print_out()
@@ -996,32 +2296,99 @@ class ServerSocket:
 				self.sendResponse(resp)
 
 
+	def __admit(self, iv, extended=False):
+		# type: (int, bool) -> ClientSocket
+		# provides a ClientSocket for a new client, if no client ID is left a stale connection is evicted (see evictable_states)
+		q = self.__connection_queue
+		cl_sock = q.provideNewClientSocket(self.srvID, iv, extended)
+		if cl_sock == None:
+			max_client_id = 255
+			if not extended:
+				max_client_id = ConnectionQueue.LEGACY_MAX_CLIENT_ID
+			victim = q.getLeastRecentlyActive(self.evictable_states, self.eviction_min_idle, max_client_id=max_client_id,
+				min_state_age=self.eviction_min_state_age)
+			if victim != None:
+				print("Evicting client ID {0} (state {1}) to admit client IV {2}".format(victim.clientID, victim.state, iv))
+				self.evictions += 1
+				if victim.last_rx_packet != None:
+					self.sendResponse(Packet.generateResetPacket(victim.last_rx_packet, self.srvID, Packet.CON_RESET_REASON_UNSPECIFIED), record=False)
+				victim.state = ClientSocket.STATE_CLOSE # deletes the socket and frees its client ID
+				cl_sock = q.provideNewClientSocket(self.srvID, iv, extended)
+		if cl_sock == None:
+			self.rejections += 1
+		else:
+			self.admissions += 1
+		return cl_sock
+
+	def __schedule_idle_check(self, cl_sock, now):
+		timeout = self.idle_timeouts.get(cl_sock.state)
+		if timeout == None:
+			timeout = self.idle_check_interval
+		self.__session_timers.schedule(now + timeout - cl_sock.getIdleTime(now), cl_sock)
+
+	def __expire_idle_sessions(self, now):
+		# called by the firmware event thread, handles the session timers which are due
+		q = self.__connection_queue
+		if q == None:
+			return
+		for cl_sock in self.__session_timers.advance(now):
+			if q.getConnectionByClientID(cl_sock.clientID) is not cl_sock:
+				continue # already removed, timer dropped
+			timeout = self.idle_timeouts.get(cl_sock.state)
+			if timeout == None or cl_sock.getIdleTime(now) < timeout:
+				# the client has been active since the timer has been scheduled (or the state changed), reschedule
+				self.__schedule_idle_check(cl_sock, now)
+				continue
+
+			print("Session of client ID {0} (state {1}) idle for {2:.0f} seconds, closing it".format(cl_sock.clientID, cl_sock.state, cl_sock.getIdleTime(now)))
+			self.sessions_expired += 1
+			if cl_sock.last_rx_packet != None:
+				# in case the client is still around, tell it to re-initiate the connection
+				self.sendResponse(Packet.generateResetPacket(cl_sock.last_rx_packet, self.srvID, Packet.CON_RESET_REASON_UNSPECIFIED), record=False)
+			cl_sock.state = ClientSocket.STATE_CLOSE # the connection queue deletes the socket and recycles the client ID
+
 	def getOpenClientSockets(self):
 		return self.__connection_queue.getConnectionListByState(ClientSocket.STATE_OPEN)
 
-	def accept(self):
-		# type: () -> ClientSocket
+	def accept(self, timeout=None):
+		# type: (float) -> ClientSocket
 
-		# ask connection queue for the first connection in Connection.STATE_PENDING_ACCEPT
-		# if there's no connection, passive wait for a state change
-		# repeat till there's a connection in state Connection.STATE_PENDING_ACCEPT and return it
-		# before returning, set state to open
+		# returns the oldest connection in STATE_PENDING_ACCEPT (after setting it to STATE_OPEN), if there's no such
+		# connection, accept blocks (without polling) till a client finished connection init, the timeout (seconds,
+		# None = forever) is reached or the socket is unbound. Returns None in the latter cases.
 
 		logging.debug("Entering accept()")
 
-		while self.isListening:
-			cons_pa = self.__connection_queue.getConnectionListByState(ClientSocket.STATE_PENDING_ACCEPT)
-			if len(cons_pa) == 0:
-				# no pending connection, passive wait and retry
-				self.__connection_queue.waitForPendingAcceptStateChange()
-				continue
-			else:
-				# pending connection found
-				result_con = cons_pa[0]
+		if not self.isListening:
+			return None
+		result_con = self.__connection_queue.acceptPendingConnection(timeout)
+		if result_con != None:
+			logging.debug("...returning from accept")
+		return result_con
+
+	def acceptAsync(self, callback):
+		# non-blocking counterpart of accept() for servers listening on an EventLoop: callback(con) is called on the
+		# loop for every connection which finished connection init (after setting it to STATE_OPEN)
+		if not self.isListening or self.__loop == None:
+			ServerSocket.eprint("acceptAsync() needs a socket listening on an EventLoop")
+			return False
+		self.__accept_callback = callback
+		self.__connection_queue.accept_callback = self.__onPendingAccept
+		self.__onPendingAccept() # connections which have been pending before
+		return True
 
-				result_con.state = ClientSocket.STATE_OPEN
-				logging.debug("...returning from accept")
-				return result_con
+	def __onPendingAccept(self):
+		# the connection entered pending_accept while its request is handled, thus it is accepted after the request
+		self.__loop.callSoon(self.__acceptPending)
+
+	def __acceptPending(self):
+		q = self.__connection_queue
+		while self.isListening and self.__accept_callback != None:
+			con = q.acceptPendingConnection(0)
+			if con == None:
+				break
+			logging.debug("...accepted client ID {0} on event loop".format(con.clientID))
+			self.__accept_callback(con)
 
 
 
@@ -1141,13 +2508,11 @@ class Server(cmd.Cmd):
 					print("Option not implemented")
 
 
-			while cs.hasInData():
-				inchunk = cs.read(cs.mtu)
-				if len(inchunk) > 0:
-					#print("inchunk: {0}".format(inchunk))
-					sys.stdout.write(inchunk)
-				else:
-					logging.debug("Empty packet")
+			inchunk = cs.read(0xFFFF)
+			if len(inchunk) > 0:
+				#print("inchunk: {0}".format(inchunk))
+				sys.stdout.write(inchunk)
+				sys.stdout.flush()
 
 
 	def emptyline(self):
@@ -1180,13 +2545,14 @@ class Server(cmd.Cmd):
 
 
 ##### MAIN CODE #####
-srv = Server(srvID=9, max_clients=15)
-try:
-	srv.cmdloop(intro=None)
-except KeyboardInterrupt:
-	srv.exit()
-finally:
-	srv.exit()
+if __name__ == "__main__":
+	srv = Server(srvID=9, max_clients=15)
+	try:
+		srv.cmdloop(intro=None)
+	except KeyboardInterrupt:
+		srv.exit()
+	finally:
+		srv.exit()
 
 
 #SERVER_ID = 9